@@ -45,9 +45,10 @@ from apiv2.exceptions import RequiresHttpsException, UnauthorizedException, Serv
     NotFoundException
 from examples import examples
 from search.views import search_prepare_query
+from utils.search.search_general import get_solr_results
 from similarity.client import SimilarityException
 from utils.logging_filters import get_client_ip
-from utils.search.solr import Solr, SolrException, SolrResponseInterpreter
+from utils.search.solr import SolrException
 from utils.similarity_utilities import api_search as similarity_api_search
 from utils.similarity_utilities import get_sounds_descriptors
 
@@ -295,7 +296,6 @@ def api_search(
 
         # Standard text-based search
         try:
-            solr = Solr(settings.SOLR_URL)
             query = search_prepare_query(unquote(search_form.cleaned_data['query'] or ""),
                                          unquote(search_form.cleaned_data['filter'] or ""),
                                          search_form.cleaned_data['sort'],
@@ -304,7 +304,7 @@ def api_search(
                                          grouping=search_form.cleaned_data['group_by_pack'],
                                          include_facets=False)
 
-            result = SolrResponseInterpreter(solr.select(unicode(query)))
+            result = get_solr_results(query)
             solr_ids = [element['id'] for element in result.docs]
             solr_count = result.num_found
 
@@ -21,12 +21,35 @@
 #
 
 from utils.similarity_utilities import api_search as similarity_api_search
-from utils.search.solr import Solr, SolrException, SolrResponseInterpreter
+from utils.search.solr import SolrException, SolrResponseInterpreter
+from utils.search.search_general import get_sounds_solr
 from similarity.client import SimilarityException
 from search.views import search_prepare_query
 from exceptions import ServerErrorException, BadRequestException, NotFoundException
+from multiprocessing.pool import ThreadPool
 from urllib import unquote
 from django.conf import settings
+from django.core.cache import cache
+import threading
+import random
+
+
+COMBINED_SEARCH_CURSOR_CACHE_KEY = 'cs-cursor-%s'
+
+
+_solr_id_blocks_pool = None
+_solr_id_blocks_pool_lock = threading.Lock()
+
+
+def get_solr_id_blocks_pool():
+    """Returns the process-wide pool of threads used to check blocks of ids against solr. The pool is created lazily so
+    that it is not shared between forked processes.
+    """
+    global _solr_id_blocks_pool
+    with _solr_id_blocks_pool_lock:
+        if _solr_id_blocks_pool is None:
+            _solr_id_blocks_pool = ThreadPool(settings.APIV2_COMBINED_SEARCH_SOLR_WORKERS)
+        return _solr_id_blocks_pool
 
 
 def merge_all(search_form, target_file=None, extra_parameters=None):
@@ -88,15 +111,14 @@ def filter_both(search_form, target_file=None, extra_parameters=None):
     gaia_filter_id_max_pages = extra_parameters.get('cs_gaia_filter_id_max_pages', 7)
     gaia_max_pages = extra_parameters.get('cs_max_gaia_pages', 1)
     gaia_page_size = extra_parameters.get('cs_gaia_page_size', 9999999)  # We can get ALL gaia results at once
+    params_for_next_page = dict()
 
     if search_form.cleaned_data['target'] or target_file:
         # First search into gaia and then into solr (get all gaia results)
-        gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results(search_form, target_file, page_size=gaia_page_size, max_pages=gaia_max_pages)
+        gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results_with_cursor(search_form, target_file, extra_parameters, params_for_next_page, page_size=gaia_page_size, max_pages=gaia_max_pages)
         valid_ids_pages = [gaia_ids[i:i+solr_filter_id_block_size] for i in range(0, len(gaia_ids), solr_filter_id_block_size) if (i/solr_filter_id_block_size) < solr_filter_id_max_pages]
         solr_ids = list()
-        solr = Solr(settings.SOLR_URL)
-        for valid_ids_page in valid_ids_pages:
-            page_solr_ids, solr_count = get_solr_results(search_form, page_size=len(valid_ids_page), max_pages=1, valid_ids=valid_ids_page, solr=solr)
+        for page_solr_ids in iter_solr_results_for_id_blocks(search_form, valid_ids_pages):
             solr_ids += page_solr_ids
 
         if gaia_count <= solr_filter_id_block_size * solr_filter_id_max_pages:
@@ -112,7 +134,7 @@ def filter_both(search_form, target_file=None, extra_parameters=None):
         # present in the current block. However given that gaia results can be retrieved
         # all at once very quickly, we optimize this bit by retrieving them all at once and avoiding many requests
         # to similarity server.
-        gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results(search_form, target_file, page_size=gaia_page_size, max_pages=gaia_max_pages)
+        gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results_with_cursor(search_form, target_file, extra_parameters, params_for_next_page, page_size=gaia_page_size, max_pages=gaia_max_pages)
         '''
         # That would be the code without the optimization:
         valid_ids_pages = [solr_ids[i:i+gaia_filter_id_block_size] for i in range(0, len(solr_ids), gaia_filter_id_block_size) if (i/gaia_filter_id_block_size) < gaia_filter_id_max_pages]
@@ -143,7 +165,7 @@ def filter_both(search_form, target_file=None, extra_parameters=None):
     combined_ids = [id for id in results_a if id in results_b_set]
     combined_count = len(combined_ids)
     return combined_ids[(search_form.cleaned_data['page'] - 1) * search_form.cleaned_data['page_size']:search_form.cleaned_data['page'] * search_form.cleaned_data['page_size']], \
-           combined_count, distance_to_target_data, None, note, None, None
+           combined_count, distance_to_target_data, None, note, params_for_next_page, None
 
 
 def merge_optimized(search_form, target_file=None, extra_parameters=None):
@@ -170,31 +192,37 @@ def merge_optimized(search_form, target_file=None, extra_parameters=None):
 
     if search_form.cleaned_data['target'] or target_file:
         # First search into gaia and get all results that have not been checked in previous calls (indicated in request parameter 'cs_lcvidp')
+        # The list of gaia results is kept in the cache for the following pages (see get_gaia_results_with_cursor)
         last_checked_valid_id_position = extra_parameters.get('cs_lcvidp', 0)
         if last_checked_valid_id_position < 0:
             last_checked_valid_id_position = 0
-        gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results(search_form, target_file, page_size=gaia_page_size, max_pages=gaia_max_pages, offset=last_checked_valid_id_position)
+        gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results_with_cursor(search_form, target_file, extra_parameters, params_for_next_page, page_size=gaia_page_size, max_pages=gaia_max_pages, offset=last_checked_valid_id_position)
         if len(gaia_ids):
             # Now divide gaia results in blocks of "solr_filter_id_block_size" results and iteratively query solr limiting the
             # results to those ids in the common block to obtain common results for the search.
             # Once we get as many results as "num_requested_results" or we exceed a maximum number
             # of iterations (solr_filter_id_max_pages), return what we got and update 'cs_lcvidp' parameter for further calls.
+            # Blocks are checked concurrently (see iter_solr_results_for_id_blocks) but results are consumed in order,
+            # so we stop (and skip the blocks not yet sent to solr) as soon as the first blocks have enough results.
             valid_ids_pages = [gaia_ids[i:i+solr_filter_id_block_size] for i in range(0, len(gaia_ids), solr_filter_id_block_size)]
+            valid_ids_pages = valid_ids_pages[:solr_filter_id_max_pages + 1]
             solr_ids = list()
             checked_gaia_ids = list()
-            solr = Solr(settings.SOLR_URL)
-            for count, valid_ids_page in enumerate(valid_ids_pages):
-                page_solr_ids, solr_count = get_solr_results(search_form, page_size=len(valid_ids_page), max_pages=1, valid_ids=valid_ids_page, solr=solr)
-                solr_ids += page_solr_ids
-                checked_gaia_ids += valid_ids_page
-                if len(solr_ids) >= num_requested_results:
-                    debug_note = 'Found enough results in %i solr requests' % (count + 1)
-                    #print 'Did %i requests to solr' % (count + 1)
-                    break
-                if count + 1 > solr_filter_id_max_pages:
-                    debug_note = 'Did %i solr requests (still not enough results)' % (count + 1)
-                    #print 'Too many requests and not enough results'
-                    break
+            blocks_results = iter_solr_results_for_id_blocks(search_form, valid_ids_pages)
+            try:
+                for count, page_solr_ids in enumerate(blocks_results):
+                    solr_ids += page_solr_ids
+                    checked_gaia_ids += valid_ids_pages[count]
+                    if len(solr_ids) >= num_requested_results:
+                        debug_note = 'Found enough results in %i solr requests' % (count + 1)
+                        #print 'Did %i requests to solr' % (count + 1)
+                        break
+                    if count + 1 > solr_filter_id_max_pages:
+                        debug_note = 'Did %i solr requests (still not enough results)' % (count + 1)
+                        #print 'Too many requests and not enough results'
+                        break
+            finally:
+                blocks_results.close()
 
             combined_ids = list()
             for index, sid in enumerate(checked_gaia_ids):
@@ -216,7 +244,7 @@ def merge_optimized(search_form, target_file=None, extra_parameters=None):
 
     else:
         # First search into gaia to obtain a list of all sounds that match content-based query parameters
-        gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results(search_form, target_file, page_size=gaia_page_size, max_pages=gaia_max_pages)
+        gaia_ids, gaia_count, distance_to_target_data, note = get_gaia_results_with_cursor(search_form, target_file, extra_parameters, params_for_next_page, page_size=gaia_page_size, max_pages=gaia_max_pages)
         last_retrieved_solr_id_pos = extra_parameters.get('cs_lrsidp', 0)
         if last_retrieved_solr_id_pos < 0:
             last_retrieved_solr_id_pos = 0
@@ -312,9 +340,77 @@ def get_gaia_results(search_form, target_file, page_size, max_pages, start_page=
     return gaia_ids, gaia_count, distance_to_target_data, note
 
 
+def get_gaia_results_with_cursor(search_form, target_file, extra_parameters, params_for_next_page, page_size, max_pages,
+                                 offset=0):
+    """
+    Same as get_gaia_results (starting at offset) but the list of gaia ids and distances is stored in the cache, together
+    with the offset it starts at, under a random cursor which is added to params_for_next_page as 'cs_cursor'. Following
+    requests for the same content-based query which include the cursor get the stored list (sliced at their offset)
+    instead of querying the similarity server again, as long as the stored list starts before their offset and reaches
+    the last result. Cursors expire after settings.APIV2_COMBINED_SEARCH_CURSOR_TIMEOUT seconds and lists with more
+    than settings.APIV2_COMBINED_SEARCH_CURSOR_MAX_IDS ids are not stored. Searches with a target file do not use
+    cursors.
+    """
+    use_cursor = not target_file and settings.APIV2_COMBINED_SEARCH_CURSOR_TIMEOUT
+    query_params = [search_form.cleaned_data['target'], search_form.cleaned_data['descriptors_filter'],
+                    page_size, max_pages]
+
+    cursor = extra_parameters.get('cs_cursor', None)
+    if use_cursor and cursor is not None:
+        stored_results = cache.get(COMBINED_SEARCH_CURSOR_CACHE_KEY % cursor)
+        if stored_results is not None and stored_results['query_params'] == query_params \
+                and stored_results['offset'] <= offset \
+                and stored_results['offset'] + len(stored_results['gaia_ids']) >= stored_results['gaia_count']:
+            params_for_next_page['cs_cursor'] = cursor
+            return stored_results['gaia_ids'][offset - stored_results['offset']:], stored_results['gaia_count'], \
+                   stored_results['distance_to_target_data'], stored_results['note']
+
+    gaia_ids, gaia_count, distance_to_target_data, note = \
+        get_gaia_results(search_form, target_file, page_size=page_size, max_pages=max_pages, offset=offset)
+
+    if use_cursor and len(gaia_ids) <= settings.APIV2_COMBINED_SEARCH_CURSOR_MAX_IDS:
+        cursor = random.getrandbits(62)
+        cache.set(COMBINED_SEARCH_CURSOR_CACHE_KEY % cursor, {
+            'query_params': query_params,
+            'offset': offset,
+            'gaia_ids': gaia_ids,
+            'gaia_count': gaia_count,
+            'distance_to_target_data': distance_to_target_data,
+            'note': note,
+        }, settings.APIV2_COMBINED_SEARCH_CURSOR_TIMEOUT)
+        params_for_next_page['cs_cursor'] = cursor
+
+    return gaia_ids, gaia_count, distance_to_target_data, note
+
+
+def iter_solr_results_for_id_blocks(search_form, valid_ids_pages):
+    """
+    Generator that yields, for each block of ids in valid_ids_pages and in the same order, the list of solr ids that
+    match the query and are in the block. Blocks are checked concurrently using the process-wide pool of threads
+    (at most settings.APIV2_COMBINED_SEARCH_SOLR_WORKERS solr requests at a time), so the time to get N blocks is
+    bounded by the slowest requests rather than by the sum of all of them. When the generator is closed, blocks which
+    have not yet been sent to solr are skipped.
+    """
+    solr = get_sounds_solr()
+    cancelled = threading.Event()
+
+    def check_block(valid_ids_page):
+        if cancelled.is_set():
+            return None
+        page_solr_ids, solr_count = get_solr_results(search_form, page_size=len(valid_ids_page), max_pages=1,
+                                                     valid_ids=valid_ids_page, solr=solr)
+        return page_solr_ids
+
+    try:
+        for page_solr_ids in get_solr_id_blocks_pool().imap(check_block, valid_ids_pages):
+            yield page_solr_ids
+    finally:
+        cancelled.set()
+
+
 def get_solr_results(search_form, page_size, max_pages, start_page=1, valid_ids=None, solr=None, offset=None):
     if not solr:
-        solr = Solr(settings.SOLR_URL)
+        solr = get_sounds_solr()
 
     query_filter = search_form.cleaned_data['filter']
     if valid_ids:
@@ -17,16 +17,21 @@
 # Authors:
 #     See AUTHORS file.
 #
-from django.test import TestCase, SimpleTestCase
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.core.cache import cache
 from django.urls import reverse
 from django.conf import settings
 
 from apiv2.models import ApiV2Client
 from apiv2.apiv2_utils import ApiSearchPaginator
+from apiv2.combined_search_strategies import iter_solr_results_for_id_blocks, get_gaia_results_with_cursor
 from sounds.tests import create_user_and_sounds
 from forms import SoundCombinedSearchFormAPI
 
 from exceptions import BadRequestException
+from multiprocessing.pool import ThreadPool
+import mock
+import threading
 
 
 class TestAPiViews(TestCase):
@@ -137,6 +142,32 @@ class TestAPI(TestCase):
         resp = self.client.options("/apiv2/search/text/?query=ambient&filter=tag:(rain%20OR%CAfe)", secure=True, **headers)
         self.assertEqual(resp.status_code, 200)
 
+    @mock.patch('apiv2.views.CombinedSearch.merging_strategy', 'filter_both')
+    @mock.patch('apiv2.views.api_search')
+    def test_combined_search_last_page(self, api_search):
+        user, packs, sounds = create_user_and_sounds(num_sounds=5, num_packs=1)
+        c = ApiV2Client(user=user, status='OK', redirect_uri="https://freesound.com",
+                        url="https://freesound.com", name="test")
+        c.save()
+        headers = {
+            'HTTP_AUTHORIZATION': 'Token %s' % c.key,
+        }
+
+        # Last page of the results with a cursor for the next page has no 'more' link
+        sound_ids = [sound.id for sound in sounds]
+        api_search.return_value = (sound_ids, len(sound_ids), None, None, None, {'cs_cursor': 'cursor'}, None)
+        resp = self.client.get(reverse('apiv2-sound-combined-search'),
+                               {'filter': 'tag:rain', 'target': '.lowlevel.pitch.mean:220'}, secure=True, **headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(resp.data['more'])
+
+        # Other pages keep the cursor in the 'more' link
+        api_search.return_value = (sound_ids, 100, None, None, None, {'cs_cursor': 'cursor'}, None)
+        resp = self.client.get(reverse('apiv2-sound-combined-search'),
+                               {'filter': 'tag:rain', 'target': '.lowlevel.pitch.mean:220'}, secure=True, **headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('cs_cursor=cursor', resp.data['more'])
+
 
 class ApiSearchPaginatorTest(TestCase):
     def test_page(self):
@@ -152,6 +183,112 @@ class ApiSearchPaginatorTest(TestCase):
                                  'page_num': 2})
 
 
+class CombinedSearchSolrIdBlocksTest(SimpleTestCase):
+
+    @mock.patch('apiv2.combined_search_strategies.get_solr_id_blocks_pool')
+    @mock.patch('apiv2.combined_search_strategies.get_sounds_solr')
+    @mock.patch('apiv2.combined_search_strategies.get_solr_results')
+    def test_blocks_results_in_order_and_cancelled(self, get_solr_results, get_sounds_solr, get_solr_id_blocks_pool):
+        pool = ThreadPool(2)
+        get_solr_id_blocks_pool.return_value = pool
+        second_block_done = threading.Event()
+        release_blocks = threading.Event()
+
+        def fake_get_solr_results(search_form, page_size, max_pages, valid_ids=None, solr=None):
+            if valid_ids[0] == 0:
+                # First block answers after the second one, results must still be returned in order
+                second_block_done.wait(10)
+            elif valid_ids[0] == 1:
+                second_block_done.set()
+            elif valid_ids[0] > 2:
+                # Blocks after the third one don't answer until the generator is closed
+                release_blocks.wait(10)
+            return [valid_ids[0]], 1
+        get_solr_results.side_effect = fake_get_solr_results
+
+        valid_ids_pages = [[i] for i in range(0, 10)]
+        blocks_results = iter_solr_results_for_id_blocks(None, valid_ids_pages)
+        self.assertEqual([next(blocks_results) for i in range(0, 3)], [[0], [1], [2]])
+        blocks_results.close()
+        release_blocks.set()
+        pool.close()
+        pool.join()
+
+        # Blocks not yet sent to solr when closing the generator are skipped (at most one block per thread of the
+        # pool was already being checked)
+        checked_blocks = [call[1]['valid_ids'][0] for call in get_solr_results.call_args_list]
+        self.assertEqual(sorted(checked_blocks)[:3], [0, 1, 2])
+        self.assertLessEqual(max(checked_blocks), 4)
+
+
+class CombinedSearchCursorTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.search_form = mock.Mock(cleaned_data={'target': '1234', 'descriptors_filter': None})
+
+    @mock.patch('apiv2.combined_search_strategies.get_gaia_results')
+    def test_cursor_reuses_gaia_results(self, get_gaia_results):
+        get_gaia_results.return_value = ([1, 2, 3], 3, {1: 0.1, 2: 0.2, 3: 0.3}, None)
+
+        params_for_next_page = dict()
+        results = get_gaia_results_with_cursor(self.search_form, None, {}, params_for_next_page, 9999999, 1)
+        self.assertEqual(results, get_gaia_results.return_value)
+        self.assertIn('cs_cursor', params_for_next_page)
+
+        # Next page with the cursor does not query gaia again
+        next_params_for_next_page = dict()
+        results = get_gaia_results_with_cursor(self.search_form, None, params_for_next_page, next_params_for_next_page,
+                                               9999999, 1)
+        self.assertEqual(results, get_gaia_results.return_value)
+        self.assertEqual(next_params_for_next_page, params_for_next_page)
+        self.assertEqual(get_gaia_results.call_count, 1)
+
+        # A cursor is not valid for a different content-based query
+        self.search_form.cleaned_data['target'] = '5678'
+        get_gaia_results_with_cursor(self.search_form, None, params_for_next_page, dict(), 9999999, 1)
+        self.assertEqual(get_gaia_results.call_count, 2)
+
+    @mock.patch('apiv2.combined_search_strategies.get_gaia_results')
+    def test_cursor_with_offset(self, get_gaia_results):
+        get_gaia_results.return_value = ([1, 2, 3], 3, {1: 0.1, 2: 0.2, 3: 0.3}, None)
+        params_for_next_page = dict()
+        get_gaia_results_with_cursor(self.search_form, None, {}, params_for_next_page, 9999999, 1)
+
+        # Following pages get the stored list from their offset
+        results = get_gaia_results_with_cursor(self.search_form, None, params_for_next_page, dict(), 9999999, 1,
+                                               offset=2)
+        self.assertEqual(results[0], [3])
+        self.assertEqual(get_gaia_results.call_count, 1)
+
+        # Lists which don't reach the last result are not used for offsets after their end
+        get_gaia_results.return_value = ([1, 2], 10, {1: 0.1, 2: 0.2}, None)
+        params_for_next_page = dict()
+        get_gaia_results_with_cursor(self.search_form, None, {}, params_for_next_page, 2, 1)
+        get_gaia_results.return_value = ([5, 6], 10, {5: 0.5, 6: 0.6}, None)
+        results = get_gaia_results_with_cursor(self.search_form, None, params_for_next_page, dict(), 2, 1, offset=4)
+        self.assertEqual(results[0], [5, 6])
+        self.assertEqual(get_gaia_results.call_args[1]['offset'], 4)
+
+    @mock.patch('apiv2.combined_search_strategies.get_gaia_results')
+    def test_cursor_not_used_for_target_file(self, get_gaia_results):
+        get_gaia_results.return_value = ([3, 4], 4, {}, None)
+        params_for_next_page = dict()
+        results = get_gaia_results_with_cursor(self.search_form, 'file', {}, params_for_next_page, 9999999, 1,
+                                               offset=2)
+        self.assertEqual(results[0], [3, 4])
+        self.assertEqual(get_gaia_results.call_args[1]['offset'], 2)
+        self.assertNotIn('cs_cursor', params_for_next_page)
+
+    @override_settings(APIV2_COMBINED_SEARCH_CURSOR_MAX_IDS=2)
+    @mock.patch('apiv2.combined_search_strategies.get_gaia_results')
+    def test_cursor_not_stored_for_big_results(self, get_gaia_results):
+        get_gaia_results.return_value = ([1, 2, 3], 3, {}, None)
+        params_for_next_page = dict()
+        get_gaia_results_with_cursor(self.search_form, None, {}, params_for_next_page, 9999999, 1)
+        self.assertNotIn('cs_cursor', params_for_next_page)
+
+
 class TestSoundCombinedSearchFormAPI(SimpleTestCase):
     # Query
     def test_query_empty_valid(self):
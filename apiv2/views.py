@@ -338,7 +338,7 @@ class CombinedSearch(GenericAPIView):
                                                                        page=search_form.cleaned_data['page'] + 1)
                 else:
                     response_data['more'] = None
-            if extra_parameters_string:
+            if extra_parameters_string and response_data['more'] is not None:
                 response_data['more'] += '%s' % extra_parameters_string
         else:
             response_data['more'] = None
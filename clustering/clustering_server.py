@@ -121,14 +121,14 @@ class ClusteringServer(resource.Resource):
         k = int(np.ceil(np.log2(len(sound_ids_list))))
         k = 5
 
-        for sound_id in sound_ids_list:
-            try:
-                nearest_neighbors = self.gaia.search_nearest_neighbors(sound_id, k, sound_ids_list, features=features)
-                # edges += [(sound_id, i[0]) for i in nearest_neighbors if i[1]<20]
-                graph.add_edges_from([(sound_id, i[0]) for i in nearest_neighbors if i[1]<20])
-                # graph.add_weighted_edges_from([(sound_id, i[0], 1/i[1]) for i in nearest_neighbors if i[1]<10])
-            except ValueError:  # node does not exist in Gaia dataset
-                graph.remove_node(sound_id)
+        # Nearest neighbors of all the sounds are searched at once, sounds that do not exist in Gaia dataset are
+        # not returned and end up as isolated nodes
+        all_nearest_neighbors = self.gaia.search_nearest_neighbors_batch(sound_ids_list, k, sound_ids_list,
+                                                                         features=features)
+        for sound_id, nearest_neighbors in all_nearest_neighbors.iteritems():
+            # edges += [(sound_id, i[0]) for i in nearest_neighbors if i[1]<20]
+            graph.add_edges_from([(sound_id, i[0]) for i in nearest_neighbors if i[1]<20])
+            # graph.add_weighted_edges_from([(sound_id, i[0], 1/i[1]) for i in nearest_neighbors if i[1]<10])
 
         # Remove isolated nodes
         graph.remove_nodes_from(list(nx.isolates(graph)))
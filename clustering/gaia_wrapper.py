@@ -9,7 +9,7 @@ from gaia2 import DataSet, View, DistanceFunctionFactory
 import clustering_settings as clust_settings
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
-from similarity.gaia_wrapper import GaiaWrapper as GaiaWrapperSimilarity
+from similarity.gaia_wrapper import GaiaWrapper as GaiaWrapperSimilarity, parse_gaia_filter
 
 logger = logging.getLogger('clustering')
 
@@ -98,6 +98,32 @@ class GaiaWrapper:
             logger.info(e)
             return []
 
+    def search_nearest_neighbors_batch(self, sound_ids, k, in_sound_ids=[], features='audio_as'):
+        """Same as search_nearest_neighbors for a list of sounds, the filter is only parsed once for all of them.
+        Returns a dictionary of sound id -> nearest neighbors (sounds that could not be searched are not included)."""
+        if in_sound_ids:
+            filter = parse_gaia_filter('WHERE point.id IN ("' + '", "'.join(in_sound_ids) + '")')
+        else:
+            filter = None
+        if features == 'audio_as':
+            view, metric = self.as_view, self.as_metric
+        elif features == 'tag':
+            view, metric = self.tag_view, self.tag_metric
+        elif features == 'audio_fs':
+            view, metric = self.gaia_similiarity.view_pca, self.gaia_similiarity.metrics['pca']
+        elif features == 'audio_fs_selected':
+            view, metric = self.fs_view, self.fs_metric
+        elif features == 'audio_ac':
+            view, metric = self.ac_view, self.ac_metric
+
+        nearest_neighbors = dict()
+        for sound_id in sound_ids:
+            try:
+                nearest_neighbors[sound_id] = view.nnSearch(sound_id, metric, filter).get(k)[1:]
+            except Exception as e:
+                logger.info(e)
+        return nearest_neighbors
+
     def return_sound_tag_features(self, sound_ids):
         tag_features = []
         for sound_id in sound_ids:
@@ -23,8 +23,7 @@
 from follow.models import FollowingUserItem, FollowingQueryItem
 import sounds
 from search.views import search_prepare_query, search_prepare_sort
-from django.conf import settings
-from utils.search.solr import Solr, SolrResponseInterpreter
+from utils.search.search_general import get_sounds_solr
 from search.forms import SEARCH_SORT_OPTIONS_WEB
 # from utils.search.solr import Solr, SolrQuery, SolrException, SolrResponseInterpreter, SolrResponseInterpreterPaginator
 import urllib
@@ -97,93 +96,75 @@ def get_vars_for_views_helper(user, clip):
 
 
 def get_stream_sounds(user, time_lapse):
-
-    solr = Solr(settings.SOLR_URL)
-
+    """Returns the latest sounds of the users and tags followed by user uploaded during time_lapse. All followed users
+    and tags are retrieved with a single Solr request (one group.query per followed user or set of tags) and all
+    sounds are retrieved with a single database query, no matter how many users and tags are followed.
+    """
     sort_str = search_prepare_sort("created desc", SEARCH_SORT_OPTIONS_WEB)
 
+    users_following = get_users_following(user)
+    tags_following = [tag_following.split(" ") for tag_following in get_tags_following(user)]
+    if not users_following and not tags_following:
+        return [], []
+
+    # Group queries are the same clauses we use as filters when linking to the search page
+    users_group_queries = ["username:" + user_following.username for user_following in users_following]
+    tags_group_queries = ["".join(["tag:" + tag + " " for tag in tags]) for tags in tags_following]
+
+    query = search_prepare_query(
+        "",
+        "created:" + time_lapse,
+        sort_str,
+        1,
+        SOLR_QUERY_LIMIT_PARAM,
+        grouping=False,
+        include_facets=False
+    )
+    query.set_group_options(
+        group_query=users_group_queries + tags_group_queries,
+        group_limit=SOLR_QUERY_LIMIT_PARAM,
+        group_sort=sort_str[0],
+        group_num_groups=False)
+    grouped = get_sounds_solr().select(unicode(query)).get("grouped", {})
+
+    # Get the sound ids of every group and retrieve all sounds from the DB at once
+    groups_sound_ids = dict()
+    for group_query in users_group_queries + tags_group_queries:
+        group = grouped.get(group_query, None)
+        if group is not None and group['doclist']['docs']:
+            groups_sound_ids[group_query] = ([element['id'] for element in group['doclist']['docs']],
+                                             group['doclist']['numFound'])
+    all_sound_ids = [sound_id for sound_ids, _ in groups_sound_ids.values() for sound_id in sound_ids]
+    sound_objs_dict = sounds.models.Sound.objects.select_related('license', 'user').in_bulk(all_sound_ids)
+
+    def get_group_sounds(group_query, filter_str):
+        sound_ids, num_found = groups_sound_ids[group_query]
+        more_count = max(0, num_found - SOLR_QUERY_LIMIT_PARAM)
+        # the sorting only works if done like this!
+        more_url_params = [urllib.quote(filter_str), urllib.quote(sort_str[0])]
+        sound_objs = [sound_objs_dict[sound_id] for sound_id in sound_ids if sound_id in sound_objs_dict]
+        new_count = more_count + len(sound_ids)
+        return sound_objs, more_url_params, more_count, new_count
+
     #
     # USERS FOLLOWING
     #
 
-    users_following = get_users_following(user)
-
     users_sounds = []
-    for user_following in users_following:
-
-        filter_str = "username:" + user_following.username + " created:" + time_lapse
-
-        query = search_prepare_query(
-            "",
-            filter_str,
-            sort_str,
-            1,
-            SOLR_QUERY_LIMIT_PARAM,
-            grouping=False,
-            include_facets=False
-        )
-
-        result = SolrResponseInterpreter(solr.select(unicode(query)))
-
-        if result.num_rows != 0:
-
-            more_count = max(0, result.num_found - SOLR_QUERY_LIMIT_PARAM)
-
-            # the sorting only works if done like this!
-            more_url_params = [urllib.quote(filter_str), urllib.quote(sort_str[0])]
-
-            # this is the same link but for the email has to be "quoted"
-            more_url = u"?f=" + filter_str + u"&s=" + sort_str[0]
-            # more_url_quoted = urllib.quote(more_url)
-
-            sound_ids = [element['id'] for element in result.docs]
-            sound_objs = sounds.models.Sound.objects.filter(id__in=sound_ids).select_related('license', 'user')
-            new_count = more_count + len(sound_ids)
-            users_sounds.append(((user_following, False), sound_objs, more_url_params, more_count, new_count))
+    for user_following, group_query in zip(users_following, users_group_queries):
+        if group_query in groups_sound_ids:
+            filter_str = group_query + " created:" + time_lapse
+            users_sounds.append(((user_following, False),) + get_group_sounds(group_query, filter_str))
 
     #
     # TAGS FOLLOWING
     #
 
-    tags_following = get_tags_following(user)
-
     tags_sounds = []
-    for tag_following in tags_following:
-
-        tags = tag_following.split(" ")
-        tag_filter_query = ""
-        for tag in tags:
-            tag_filter_query += "tag:" + tag + " "
-
-        tag_filter_str = tag_filter_query + " created:" + time_lapse
-
-        query = search_prepare_query(
-            "",
-            tag_filter_str,
-            sort_str,
-            1,
-            SOLR_QUERY_LIMIT_PARAM,
-            grouping=False,
-            include_facets=False
-        )
-
-        result = SolrResponseInterpreter(solr.select(unicode(query)))
-
-        if result.num_rows != 0:
-
-            more_count = max(0, result.num_found - SOLR_QUERY_LIMIT_PARAM)
-
-            # the sorting only works if done like this!
-            more_url_params = [urllib.quote(tag_filter_str), urllib.quote(sort_str[0])]
-
-            # this is the same link but for the email has to be "quoted"
-            more_url = u"?f=" + tag_filter_str + u"&s=" + sort_str[0]
-            # more_url_quoted = urllib.quote(more_url)
-
-            sound_ids = [element['id'] for element in result.docs]
-            sound_objs = sounds.models.Sound.objects.filter(id__in=sound_ids)
-            new_count = more_count + len(sound_ids)
-            tags_sounds.append((tags, sound_objs, more_url_params, more_count, new_count))
+    for tags, group_query in zip(tags_following, tags_group_queries):
+        if group_query in groups_sound_ids:
+            filter_str = group_query + " created:" + time_lapse
+            tags_sounds.append((tags,) + get_group_sounds(group_query, filter_str))
 
     return users_sounds, tags_sounds
 
@@ -24,6 +24,11 @@ from django.test.client import Client
 from accounts.models import Profile
 from django.contrib.auth.models import User
 from follow.models import FollowingUserItem, FollowingQueryItem
+from follow import follow_utils
+from sounds.models import Sound
+from datetime import datetime, timedelta
+import mock
+import urlparse
 
 
 class FollowTestCase(TestCase):
@@ -147,3 +152,44 @@ class FollowTestCase(TestCase):
         # Stream should return OK
         resp = self.client.get("/home/stream/")
         self.assertEqual(resp.status_code, 200)
+
+
+class StreamSoundsTestCase(TestCase):
+
+    fixtures = ['users', 'sounds_with_tags']
+
+    def setUp(self):
+        self.user = User.objects.create_user("testuser", password="testpass")
+        self.sound_ids = list(Sound.objects.values_list('id', flat=True)[:follow_utils.SOLR_QUERY_LIMIT_PARAM])
+
+    def fake_select(self, query_string):
+        # Every group query returns the same sounds
+        group_queries = urlparse.parse_qs(str(query_string))['group.query']
+        return {'grouped': dict((group_query, {
+            'matches': 10,
+            'doclist': {'numFound': 10, 'start': 0, 'docs': [{'id': sound_id} for sound_id in self.sound_ids]}
+        }) for group_query in group_queries)}
+
+    @mock.patch('follow.follow_utils.get_sounds_solr')
+    def test_get_stream_sounds_num_backend_calls(self, get_sounds_solr):
+        get_sounds_solr.return_value.select.side_effect = self.fake_select
+        time_lapse = follow_utils.build_time_lapse(datetime.now() - timedelta(days=7), datetime.now())
+        users = list(User.objects.exclude(id=self.user.id)[:5])
+
+        for num_following in [1, 5]:
+            for user in users[:num_following]:
+                FollowingUserItem.objects.get_or_create(user_from=self.user, user_to=user)
+                FollowingQueryItem.objects.create(user=self.user, query='%s another_tag' % user.username)
+            get_sounds_solr.return_value.select.reset_mock()
+
+            # Solr and DB calls do not depend on the number of followed users and tags
+            with self.assertNumQueries(3):
+                users_sounds, tags_sounds = follow_utils.get_stream_sounds(self.user, time_lapse)
+            self.assertEqual(get_sounds_solr.return_value.select.call_count, 1)
+
+            self.assertEqual(len(users_sounds), num_following)
+            self.assertEqual(len(tags_sounds), FollowingQueryItem.objects.filter(user=self.user).count())
+            (user, _), sound_objs, more_url_params, more_count, new_count = users_sounds[0]
+            self.assertEqual([sound.id for sound in sound_objs], self.sound_ids)
+            self.assertEqual(more_count, 10 - follow_utils.SOLR_QUERY_LIMIT_PARAM)
+            self.assertEqual(new_count, 10)
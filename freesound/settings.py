@@ -228,6 +228,10 @@ SOLR_DYNAMIC_FIELDS_SUFFIX_MAP = {
     unicode: '_s',
 }
 
+# Number of seconds that the results of a search query (ids, facets and counts) are cached. Cached results are also
+# invalidated when sounds are added to or deleted from the index. Set to 0 to disable the cache.
+SEARCH_RESULTS_CACHE_TIMEOUT = 60 * 5
+
 # Random Sound of the day settings
 # Don't choose a sound by a user whose sound has been chosen in the last ~1 month
 NUMBER_OF_DAYS_FOR_USER_RANDOM_SOUNDS = 30
@@ -306,6 +310,16 @@ APIV2 = {
     'MAX_PAGE_SIZE': 150,
 }
 
+# Maximum number of concurrent Solr requests (per process) used by combined search strategies to check blocks of
+# similarity results against Solr
+APIV2_COMBINED_SEARCH_SOLR_WORKERS = 4
+
+# Number of seconds that combined search cursors (the list of similarity results of a query, reused when requesting
+# the following pages) are kept, and maximum number of similarity results stored for a cursor. Set the timeout to 0
+# to disable cursors.
+APIV2_COMBINED_SEARCH_CURSOR_TIMEOUT = 60 * 10
+APIV2_COMBINED_SEARCH_CURSOR_MAX_IDS = 50000
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'apiv2.pagination.CustomPagination',
     'DEFAULT_PERMISSION_CLASSES': ('rest_framework.permissions.IsAuthenticated',),
@@ -0,0 +1,144 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import logging
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
+from similarity.client import Similarity
+from similarity.similarity_settings import DEFAULT_PRESET, SIMILAR_SOUNDS_TO_CACHE
+import similarity.similarity_settings as sim_settings
+from sounds.models import Sound, SimilarSoundsList
+
+logger = logging.getLogger("web")
+console_logger = logging.getLogger("console")
+
+# The similarity server searches batches in groups of SEARCH_BATCH_GROUP_SIZE sounds which have to finish before
+# SEARCH_BATCH_DEADLINE, slices of a few groups fit in it even when exact (not approximate) searches are used
+DEFAULT_SLICE_SIZE = 2 * getattr(sim_settings, 'SEARCH_BATCH_GROUP_SIZE', 50)
+
+
+def search_similar_sounds(args):
+    # Runs in a worker process, returns the packed results of every sound found in the similarity index
+    sound_ids, num_results, preset = args
+    try:
+        results = Similarity.search_batch(sound_ids, num_results=num_results, preset=preset)
+    except Exception as e:
+        return sound_ids, None, str(e)
+    return sound_ids, [(int(sound_id), result['count'], SimilarSoundsList.pack_results(result['results']))
+                       for sound_id, result in results.items()], None
+
+
+class Command(BaseCommand):
+    help = "Precompute the results of the similarity search of every sound in the similarity index so that similar " \
+           "sounds pages do not need to query the similarity service. Use option --incremental to only compute the " \
+           "results of sounds which do not have them (sounds whose similarity state changed since the last run)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--num_results',
+            action='store',
+            dest='num_results',
+            type=int,
+            default=SIMILAR_SOUNDS_TO_CACHE,
+            help='Number of similar sounds stored for every sound')
+
+        parser.add_argument(
+            '-p', '--preset',
+            action='store',
+            dest='preset',
+            default=DEFAULT_PRESET,
+            help='Similarity preset')
+
+        parser.add_argument(
+            '-w', '--workers',
+            action='store',
+            dest='workers',
+            type=int,
+            default=4,
+            help='Number of processes sending requests to the similarity service')
+
+        parser.add_argument(
+            '-s', '--slice_size',
+            action='store',
+            dest='slice_size',
+            type=int,
+            default=DEFAULT_SLICE_SIZE,
+            help='Number of sounds searched in every request (slices that fail are retried split in halves)')
+
+        parser.add_argument(
+            '-i', '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Only compute the results of sounds which do not have them')
+
+    def handle(self, *args, **options):
+        preset = options['preset']
+        sounds = Sound.objects.filter(similarity_state='OK')
+        if options['incremental']:
+            sounds = sounds.exclude(similar_sounds_lists__preset=preset)
+        sound_ids = list(sounds.order_by('id').values_list('id', flat=True))
+        logger.info("Starting precomputation of similar sounds. %i sounds to be searched" % len(sound_ids))
+
+        # Worker processes don't use the database, close the connection so that it is not shared with them
+        # Inside a transaction (e.g. in tests) the connection can't be closed, workers exit without using it anyway
+        if not connection.in_atomic_block:
+            connections.close_all()
+        pool = Pool(options['workers'])
+        slices = [sound_ids[i:i + options['slice_size']] for i in range(0, len(sound_ids), options['slice_size'])]
+        start = time.time()
+        num_saved = 0
+        num_failed = 0
+        while slices:
+            # Slices that fail (e.g. because they did not finish before the deadline of the similarity server) are
+            # searched again in the next round split in halves, until they only have one sound
+            failed_slices = []
+            tasks = [(slice_sound_ids, options['num_results'], preset) for slice_sound_ids in slices]
+            for count, (slice_sound_ids, results, error) in \
+                    enumerate(pool.imap_unordered(search_similar_sounds, tasks)):
+                if results is None:
+                    console_logger.info("Could not search %i sounds (%s)" % (len(slice_sound_ids), error))
+                    if len(slice_sound_ids) > 1:
+                        half = len(slice_sound_ids) / 2
+                        failed_slices += [slice_sound_ids[:half], slice_sound_ids[half:]]
+                    else:
+                        num_failed += 1
+                    continue
+                with transaction.atomic():
+                    SimilarSoundsList.objects.filter(sound_id__in=slice_sound_ids, preset=preset).delete()
+                    SimilarSoundsList.objects.bulk_create([
+                        SimilarSoundsList(sound_id=sound_id, preset=preset, count=total, results_data=results_data)
+                        for sound_id, total, results_data in results])
+                num_saved += len(results)
+                console_logger.info("Searched slice %i of %i (%i sounds saved)" % (count + 1, len(slices), num_saved))
+            slices = failed_slices
+        pool.close()
+        pool.join()
+
+        elapsed = time.time() - start
+        logger.info("Finished precomputation of similar sounds. %i sounds saved, %i could not be searched (%.2f "
+                    "seconds, %.2f sounds/sec)" % (num_saved, num_failed, elapsed,
+                                                   num_saved / elapsed if elapsed else 0))
+        if num_failed:
+            raise CommandError("%i sounds could not be searched" % num_failed)
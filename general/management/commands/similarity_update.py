@@ -19,13 +19,56 @@
 #
 
 from django.core.management.base import BaseCommand
-from sounds.models import Sound
+from django.db import connection, connections
+from sounds.models import Sound, SimilarSoundsList
 from similarity.client import Similarity
-from optparse import make_option
+from multiprocessing import Pool
+import re
+import time
 import yaml
 import logging
 logger = logging.getLogger("web")
 
+EXTRACTOR_VERSION_RE = re.compile(r'^\s+freesound_extractor:\s*(\S.*?)\s*$')
+
+
+def get_extractor_version(yaml_path):
+    """Returns the freesound extractor version of an analysis file by looking for it line by line (it is only
+    parsed with yaml if the version is not found that way), None if the file has no version and False if it is
+    empty. Raises an exception if the file can't be read."""
+    with open(yaml_path) as f:
+        empty = True
+        for line in f:
+            empty = empty and not line.strip()
+            match = EXTRACTOR_VERSION_RE.match(line)
+            if match:
+                return match.group(1).strip('"\'')
+    if empty:
+        return False
+    data = yaml.load(open(yaml_path), Loader=yaml.cyaml.CLoader)
+    if not data:
+        return False
+    version = data['metadata']['version'].get('freesound_extractor', None)
+    return str(version) if version is not None else None
+
+
+def check_analysis_file(args):
+    # Runs in a worker process, returns the sound id, analysis file path and the reason why the sound should not be
+    # indexed (None if it should be indexed)
+    sound_id, yaml_path, freesound_extractor_version = args
+    if freesound_extractor_version:
+        try:
+            version = get_extractor_version(yaml_path)
+        except Exception:
+            return sound_id, yaml_path, 'no yaml file found when checking for extractor version'
+        if version is False:
+            return sound_id, yaml_path, 'most probably empty yaml file'
+        if version is None:
+            return sound_id, yaml_path, 'it was analyzed with an unknown extractor'
+        if version != freesound_extractor_version:
+            return sound_id, yaml_path, 'it was analyzed with extractor version %s' % version
+    return sound_id, yaml_path, None
+
 
 class Command(BaseCommand):
     help = "Take all sounds that haven't been added to the similarity service yet and add them. Use option --force to " \
@@ -62,6 +105,22 @@ class Command(BaseCommand):
             default=False,
             help='Send files to the indexing server instead of the main similarity server')
 
+        parser.add_argument(
+            '-w', '--workers',
+            action='store',
+            dest='workers',
+            type=int,
+            default=4,
+            help='Number of processes checking analysis files')
+
+        parser.add_argument(
+            '-c', '--chunk_size',
+            action='store',
+            dest='chunk_size',
+            type=int,
+            default=100,
+            help='Number of sounds added to the similarity index in every request')
+
     def handle(self,  *args, **options):
 
         limit = int(options['limit'])
@@ -72,54 +131,66 @@ class Command(BaseCommand):
         else:
             to_be_added = Sound.objects.filter(analysis_state='OK', similarity_state='PE', moderation_state='OK').order_by('id')[:limit]
 
-        logger.info("Starting similarity update. %i sounds to be added to the similarity index" % to_be_added.count())
-        N = len(to_be_added)
-        for count, sound in enumerate(to_be_added):
-
-            # Check if sound analyzed using the desired extractor
-            if freesound_extractor_version:
-                try:
-                    data = yaml.load(open(sound.locations('analysis.statistics.path')), Loader=yaml.cyaml.CLoader)
-                except:
-                    print 'Sound with id %i was not indexed (no yaml file found when checking for extractor version)' % sound.id
-                    continue
-
-                if data:
-                    if 'freesound_extractor' in data['metadata']['version']:
-                        if data['metadata']['version']['freesound_extractor'] != freesound_extractor_version:
-                            print 'Sound with id %i was not indexed (it was analyzed with extractor version %s)' % (sound.id, data['metadata']['version']['freesound_extractor'])
-                            continue
-                    else:
-                        print 'Sound with id %i was not indexed (it was analyzed with an unknown extractor)' % sound.id
-                        continue
-                else:
-                    print 'Sound with id %i was not indexed (most probably empty yaml file)' % sound.id
-                    continue
-
-            try:
-                if options['indexing_server']:
-                    result = Similarity.add_to_indeixing_server(sound.id, sound.locations('analysis.statistics.path'))
-                else:
-                    result = Similarity.add(sound.id, sound.locations('analysis.statistics.path'))
-                    sound.set_similarity_state('OK')
-                    sound.invalidate_template_caches()
-                print "%s (%i of %i)" % (result, count+1, N)
-
-                # Every 2000 added sounds, save the index
-                #if count % 2000 == 0:
-                #    if options['indexing_server']:
-                #        Similarity.save_indexing_server()
-                #    else:
-                #        Similarity.save()
-
-            except Exception as e:
-                if not options['indexing_server']:
-                    sound.set_similarity_state('FA')
-                print 'Sound could not be added (id: %i, %i of %i): \n\t%s' % (sound.id, count+1, N ,str(e))
-
-        logger.info("Finished similarity update. %i sounds added to the similarity index" % to_be_added.count())
+        sounds = dict((sound.id, sound) for sound in to_be_added)
+        N = len(sounds)
+        logger.info("Starting similarity update. %i sounds to be added to the similarity index" % N)
+        start = time.time()
+
+        # Analysis files are checked in worker processes (which don't use the database, so the connection is closed
+        # to not share it with them) while checked sounds are added to the index in chunks
+        # Inside a transaction (e.g. in tests) the connection can't be closed, workers exit without using it anyway
+        if not connection.in_atomic_block:
+            connections.close_all()
+        pool = Pool(options['workers'])
+        files_to_check = [(sound_id, sounds[sound_id].locations('analysis.statistics.path'),
+                           freesound_extractor_version) for sound_id in sorted(sounds)]
+        chunk = []
+        num_added = 0
+        num_failed = 0
+        for count, (sound_id, yaml_path, reason) in enumerate(pool.imap(check_analysis_file, files_to_check,
+                                                                        chunksize=10)):
+            if reason is not None:
+                print 'Sound with id %i was not indexed (%s)' % (sound_id, reason)
+            else:
+                chunk.append((sound_id, yaml_path))
+            if len(chunk) == options['chunk_size'] or (count + 1 == N and chunk):
+                added, failed = self.add_chunk(chunk, sounds, options['indexing_server'])
+                num_added += added
+                num_failed += failed
+                print "Added %i sounds, %i could not be added (%i of %i)" % (added, failed, count + 1, N)
+                chunk = []
+        pool.close()
+        pool.join()
+
+        elapsed = time.time() - start
+        logger.info("Finished similarity update. %i sounds added to the similarity index, %i could not be added "
+                    "(%.2f seconds, %.2f sounds/sec)" % (num_added, num_failed, elapsed,
+                                                         num_added / elapsed if elapsed else 0))
         # At the end save the index
         #if options['indexing_server']:
         #    Similarity.save_indexing_server()
         #else:
         #    Similarity.save()
+
+    def add_chunk(self, chunk, sounds, indexing_server):
+        sound_ids = [sound_id for sound_id, _ in chunk]
+        try:
+            result = Similarity.add_points(sound_ids, [yaml_path for _, yaml_path in chunk],
+                                           indexing_server=indexing_server)
+        except Exception as e:
+            print 'Sounds could not be added (ids: %s): \n\t%s' % (','.join(map(str, sound_ids)), str(e))
+            result = {'added': [], 'failed': dict((str(sound_id), str(e)) for sound_id in sound_ids)}
+        added_ids = [int(sound_id) for sound_id in result['added']]
+        failed_ids = [int(sound_id) for sound_id in result['failed']]
+        for sound_id in failed_ids:
+            print 'Sound could not be added (id: %i): \n\t%s' % (sound_id, result['failed'][str(sound_id)])
+
+        if not indexing_server:
+            # Similarity state of the sounds of the chunk is updated with one query per state. Same as in
+            # Sound.set_similarity_state, precomputed similar sounds of these sounds are now outdated
+            Sound.objects.filter(id__in=added_ids).update(similarity_state='OK')
+            Sound.objects.filter(id__in=failed_ids).update(similarity_state='FA')
+            SimilarSoundsList.objects.filter(sound_id__in=added_ids + failed_ids).delete()
+            for sound_id in added_ids:
+                sounds[sound_id].invalidate_template_caches()
+        return len(added_ids), len(failed_ids)
@@ -39,5 +39,6 @@ urlpatterns = [
     url(r'^ajax_users_stats/$', monitor.views.users_stats_ajax, name='monitor-users-stats-ajax'),
     url(r'^ajax_active_users_stats/$', monitor.views.active_users_stats_ajax, name='monitor-active-users-stats-ajax'),
     url(r'^ajax_moderator_stats/$', monitor.views.moderator_stats_ajax, name='monitor-moderator-stats-ajax'),
+    url(r'^ajax_solr_stats/$', monitor.views.solr_stats_ajax, name='monitor-solr-stats-ajax'),
 
 ]
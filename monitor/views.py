@@ -32,6 +32,8 @@ from django.http import HttpResponse, JsonResponse
 from django.db.models import Count
 from tickets import TICKET_STATUS_CLOSED
 from sounds.models import Sound
+from utils.search.solr import get_connection_pools_stats
+from utils.search.search_general import solr_query_cache_stats
 from collections import Counter
 
 @login_required
@@ -200,6 +202,16 @@ def totals_stats_ajax(request):
     return JsonResponse(totals_stats or {})
 
 
+@login_required
+@user_passes_test(lambda u: u.is_staff, login_url='/')
+def solr_stats_ajax(request):
+    # NOTE: connection pools are per process, so these are the stats of the worker serving this request
+    return JsonResponse({
+        'connection_pools': get_connection_pools_stats(),
+        'query_cache': solr_query_cache_stats.as_dict(),
+    })
+
+
 @login_required
 @user_passes_test(lambda u: u.is_staff, login_url='/')
 def process_sounds(request):
@@ -0,0 +1,79 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils.search.search_general import SOLR_SOUNDS_DATE_FIELDS
+from utils.search.solr import Solr, SolrJsonResponseDecoder
+
+console_logger = logging.getLogger("console")
+
+
+class Command(BaseCommand):
+    help = 'Compare the time it takes to decode recorded Solr responses with the regex-based decoder and with the ' \
+           'schema-driven one (which only converts known date fields). Use --record to store the response of a ' \
+           'query so it can be used as input later.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('response_files', nargs='*', help='Files with raw JSON responses from Solr')
+        parser.add_argument(
+            '-n', '--iterations',
+            action='store',
+            dest='iterations',
+            type=int,
+            default=20,
+            help='Number of times each response is decoded')
+        parser.add_argument(
+            '-r', '--record',
+            action='store',
+            dest='record',
+            default=None,
+            help='Query string to send to the sounds Solr index. The raw response is saved to the first filename '
+                 'passed as argument instead of running the benchmark')
+
+    def handle(self, *args, **options):
+        response_files = options['response_files']
+        if options['record'] is not None:
+            raw_response = Solr(settings.SOLR_URL)._request(query_string=options['record'])
+            open(response_files[0], 'w').write(raw_response)
+            console_logger.info("Saved response of %i bytes to %s", len(raw_response), response_files[0])
+            return
+
+        decoders = [
+            ('regex', SolrJsonResponseDecoder()),
+            ('schema', SolrJsonResponseDecoder(date_fields=SOLR_SOUNDS_DATE_FIELDS)),
+        ]
+        for filename in response_files:
+            raw_response = open(filename).read()
+            results = dict()
+            for name, decoder in decoders:
+                start = time.time()
+                for i in range(0, options['iterations']):
+                    decoded = decoder.decode(raw_response)
+                elapsed = (time.time() - start) * 1000.0 / options['iterations']
+                results[name] = decoded
+                console_logger.info("%s (%i bytes): %s decoder %.2f ms per response",
+                                    filename, len(raw_response), name, elapsed)
+            if results['regex'] != results['schema']:
+                console_logger.info("%s: decoded responses differ (some non-date field looks like a date)", filename)
@@ -0,0 +1,85 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from sounds.models import Sound
+from utils.search.search_general import add_all_sounds_to_solr, convert_to_solr_document
+from utils.search.solr import BaseSolrAddEncoder, SolrJsonAddEncoder
+
+console_logger = logging.getLogger("console")
+
+
+class Command(BaseCommand):
+    help = 'Measure Solr indexing throughput (sounds/sec) by re-indexing a number of sounds. Use --encode_only to ' \
+           'only compare the XML and JSON document encoders without sending anything to Solr.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--num_sounds',
+            action='store',
+            dest='num_sounds',
+            type=int,
+            default=10000,
+            help='Number of sounds to index')
+        parser.add_argument(
+            '-s', '--slice_size',
+            action='store',
+            dest='slice_size',
+            type=int,
+            default=1000,
+            help='Number of sounds sent to Solr in every request')
+        parser.add_argument(
+            '--no_pipeline',
+            action='store_true',
+            dest='no_pipeline',
+            help='Do not fetch the next slice of sounds from the database while posting the current one to Solr')
+        parser.add_argument(
+            '--encode_only',
+            action='store_true',
+            dest='encode_only',
+            help='Only measure document encoding time')
+
+    def handle(self, *args, **options):
+        sound_ids = list(Sound.objects.filter(processing_state="OK", moderation_state="OK")
+                         .values_list('id', flat=True)[:options['num_sounds']])
+
+        if options['encode_only']:
+            documents = [convert_to_solr_document(s) for s in Sound.objects.bulk_query_solr(sound_ids)]
+            for name, encoder in [('xml', BaseSolrAddEncoder()), ('json', SolrJsonAddEncoder())]:
+                start = time.time()
+                for i in range(0, len(documents), options['slice_size']):
+                    encoder.encode(documents[i:i + options['slice_size']])
+                elapsed = time.time() - start
+                console_logger.info("%s encoder: %i sounds in %.2f seconds (%.2f sounds/sec)",
+                                    name, len(documents), elapsed, len(documents) / elapsed if elapsed else 0)
+            return
+
+        start = time.time()
+        num_indexed = add_all_sounds_to_solr(Sound.objects.filter(id__in=sound_ids),
+                                             slice_size=options['slice_size'],
+                                             pipelined=not options['no_pipeline'])
+        elapsed = time.time() - start
+        console_logger.info("Indexed %i sounds in %.2f seconds (%.2f sounds/sec, %s)", num_indexed, elapsed,
+                            num_indexed / elapsed if elapsed else 0,
+                            'not pipelined' if options['no_pipeline'] else 'pipelined')
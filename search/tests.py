@@ -22,9 +22,16 @@ from django.test import TestCase, override_settings
 from django.urls import reverse
 from sounds.models import Sound
 from search.views import search_process_filter
-from utils.search.solr import SolrResponseInterpreter, SolrResponseInterpreterPaginator
+from utils.search.search_general import search_prepare_query, get_solr_results, get_solr_query_cache_key, \
+    invalidate_solr_query_cache, solr_query_cache_stats
+from utils.search.solr import SolrResponseInterpreter, SolrResponseInterpreterPaginator, SolrConnectionPool, \
+    SolrJsonResponseDecoder, SolrQuery
+from django.core.cache import cache
 import mock
 import copy
+import datetime
+import json
+import socket
 
 
 solr_select_returned_data = {
@@ -161,4 +168,132 @@ class SearchProcessFilter(TestCase):
                                        'ac_warmth_d: ac_sharpness_d: another_field:')
 
 
+class SolrConnectionPoolTest(TestCase):
 
+    def _mock_response(self, body='{}', will_close=False):
+        response = mock.Mock(status=200, will_close=will_close)
+        response.read.return_value = body
+        return response
+
+    @mock.patch('utils.search.solr.httplib.HTTPConnection')
+    def test_connections_are_reused(self, http_connection):
+        http_connection.return_value.sock = None
+        http_connection.return_value.getresponse.return_value = self._mock_response()
+        pool = SolrConnectionPool('localhost', 8983, max_size=2)
+        for i in range(0, 3):
+            response, data = pool.request('GET', '/solr/select/?q=dogs')
+            self.assertEqual(data, '{}')
+
+        # Only the first request opens a connection, the rest reuse it
+        self.assertEqual(http_connection.call_count, 1)
+        stats = pool.stats.as_dict()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+
+    @mock.patch('utils.search.solr.httplib.HTTPConnection')
+    def test_connection_not_reused_if_server_closes_it(self, http_connection):
+        http_connection.return_value.sock = None
+        http_connection.return_value.getresponse.return_value = self._mock_response(will_close=True)
+        pool = SolrConnectionPool('localhost', 8983)
+        pool.request('GET', '/solr/select/?q=dogs')
+        pool.request('GET', '/solr/select/?q=dogs')
+        self.assertEqual(pool.stats.as_dict()['misses'], 2)
+
+    @mock.patch('utils.search.solr.httplib.HTTPConnection')
+    def test_reconnect_on_broken_connection(self, http_connection):
+        broken_connection = mock.Mock(sock=None)
+        broken_connection.request.side_effect = socket.error('Broken pipe')
+        new_connection = mock.Mock(sock=None)
+        new_connection.getresponse.return_value = self._mock_response()
+        http_connection.side_effect = [new_connection, new_connection]
+
+        pool = SolrConnectionPool('localhost', 8983)
+        pool._idle.append(broken_connection)
+        response, data = pool.request('GET', '/solr/select/?q=dogs')
+        self.assertEqual(data, '{}')
+        broken_connection.close.assert_called_once_with()
+        stats = pool.stats.as_dict()
+        self.assertEqual(stats['reconnects'], 1)
+        self.assertEqual(stats['errors'], 0)
+
+        # Errors on new connections are not retried
+        new_connection.request.side_effect = socket.error('Connection refused')
+        pool._idle = []
+        self.assertRaises(socket.error, pool.request, 'GET', '/solr/select/?q=dogs')
+        self.assertEqual(pool.stats.as_dict()['errors'], 1)
+
+
+class SolrJsonResponseDecoderTest(TestCase):
+
+    def test_decode_schema_date_fields(self):
+        raw_response = json.dumps({
+            'responseHeader': {'QTime': 3, 'params': {'q': '2010-01-01T00:00:00Z'}},
+            'response': {'numFound': 1, 'start': 0, 'docs': [
+                {'id': 1, 'created': '2010-02-03T04:05:06.789Z', 'description': '2011-01-01T00:00:00Z', 'tag': ['a']}
+            ]},
+            'grouped': {'grouping_pack': {'matches': 1, 'ngroups': 1, 'groups': [
+                {'groupValue': '1', 'doclist': {'numFound': 1, 'start': 0, 'docs': [
+                    {'id': 2, 'created': '2012-01-01T00:00:00Z'}
+                ]}}
+            ]}},
+        })
+
+        # Regex-based decoder converts any string that looks like a date
+        response = SolrJsonResponseDecoder().decode(raw_response)
+        self.assertEqual(response['response']['docs'][0]['description'], datetime.datetime(2011, 1, 1))
+        self.assertEqual(response['responseHeader']['params']['q'], datetime.datetime(2010, 1, 1))
+
+        # Schema-driven decoder only converts date fields of the documents
+        response = SolrJsonResponseDecoder(date_fields=['created']).decode(raw_response)
+        doc = response['response']['docs'][0]
+        self.assertEqual(doc['created'], datetime.datetime(2010, 2, 3, 4, 5, 6))
+        self.assertEqual(doc['description'], '2011-01-01T00:00:00Z')
+        self.assertEqual(response['responseHeader']['params']['q'], '2010-01-01T00:00:00Z')
+        grouped_doc = response['grouped']['grouping_pack']['groups'][0]['doclist']['docs'][0]
+        self.assertEqual(grouped_doc['created'], datetime.datetime(2012, 1, 1))
+
+        # Not requested fields are dropped
+        response = SolrJsonResponseDecoder(date_fields=[], field_list=['id']).decode(raw_response)
+        self.assertEqual(response['response']['docs'][0], {'id': 1})
+
+
+class SolrQueryCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cache_key_does_not_depend_on_parameters_order(self):
+        query1 = SolrQuery()
+        query1.set_query('dogs')
+        query1.set_query_options(start=0, rows=15, field_list=["id"])
+        query2 = SolrQuery()
+        query2.set_query_options(field_list=["id"], rows=15, start=0)
+        query2.set_query('dogs')
+        self.assertEqual(get_solr_query_cache_key(query1), get_solr_query_cache_key(query2))
+
+        query2.set_query('cats')
+        self.assertNotEqual(get_solr_query_cache_key(query1), get_solr_query_cache_key(query2))
+
+    @override_settings(SEARCH_RESULTS_CACHE_TIMEOUT=60)
+    @mock.patch('utils.search.search_general.get_sounds_solr')
+    def test_results_are_cached_until_invalidated(self, get_sounds_solr):
+        get_sounds_solr.return_value.select.side_effect = \
+            lambda query_string: copy.deepcopy(solr_select_returned_data)
+        query = search_prepare_query('dogs', '', ['score desc'], 1, 15)
+        hits = solr_query_cache_stats.hits
+
+        results = get_solr_results(query)
+        self.assertEqual(results.num_found, 548)
+        get_solr_results(query)
+        self.assertEqual(get_sounds_solr.return_value.select.call_count, 1)
+        self.assertEqual(solr_query_cache_stats.hits, hits + 1)
+
+        # Updating the index invalidates cached results
+        invalidate_solr_query_cache()
+        get_solr_results(query)
+        self.assertEqual(get_sounds_solr.return_value.select.call_count, 2)
+
+        # Cache can be bypassed
+        get_solr_results(query, use_cache=False)
+        self.assertEqual(get_sounds_solr.return_value.select.call_count, 3)
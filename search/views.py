@@ -33,9 +33,10 @@ import forms
 import sounds
 import forum
 from utils.search.search_general import search_prepare_sort, search_process_filter, \
-    search_prepare_query, perform_solr_query
+    search_prepare_query, perform_solr_query, get_sounds_solr
+from utils.search.search_forum import get_forum_solr
 from utils.logging_filters import get_client_ip
-from utils.search.solr import Solr, SolrQuery, SolrResponseInterpreter, \
+from utils.search.solr import SolrQuery, SolrResponseInterpreter, \
     SolrResponseInterpreterPaginator, SolrException
 from utils.clustering_utilities import cluster_sound_results
 
@@ -394,7 +395,7 @@ def search_forum(request):
         query.set_group_field("thread_title_grouped")
         query.set_group_options(group_limit=30)
 
-        solr = Solr(settings.SOLR_FORUM_URL)
+        solr = get_forum_solr()
 
         try:
             results = SolrResponseInterpreter(solr.select(unicode(query)))
@@ -442,7 +443,7 @@ def get_pack_tags(pack_obj):
     query.add_facet_fields("tag")
     query.set_facet_options("tag", limit=20, mincount=1)
     try:
-        solr = Solr(settings.SOLR_URL)
+        solr = get_sounds_solr()
         results = SolrResponseInterpreter(solr.select(unicode(query)))
     except (SolrException, Exception) as e:
         #  TODO: do something here?
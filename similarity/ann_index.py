@@ -0,0 +1,157 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import numpy as np
+
+
+class IVFIndex:
+    '''
+    Approximate nearest neighbour index of fixed-length vectors with euclidean distance (inverted file index).
+    When the index is built, vectors are clustered in n_lists lists (k-means) and a search only computes the distances
+    to the vectors of the n_probes lists whose centroids are closest to the query, so search time depends on the size
+    of the lists instead of the size of the index. Points added after the index is built are assigned to the list of
+    the closest centroid (centroids are not recomputed until the index is built again).
+    Rows of removed points are reused by points added later.
+    '''
+
+    kmeans_iterations = 10
+    kmeans_training_points_per_list = 50
+    chunk_size = 10000  # Vectors for which distances to the centroids are computed at once
+
+    def __init__(self, n_lists=None, n_probes=8):
+        self.n_lists = n_lists  # Defaults to the square root of the number of points
+        self.n_probes = n_probes
+        self.centroids = None
+        self.vectors = None
+        self.vector_lists = None  # List of every row of vectors
+        self.names = []  # Name of the point of every row of vectors (None for free rows)
+        self.rows = dict()
+        self.free_rows = []
+        self.lists = []  # Rows of every list
+        self.list_arrays = []  # Rows of every list as numpy arrays (None if the list changed since last search)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def build(self, names, vectors):
+        vectors = np.array(vectors, dtype=np.float32)
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(len(names)))), len(names))
+        self.centroids = self.__kmeans(vectors, n_lists)
+        self.vectors = vectors
+        self.vector_lists = self.__closest_centroids(vectors, 1)[:, 0]
+        self.names = list(names)
+        self.rows = dict((name, row) for row, name in enumerate(self.names))
+        self.free_rows = []
+
+        order = np.argsort(self.vector_lists, kind='mergesort')
+        boundaries = np.searchsorted(self.vector_lists[order], np.arange(n_lists + 1))
+        self.lists = [order[boundaries[i]:boundaries[i + 1]].tolist() for i in range(n_lists)]
+        self.list_arrays = [None] * n_lists
+
+    def add(self, name, vector):
+        if name in self.rows:
+            self.remove(name)
+        if self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            row = len(self.names)
+            self.names.append(None)
+            if row == len(self.vectors):
+                # Grow vectors (and their lists) to double capacity
+                extra_rows = max(row, 1)
+                self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors[:extra_rows])])
+                self.vector_lists = np.concatenate([self.vector_lists, np.empty_like(self.vector_lists[:extra_rows])])
+        self.vectors[row] = vector
+        list_id = self.__closest_centroids(self.vectors[row:row + 1], 1)[0, 0]
+        self.vector_lists[row] = list_id
+        self.names[row] = name
+        self.rows[name] = row
+        self.lists[list_id].append(row)
+        self.list_arrays[list_id] = None
+
+    def remove(self, name):
+        row = self.rows.pop(name)
+        list_id = self.vector_lists[row]
+        self.lists[list_id].remove(row)
+        self.list_arrays[list_id] = None
+        self.names[row] = None
+        self.free_rows.append(row)
+
+    def search(self, query, number_of_results, offset=0):
+        """
+        Returns a list of (name, distance) tuples of the nearest points to query (name of a point of the index or
+        vector) sorted by distance (a point of the index is returned as its own nearest neighbour).
+        """
+        if isinstance(query, basestring):
+            query = self.vectors[self.rows[query]]
+        query = np.asarray(query, dtype=np.float32)
+
+        candidates = np.concatenate([self.__list_array(list_id) for list_id in
+                                     self.__closest_centroids(query[np.newaxis], self.n_probes)[0]])
+        distances = np.sqrt(np.square(self.vectors[candidates] - query).sum(axis=1))
+        n = min(number_of_results + offset, len(candidates))
+        if n <= 0:
+            return []
+        nearest = np.argpartition(distances, n - 1)[:n]
+        nearest = nearest[np.argsort(distances[nearest], kind='mergesort')][offset:]
+        return [(self.names[candidates[i]], float(distances[i])) for i in nearest]
+
+    def __list_array(self, list_id):
+        rows = self.list_arrays[list_id]
+        if rows is None:
+            rows = self.list_arrays[list_id] = np.array(self.lists[list_id], dtype=np.int64)
+        return rows
+
+    def __closest_centroids(self, vectors, n, centroids=None):
+        # Squared euclidean distances without the norm of the vectors (does not change the order)
+        if centroids is None:
+            centroids = self.centroids
+        n = min(n, len(centroids))
+        centroid_norms = np.square(centroids).sum(axis=1)
+        closest = np.empty((len(vectors), n), dtype=np.int64)
+        for start in range(0, len(vectors), self.chunk_size):
+            distances = centroid_norms - 2 * np.dot(vectors[start:start + self.chunk_size], centroids.T)
+            if n < len(centroids):
+                nearest = np.argpartition(distances, n - 1, axis=1)[:, :n]
+            else:
+                nearest = np.tile(np.arange(n), (len(distances), 1))
+            rows = np.arange(len(distances))[:, np.newaxis]
+            order = np.argsort(distances[rows, nearest], axis=1)
+            closest[start:start + self.chunk_size] = nearest[rows, order]
+        return closest
+
+    def __kmeans(self, vectors, n_lists):
+        random_state = np.random.RandomState(0)
+        n_training_points = min(len(vectors), n_lists * self.kmeans_training_points_per_list)
+        training_points = vectors[random_state.choice(len(vectors), n_training_points, replace=False)]
+        centroids = training_points[random_state.choice(n_training_points, n_lists, replace=False)].copy()
+        for i in range(self.kmeans_iterations):
+            assignments = self.__closest_centroids(training_points, 1, centroids)[:, 0]
+            order = np.argsort(assignments, kind='mergesort')
+            counts = np.bincount(assignments, minlength=n_lists)
+            non_empty = np.nonzero(counts)[0]
+            starts = np.searchsorted(assignments[order], non_empty)
+            # Centroids of empty lists are kept as they are
+            centroids[non_empty] = np.add.reduceat(training_points[order], starts, axis=0) / \
+                counts[non_empty][:, np.newaxis]
+        return centroids
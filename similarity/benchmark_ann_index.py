@@ -0,0 +1,88 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+# Benchmark of recall and latency of the approximate nearest neighbour index (see ann_index.py) for different number
+# of probes with a synthetic set of PCA vectors. Results are compared with an exact search with the euclidean distance
+# of the pca preset, which returns the same neighbours as the search of Gaia's pca view (also a linear scan).
+
+from ann_index import IVFIndex
+import numpy as np
+import optparse
+import time
+
+parser = optparse.OptionParser("usage: %prog [options]")
+parser.add_option("-n", "--num_points", action="store", dest="num_points", type="int",
+                  help="number of points of the synthetic set (default %default)")
+parser.add_option("-d", "--dimension", action="store", dest="dimension", type="int",
+                  help="dimension of the vectors (default %default)")
+parser.add_option("-q", "--num_queries", action="store", dest="num_queries", type="int",
+                  help="number of queries (default %default)")
+parser.add_option("-k", "--num_results", action="store", dest="num_results", type="int",
+                  help="number of results of every query (default %default)")
+parser.add_option("-p", "--probes", action="store", dest="probes",
+                  help="comma separated numbers of probes to benchmark (default %default)")
+parser.set_defaults(num_points=1000000, dimension=100, num_queries=200, num_results=15, probes="1,2,4,8,16,32")
+(options, args) = parser.parse_args()
+
+
+def synthetic_vectors(num_points, dimension, num_clusters=1000):
+    """ gaussian clusters with variance decreasing with the dimension (as in PCA components) """
+    random_state = np.random.RandomState(0)
+    scales = (1.0 / np.sqrt(np.arange(1, dimension + 1))).astype(np.float32)
+    centers = random_state.randn(num_clusters, dimension).astype(np.float32) * scales * 1.5
+    vectors = np.empty((num_points, dimension), dtype=np.float32)
+    for start in range(0, num_points, 100000):
+        n = min(100000, num_points - start)
+        vectors[start:start + n] = centers[random_state.randint(0, num_clusters, n)] + \
+            random_state.randn(n, dimension).astype(np.float32) * scales
+    return vectors
+
+
+def exact_search(vectors, query, num_results):
+    distances = np.sqrt(np.square(vectors - query).sum(axis=1))
+    nearest = np.argpartition(distances, num_results - 1)[:num_results]
+    return nearest[np.argsort(distances[nearest])]
+
+
+print "Generating %i synthetic vectors of dimension %i..." % (options.num_points, options.dimension)
+vectors = synthetic_vectors(options.num_points, options.dimension)
+names = [str(i) for i in range(options.num_points)]
+queries = np.random.RandomState(1).choice(options.num_points, options.num_queries, replace=False)
+
+start = time.time()
+index = IVFIndex()
+index.build(names, vectors)
+print "Index built in %.2f seconds (%i lists)" % (time.time() - start, len(index.lists))
+
+start = time.time()
+exact_results = [set(names[i] for i in exact_search(vectors, vectors[query], options.num_results))
+                 for query in queries]
+exact_latency = (time.time() - start) / options.num_queries
+print "Exact search: %.2f ms per query" % (exact_latency * 1000)
+
+for n_probes in [int(n) for n in options.probes.split(',')]:
+    index.n_probes = n_probes
+    start = time.time()
+    results = [index.search(names[query], options.num_results) for query in queries]
+    latency = (time.time() - start) / options.num_queries
+    recall = np.mean([len(exact_results[i].intersection(name for name, distance in result)) /
+                      float(options.num_results) for i, result in enumerate(results)])
+    print "%i probes: recall@%i %.3f, %.2f ms per query (%.0fx faster)" % \
+          (n_probes, options.num_results, recall, latency * 1000, exact_latency / max(latency, 1e-9))
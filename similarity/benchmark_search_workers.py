@@ -0,0 +1,76 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+# Benchmark of the throughput of similarity searches of the index in similarity_settings when run one after the other,
+# in threads and in worker processes (as with SEARCH_WORKER_PROCESSES). If searches in threads are not faster than one
+# after the other, Gaia does not release the GIL while it searches and SEARCH_WORKER_PROCESSES should stay enabled.
+
+from gaia_wrapper import GaiaWrapper
+from similarity_server_utils import GaiaWorkerProcesses
+import optparse
+import random
+import threading
+import time
+
+parser = optparse.OptionParser("usage: %prog [options]")
+parser.add_option("-w", "--workers", action="store", dest="workers", type="int",
+                  help="number of threads and processes (default %default)")
+parser.add_option("-q", "--num_queries", action="store", dest="num_queries", type="int",
+                  help="number of queries (default %default)")
+parser.add_option("-p", "--preset", action="store", dest="preset",
+                  help="preset of the searches (default %default)")
+parser.set_defaults(workers=4, num_queries=200, preset="pca")
+(options, args) = parser.parse_args()
+
+gaia = GaiaWrapper()
+point_names = gaia.original_dataset.pointNames()
+random_state = random.Random(0)
+queries = [random_state.choice(point_names) for i in range(options.num_queries)]
+# Processes are forked before any thread is started
+processes = GaiaWorkerProcesses(gaia, options.workers)
+
+
+def run_in_threads(search):
+    def run(thread_queries):
+        for query in thread_queries:
+            search(query)
+    threads = [threading.Thread(target=run, args=(queries[i::options.workers],)) for i in range(options.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def benchmark(name, run):
+    start = time.time()
+    run()
+    elapsed = time.time() - start
+    print "%s: %.2f searches/sec" % (name, options.num_queries / elapsed)
+    return elapsed
+
+
+serial = benchmark("One after the other", lambda: [gaia.search_dataset(query, 15, options.preset) for query in queries])
+threaded = benchmark("%i threads" % options.workers,
+                     lambda: run_in_threads(lambda query: gaia.search_dataset(query, 15, options.preset)))
+benchmark("%i processes" % options.workers,
+          lambda: run_in_threads(lambda query: processes.run('search_dataset', (query, 15, options.preset))))
+print "Speedup of threads: %.2fx (Gaia %s the GIL while searching)" % \
+      (serial / threaded, "releases" if serial / threaded > 1.5 else "does not release")
+processes.stop()
@@ -19,23 +19,56 @@
 #
 
 from similarity.similarity_settings import SIMILARITY_ADDRESS, SIMILARITY_PORT, SIMILARITY_INDEXING_SERVER_PORT
+import similarity.similarity_settings as sim_settings
+from collections import defaultdict
+import httplib
 import json
-import urllib2
+import socket
+import threading
+import time
+import urllib
 
-_BASE_URL                     = 'http://%s:%i/similarity/' % (SIMILARITY_ADDRESS, SIMILARITY_PORT)
-_BASE_INDEXING_SERVER_URL     = 'http://%s:%i/similarity/' % (SIMILARITY_ADDRESS, SIMILARITY_INDEXING_SERVER_PORT)
+_BASE_URL                     = '/similarity/'
 _URL_ADD_POINT                = 'add_point/'
+_URL_ADD_POINTS               = 'add_points/'
 _URL_DELETE_POINT             = 'delete_point/'
 _URL_GET_DESCRIPTOR_NAMES     = 'get_descriptor_names/'
 _URL_GET_ALL_SOUND_IDS        = 'get_all_point_names/'
 _URL_CONTAINS_POINT           = 'contains/'
 _URL_NNSEARCH                 = 'nnsearch/'
+_URL_NNSEARCH_BATCH           = 'nnsearch_batch/'
 _URL_API_SEARCH               = 'api_search/'
 _URL_SOUNDS_DESCRIPTORS       = 'get_sounds_descriptors/'
 _URL_SAVE                     = 'save/'
 _URL_RELOAD_GAIA_WRAPPER      = 'reload_gaia_wrapper/'
 _URL_CLEAR_MEMORY             = 'clear_memory/'
 
+# Timeouts (in seconds) for the requests to each endpoint, None means no timeout. The defaults can be overridden
+# with a SIMILARITY_CLIENT_TIMEOUTS dictionary in similarity settings
+_DEFAULT_TIMEOUT = 30
+_TIMEOUTS = {
+    _URL_NNSEARCH: 10,
+    _URL_NNSEARCH_BATCH: 60,
+    _URL_CONTAINS_POINT: 10,
+    _URL_GET_ALL_SOUND_IDS: 120,
+    _URL_SAVE: 120,
+    _URL_ADD_POINTS: 300,
+}
+_TIMEOUTS.update(getattr(sim_settings, 'SIMILARITY_CLIENT_TIMEOUTS', {}))
+
+# Max number of sounds whose neighbours are requested in a single nnsearch_batch request
+_MAX_SOUNDS_PER_NNSEARCH_BATCH = 1000
+
+# Max number of idle keep-alive connections kept for every server
+_MAX_IDLE_CONNECTIONS = getattr(sim_settings, 'SIMILARITY_CLIENT_MAX_IDLE_CONNECTIONS', 8)
+
+# If True, identical read-only requests made concurrently (e.g. from different threads) share a single request to the
+# similarity server
+_COALESCE_REQUESTS = getattr(sim_settings, 'SIMILARITY_CLIENT_COALESCE_REQUESTS', True)
+
+# Upper bounds (in milliseconds) of the buckets of the latency histograms
+_LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf')]
+
 
 class SimilarityException(Exception):
     status_code = None
@@ -45,15 +78,186 @@ class SimilarityException(Exception):
         self.status_code = kwargs['status_code']
 
 
-def _get_url_as_json(url, data=None, timeout=None):
-    kwargs = dict()
-    if data is not None:
-        kwargs['data'] = data
-    if timeout is not None:
-        kwargs['timeout'] = timeout
-    f = urllib2.urlopen(url.replace(" ", "%20"), **kwargs)
-    resp = f.read()
-    return json.loads(resp)
+class _ConnectionPool(object):
+    """Keeps idle keep-alive HTTP connections to a server so that they can be reused by later requests."""
+
+    def __init__(self, host, port, max_idle_connections):
+        self.host = host
+        self.port = port
+        self.max_idle_connections = max_idle_connections
+        self.idle_connections = []
+        self.lock = threading.Lock()
+
+    def get(self, new=False):
+        """Returns a connection and whether it is a reused idle connection. If new is True the connection is not
+        reused."""
+        if not new:
+            with self.lock:
+                if self.idle_connections:
+                    return self.idle_connections.pop(), True
+        return httplib.HTTPConnection(self.host, self.port), False
+
+    def put(self, connection):
+        with self.lock:
+            if len(self.idle_connections) < self.max_idle_connections:
+                self.idle_connections.append(connection)
+                return
+        connection.close()
+
+
+_pools = {
+    'search': _ConnectionPool(SIMILARITY_ADDRESS, SIMILARITY_PORT, _MAX_IDLE_CONNECTIONS),
+    'indexing': _ConnectionPool(SIMILARITY_ADDRESS, SIMILARITY_INDEXING_SERVER_PORT, _MAX_IDLE_CONNECTIONS),
+}
+
+
+class _LatencyStats(object):
+    """Number of requests, errors and histogram of latencies of the requests to each endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = defaultdict(lambda: {
+                'count': 0,
+                'errors': 0,
+                'total_ms': 0.0,
+                'histogram': [0] * len(_LATENCY_BUCKETS_MS),
+            })
+
+    def add(self, endpoint, latency_ms, error=False):
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats['count'] += 1
+            stats['total_ms'] += latency_ms
+            if error:
+                stats['errors'] += 1
+            for i, bucket in enumerate(_LATENCY_BUCKETS_MS):
+                if latency_ms <= bucket:
+                    stats['histogram'][i] += 1
+                    break
+
+    def get(self):
+        with self.lock:
+            return dict((endpoint, {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'mean_ms': stats['total_ms'] / stats['count'] if stats['count'] else 0.0,
+                'histogram': zip(_LATENCY_BUCKETS_MS, stats['histogram']),
+            }) for endpoint, stats in self.endpoints.items())
+
+
+_latency_stats = _LatencyStats()
+
+
+class _CoalescedRequest(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+_in_flight_requests = dict()
+_in_flight_requests_lock = threading.Lock()
+
+
+def _encode_params(params):
+    # Parameters with None values are not sent, unicode values are sent utf-8 encoded
+    encoded_params = []
+    for key, value in params:
+        if value is None:
+            continue
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        encoded_params.append((key, str(value)))
+    return urllib.urlencode(encoded_params)
+
+
+def _send_request(pool, path, data, timeout, idempotent):
+    # A reused connection might have been closed by the server, in that case idempotent requests are retried once with
+    # a new connection. Other requests (which change the index or run expensive operations) might have been processed
+    # by the server when the connection fails so they are never retried, they don't reuse idle connections either so
+    # that they don't fail because of one closed by the server.
+    retry = False
+    while True:
+        connection, reused = pool.get(new=retry or not idempotent)
+        try:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            if data is None:
+                connection.request('GET', path)
+            else:
+                connection.request('POST', path, data, {'Content-Type': 'application/x-www-form-urlencoded'})
+            response = connection.getresponse()
+            body = response.read()
+        except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error) as e:
+            connection.close()
+            if reused and not isinstance(e, socket.timeout):
+                retry = True
+                continue
+            raise
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            pool.put(connection)
+        if response.status != 200:
+            raise SimilarityException('Similarity server returned HTTP status %i' % response.status,
+                                      status_code=500)
+        return body
+
+
+def _get_url_as_json(endpoint, params=(), data=None, timeout=-1, server='search', coalesce=False, idempotent=False):
+    # Only read endpoints should set idempotent (requests can then be retried on a new connection, see _send_request)
+    if timeout == -1:
+        timeout = _TIMEOUTS.get(endpoint, _DEFAULT_TIMEOUT)
+    path = _BASE_URL + endpoint
+    query = _encode_params(params)
+    if query:
+        path += '?' + query
+
+    coalesced_request = None
+    if coalesce and _COALESCE_REQUESTS and data is None:
+        key = (server, path)
+        with _in_flight_requests_lock:
+            coalesced_request = _in_flight_requests.get(key)
+            owner = coalesced_request is None
+            if owner:
+                coalesced_request = _in_flight_requests[key] = _CoalescedRequest()
+        if not owner:
+            # Wait for the identical request in progress (every caller gets its own copy of the result)
+            coalesced_request.done.wait(timeout)
+            if not coalesced_request.done.is_set():
+                raise socket.timeout('timed out')
+            if coalesced_request.exception is not None:
+                raise coalesced_request.exception
+            return json.loads(coalesced_request.result)
+
+    start = time.time()
+    try:
+        body = _send_request(_pools[server], path, data, timeout, idempotent)
+    except Exception as e:
+        _latency_stats.add(endpoint, (time.time() - start) * 1000, error=True)
+        if coalesced_request is not None:
+            coalesced_request.exception = e
+        raise
+    else:
+        _latency_stats.add(endpoint, (time.time() - start) * 1000)
+        if coalesced_request is not None:
+            coalesced_request.result = body
+        return json.loads(body)
+    finally:
+        if coalesced_request is not None:
+            with _in_flight_requests_lock:
+                del _in_flight_requests[key]
+            coalesced_request.done.set()
 
 
 def _result_or_exception(result):
@@ -66,106 +270,117 @@ def _result_or_exception(result):
             raise SimilarityException(result['result'], status_code=500)
 
 
+def get_latency_stats():
+    """Returns the number of requests, errors, mean latency and latency histogram (list of (bucket upper bound in
+    ms, number of requests) tuples) of the requests made to every similarity server endpoint by this process."""
+    return _latency_stats.get()
+
+
 class Similarity():
 
     @classmethod
     def search(cls, sound_id, num_results = None, preset = None, offset = None):
-        url = _BASE_URL + _URL_NNSEARCH + '?' + 'sound_id=' + str(sound_id)
-        if num_results:
-            url += '&num_results=' + str(num_results)
-        if preset:
-            url += '&preset=' + preset
-        if offset:
-            url += '&offset=' + str(offset)
-        return _result_or_exception(_get_url_as_json(url))
+        params = [('sound_id', sound_id), ('num_results', num_results or None), ('preset', preset or None),
+                  ('offset', offset or None)]
+        return _result_or_exception(_get_url_as_json(_URL_NNSEARCH, params, coalesce=True, idempotent=True))
+
+    @classmethod
+    def search_batch(cls, sound_ids, num_results = None, preset = None, in_ids = None):
+        """Returns the similarity search results ({'results': ..., 'count': ...}, same as in search) of every sound
+        keyed by sound id as a string (sounds not in the index are not included), optionally restricting the results
+        to in_ids.
+        Sounds are sent to the server in groups of _MAX_SOUNDS_PER_NNSEARCH_BATCH (one request per group)."""
+        results = dict()
+        for i in range(0, len(sound_ids), _MAX_SOUNDS_PER_NNSEARCH_BATCH):
+            params = [
+                ('sound_ids', ','.join([str(sound_id) for sound_id in sound_ids[i:i + _MAX_SOUNDS_PER_NNSEARCH_BATCH]])),
+                ('num_results', num_results or None),
+                ('preset', preset or None),
+                ('in_ids', ','.join([str(sound_id) for sound_id in in_ids]) if in_ids else None),
+            ]
+            result = _result_or_exception(_get_url_as_json(_URL_NNSEARCH_BATCH, data=_encode_params(params),
+                                                          idempotent=True))
+            results.update(result['results'])
+        return results
 
     @classmethod
     def api_search(cls, target_type=None, target=None, filter=None, preset=None, metric_descriptor_names=None, num_results=None, offset=None, file=None, in_ids=None):
-        url = _BASE_URL + _URL_API_SEARCH + '?'
-        if target_type:
-            url += '&target_type=' + str(target_type)
-        if target:
-            url += '&target=' + str(target)
-        if filter:
-            url += '&filter=' + str(filter)
-        if preset:
-            url += '&preset=' + str(preset)
-        if metric_descriptor_names:
-            url += '&metric_descriptor_names=' + str(metric_descriptor_names)
-        if num_results:
-            url += '&num_results=' + str(num_results)
-        if offset:
-            url += '&offset=' + str(offset)
-        if in_ids:
-            url += '&in_ids=' + str(in_ids)
-
-        j = _get_url_as_json(url, data=file)
+        params = [
+            ('target_type', target_type or None),
+            ('target', target or None),
+            ('filter', filter or None),
+            ('preset', preset or None),
+            ('metric_descriptor_names', metric_descriptor_names or None),
+            ('num_results', num_results or None),
+            ('offset', offset or None),
+            ('in_ids', in_ids or None),
+        ]
+
+        j = _get_url_as_json(_URL_API_SEARCH, params, data=file, coalesce=True, idempotent=True)
         r = _result_or_exception(j)
 
         return r
 
     @classmethod
     def add(cls, sound_id, yaml_path):
-        url = _BASE_URL + _URL_ADD_POINT + '?' + 'sound_id=' + str(sound_id) + '&location=' + str(yaml_path)
-        return _result_or_exception(_get_url_as_json(url))
+        params = [('sound_id', sound_id), ('location', yaml_path)]
+        return _result_or_exception(_get_url_as_json(_URL_ADD_POINT, params))
 
     @classmethod
     def add_to_indeixing_server(cls, sound_id, yaml_path):
-        url = _BASE_INDEXING_SERVER_URL + _URL_ADD_POINT + '?' + 'sound_id=' + str(sound_id) + '&location=' + str(yaml_path)
-        return _result_or_exception(_get_url_as_json(url))
+        params = [('sound_id', sound_id), ('location', yaml_path)]
+        return _result_or_exception(_get_url_as_json(_URL_ADD_POINT, params, server='indexing'))
+
+    @classmethod
+    def add_points(cls, sound_ids, yaml_paths, indexing_server=False):
+        """Adds several sounds to the index in a single request, returns a dictionary with the ids of the sounds
+        that were added ('added') and the error messages of the sounds that could not be added ('failed')."""
+        params = [('sound_id', sound_id) for sound_id in sound_ids] + [('location', yaml_path)
+                                                                      for yaml_path in yaml_paths]
+        return _result_or_exception(_get_url_as_json(_URL_ADD_POINTS, data=_encode_params(params),
+                                                     server='indexing' if indexing_server else 'search'))
 
     @classmethod
     def get_all_sound_ids(cls):
-        url = _BASE_URL + _URL_GET_ALL_SOUND_IDS
-        return _result_or_exception(_get_url_as_json(url))
+        return _result_or_exception(_get_url_as_json(_URL_GET_ALL_SOUND_IDS, idempotent=True))
 
     @classmethod
     def get_descriptor_names(cls):
-        url = _BASE_URL + _URL_GET_DESCRIPTOR_NAMES
-        return _result_or_exception(_get_url_as_json(url))
+        return _result_or_exception(_get_url_as_json(_URL_GET_DESCRIPTOR_NAMES, coalesce=True, idempotent=True))
 
     @classmethod
     def delete(cls, sound_id):
-        url = _BASE_URL + _URL_DELETE_POINT + '?' + 'sound_id=' + str(sound_id)
-        return _result_or_exception(_get_url_as_json(url))
+        return _result_or_exception(_get_url_as_json(_URL_DELETE_POINT, [('sound_id', sound_id)]))
 
     @classmethod
     def contains(cls, sound_id):
-        url = _BASE_URL + _URL_CONTAINS_POINT + '?' + 'sound_id=' + str(sound_id)
-        return _result_or_exception(_get_url_as_json(url))
+        return _result_or_exception(_get_url_as_json(_URL_CONTAINS_POINT, [('sound_id', sound_id)], idempotent=True))
 
     @classmethod
     def save(cls, filename = None):
-        url = _BASE_URL + _URL_SAVE
-        if filename:
-            url += '?' + 'filename=' + str(filename)
-        return _result_or_exception(_get_url_as_json(url, timeout=120))
+        return _result_or_exception(_get_url_as_json(_URL_SAVE, [('filename', filename or None)]))
 
     @classmethod
     def save_indexing_server(cls, filename = None):
-        url = _BASE_INDEXING_SERVER_URL + _URL_SAVE
-        if filename:
-            url += '?' + 'filename=' + str(filename)
-        return _result_or_exception(_get_url_as_json(url))
+        return _result_or_exception(_get_url_as_json(_URL_SAVE, [('filename', filename or None)], timeout=None,
+                                                     server='indexing'))
 
     @classmethod
     def clear_indexing_server_memory(cls):
-        url = _BASE_INDEXING_SERVER_URL + _URL_CLEAR_MEMORY
-        return _result_or_exception(_get_url_as_json(url))
+        return _result_or_exception(_get_url_as_json(_URL_CLEAR_MEMORY, timeout=None, server='indexing'))
 
     @classmethod
     def reload_indexing_server_gaia_wrapper(cls):
-        url = _BASE_INDEXING_SERVER_URL + _URL_RELOAD_GAIA_WRAPPER
-        return _result_or_exception(_get_url_as_json(url))
+        return _result_or_exception(_get_url_as_json(_URL_RELOAD_GAIA_WRAPPER, timeout=None, server='indexing'))
 
     @classmethod
     def get_sounds_descriptors(cls, sound_ids, descriptor_names=None, normalization=True, only_leaf_descriptors=False):
-        url = _BASE_URL + _URL_SOUNDS_DESCRIPTORS + '?' + 'sound_ids=' + ','.join([str(sound_id) for sound_id in sound_ids])
+        params = [('sound_ids', ','.join([str(sound_id) for sound_id in sound_ids]))]
         if descriptor_names:
-            url += '&descriptor_names=' + ','.join(descriptor_names)
+            params.append(('descriptor_names', ','.join(descriptor_names)))
         if normalization:
-            url += '&normalization=1'
+            params.append(('normalization', 1))
         if only_leaf_descriptors:
-            url += '&only_leaf_descriptors=1'
+            params.append(('only_leaf_descriptors', 1))
 
-        return _result_or_exception(_get_url_as_json(url))
+        return _result_or_exception(_get_url_as_json(_URL_SOUNDS_DESCRIPTORS, params, coalesce=True, idempotent=True))
@@ -0,0 +1,138 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+class DescriptorStore:
+    '''
+    Columnar store of the values of the real-valued fixed-length descriptors of the points of a dataset, used to get
+    the descriptors of many points with numpy indexing instead of reading Gaia points one by one.
+    It is saved in a directory next to the dataset with:
+        point_names.npy         (name of the point of every row)
+        <descriptor name>.npy   (one per descriptor, values of every point in rows, memory-mapped when loaded)
+        descriptors.json        (descriptor files and fingerprint of the dataset the store corresponds to)
+    Points added or deleted after the store was saved are invalidated and are not served by the store until it is
+    saved again with the dataset (only the values of these points are read from the dataset then).
+    '''
+
+    manifest_name = 'descriptors.json'
+
+    def __init__(self):
+        self.rows = dict()
+        self.descriptors = dict()  # Descriptor name -> array of values (one row per point)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, point_name):
+        return point_name in self.rows
+
+    def invalidate(self, point_name):
+        self.rows.pop(point_name, None)
+
+    def get_values(self, point_names, descriptor_name):
+        return self.descriptors[descriptor_name][[self.rows[name] for name in point_names]]
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """
+        Returns the store saved in path if it corresponds to the dataset with the given fingerprint, otherwise None.
+        """
+        manifest_path = os.path.join(path, cls.manifest_name)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['fingerprint'] != fingerprint:
+            return None
+
+        store = cls()
+        point_names = np.load(os.path.join(path, 'point_names.npy'))
+        store.rows = dict((str(name), row) for row, name in enumerate(point_names))
+        for descriptor_name, filename in manifest['descriptors'].items():
+            store.descriptors[str(descriptor_name)] = np.load(os.path.join(path, filename), mmap_mode='r')
+        return store
+
+    @classmethod
+    def save(cls, path, dataset, descriptor_names, fingerprint, previous_store=None):
+        """
+        Saves the store of the real-valued descriptors (from descriptor_names) of all the points of dataset to path
+        and returns it loaded. Values of points in previous_store are copied from it instead of read from dataset.
+        """
+        point_names = [str(name) for name in dataset.pointNames()]
+
+        # Descriptor dimensions are taken from the first point, descriptors with labels are not stored
+        descriptor_shapes = dict()
+        if point_names:
+            point = dataset.point(point_names[0])
+            for descriptor_name in descriptor_names:
+                try:
+                    value = point.value(str(descriptor_name))
+                except Exception:
+                    continue
+                descriptor_shapes[descriptor_name] = (len(point_names), len(value)) if hasattr(value, '__len__') \
+                    else (len(point_names),)
+
+        if previous_store is None or set(previous_store.descriptors.keys()) != set(descriptor_shapes.keys()):
+            previous_store = cls()
+        previous_rows = np.array([previous_store.rows.get(name, -1) for name in point_names], dtype=np.int64)
+        copied_rows = np.nonzero(previous_rows >= 0)[0]
+        new_rows = np.nonzero(previous_rows < 0)[0]
+
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        files = dict((descriptor_name, descriptor_name.lstrip('.') + '.npy') for descriptor_name in descriptor_shapes)
+        values = dict()
+        for descriptor_name, shape in descriptor_shapes.items():
+            values[descriptor_name] = np.lib.format.open_memmap(os.path.join(tmp_path, files[descriptor_name]),
+                                                                mode='w+', dtype=np.float32, shape=shape)
+            if len(copied_rows):
+                values[descriptor_name][copied_rows] = \
+                    previous_store.descriptors[descriptor_name][previous_rows[copied_rows]]
+        for row in new_rows:
+            point = dataset.point(point_names[row])
+            for descriptor_name in descriptor_shapes:
+                values[descriptor_name][row] = point.value(str(descriptor_name))
+        for descriptor_values in values.values():
+            descriptor_values.flush()
+        del values
+        np.save(os.path.join(tmp_path, 'point_names.npy'), np.array(point_names, dtype=str))
+        # Manifest is written last so that an incomplete store is never loaded
+        with open(os.path.join(tmp_path, cls.manifest_name), 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'descriptors': files}, f)
+
+        # Replace previous store (files of the previous store remain available to readers that still use it)
+        old_path = path + '.old'
+        if os.path.exists(path):
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+        return cls.load(path, fingerprint)
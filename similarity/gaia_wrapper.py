@@ -18,13 +18,20 @@
 #     See AUTHORS file.
 #
 
+import hashlib
+import json
 import logging
 import os
 import time
+from collections import OrderedDict
 
+import gaia2
+import numpy as np
 import yaml
 from gaia2 import DataSet, transform, DistanceFunctionFactory, View, Point, VariableLength
 
+from ann_index import IVFIndex
+from descriptor_store import DescriptorStore
 from similarity_server_utils import generate_structured_dict_from_layout, get_nested_dictionary_value, \
     get_nested_descriptor_names, set_nested_dictionary_value, parse_filter_list
 import similarity_settings as sim_settings
@@ -32,10 +39,21 @@ import similarity_settings as sim_settings
 logger = logging.getLogger('similarity')
 
 
+def parse_gaia_filter(filter):
+    """
+    Gaia parses filter strings in every nnSearch. Returns the parsed filter so that it can be used in many searches
+    without being parsed again (or the string itself if it is empty or the Gaia bindings do not expose filters).
+    """
+    if not filter or not hasattr(gaia2, 'Filter'):
+        return filter
+    return gaia2.Filter.parse(filter)
+
+
 class GaiaWrapper:
 
     def __init__(self, indexing_only_mode=False):
         self.indexing_only_mode = indexing_only_mode
+        self.worker_process = False  # Copies in search worker processes (see GaiaWorkerProcesses) don't save the index
         self.index_path = sim_settings.INDEX_DIR
         self.original_dataset = DataSet()
         self.pca_dataset = DataSet()
@@ -47,6 +65,8 @@ class GaiaWrapper:
         self.metrics = {}
         self.view = None
         self.view_pca = None
+        self.ann_indexes = {}
+        self.descriptor_store = None
         self.transformations_history = None
 
         self.__load_dataset()
@@ -54,6 +74,26 @@ class GaiaWrapper:
     def __get_dataset_path(self, ds_name):
         return os.path.join(sim_settings.INDEX_DIR, ds_name + '.db')
 
+    @staticmethod
+    def __get_pca_dataset_paths(dataset_path):
+        # PCA dataset and fingerprint of the original dataset it was computed from are stored next to the dataset
+        path = os.path.splitext(dataset_path)[0]
+        return path + '_pca.db', path + '_pca.fingerprint'
+
+    @staticmethod
+    def __get_descriptor_store_path(dataset_path):
+        return os.path.splitext(dataset_path)[0] + '_descriptors'
+
+    @staticmethod
+    def __calculate_fingerprint(dataset_path):
+        # Fingerprint of the contents of a saved dataset and the settings used to compute its PCA
+        md5 = hashlib.md5()
+        with open(dataset_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                md5.update(chunk)
+        md5.update(json.dumps([sim_settings.PCA_DESCRIPTORS, sim_settings.PCA_DIMENSIONS]))
+        return md5.hexdigest()
+
     def __load_dataset(self):
         """
         Loads the dataset, does all the necessary steps to make it available for similarity queries and creates the PCA
@@ -66,6 +106,7 @@ class GaiaWrapper:
         if not os.path.exists(sim_settings.INDEX_DIR):
             os.makedirs(sim_settings.INDEX_DIR)
 
+        tic = time.time()
         # load original dataset
         if os.path.exists(self.original_dataset_path):
             self.original_dataset.load(self.original_dataset_path)
@@ -81,16 +122,26 @@ class GaiaWrapper:
                 view = View(self.original_dataset)
                 self.view = view
 
-                # Compute PCA and create pca view and metric
-                # NOTE: this step may take a long time if the dataset is big, but it only needs to be performed once
-                # when the similarity server is loaded-
-                self.pca_dataset = transform(self.original_dataset, 'pca',
-                                             {'descriptorNames': sim_settings.PCA_DESCRIPTORS,
-                                              'dimension': sim_settings.PCA_DIMENSIONS,
-                                              'resultName': 'pca'})
-                self.pca_dataset.setReferenceDataSet(self.original_dataset)
+                # Load PCA dataset saved with the original dataset if the original dataset has not changed since,
+                # otherwise compute it and save it so it can be loaded next time. Then create pca view and metric
+                fingerprint = self.__calculate_fingerprint(self.original_dataset_path)
+                pca_source = 'loaded'
+                if not self.__load_pca_dataset(self.original_dataset_path, fingerprint):
+                    pca_source = 'computed'
+                    self.__compute_pca_dataset()
+                    self.__save_pca_dataset(self.original_dataset_path, fingerprint)
                 self.view_pca = View(self.pca_dataset)
                 self.__build_pca_metric()
+                self.__build_ann_indexes()
+                logger.info('PCA dataset %s, size: %i points' % (pca_source, self.pca_dataset.size()))
+
+                if getattr(sim_settings, 'DESCRIPTOR_STORE', False):
+                    self.descriptor_store = DescriptorStore.load(
+                        self.__get_descriptor_store_path(self.original_dataset_path), fingerprint)
+                    if self.descriptor_store is not None:
+                        logger.info('Descriptor store loaded, size: %i points' % len(self.descriptor_store))
+                    else:
+                        logger.info('Descriptor store not available until the index is saved.')
 
             if self.original_dataset.history().size() <= 0:
                 logger.info('Dataset loaded, size: %s points' % (self.original_dataset.size()))
@@ -99,6 +150,7 @@ class GaiaWrapper:
                             (self.original_dataset.size(),
                              len(self.descriptor_names['fixed-length']),
                              len(self.descriptor_names['variable-length'])))
+            logger.info('Index ready for queries (loaded in %.2f seconds)' % (time.time() - tic))
 
         else:
             # If there is no existing dataset we create an empty one.
@@ -108,6 +160,42 @@ class GaiaWrapper:
             self.__calculate_descriptor_names()
             logger.info('Created new dataset, size: %s points (should be 0)' % (self.original_dataset.size()))
 
+    def __compute_pca_dataset(self):
+        # NOTE: this step may take a long time if the dataset is big
+        logger.info('Computing PCA dataset.')
+        self.pca_dataset = transform(self.original_dataset, 'pca',
+                                     {'descriptorNames': sim_settings.PCA_DESCRIPTORS,
+                                      'dimension': sim_settings.PCA_DIMENSIONS,
+                                      'resultName': 'pca'})
+        self.pca_dataset.setReferenceDataSet(self.original_dataset)
+
+    def __load_pca_dataset(self, dataset_path, fingerprint):
+        pca_dataset_path, fingerprint_path = self.__get_pca_dataset_paths(dataset_path)
+        if not os.path.exists(pca_dataset_path) or not os.path.exists(fingerprint_path):
+            return False
+        with open(fingerprint_path) as f:
+            if f.read().strip() != fingerprint:
+                logger.info('Saved PCA dataset does not correspond to the current dataset.')
+                return False
+        try:
+            pca_dataset = DataSet()
+            pca_dataset.load(pca_dataset_path)
+            pca_dataset.setReferenceDataSet(self.original_dataset)
+        except Exception as e:
+            logger.info('WARNING: saved PCA dataset could not be loaded (%s).' % str(e))
+            return False
+        self.pca_dataset = pca_dataset
+        return True
+
+    def __save_pca_dataset(self, dataset_path, fingerprint):
+        # The fingerprint is written after the PCA dataset so that an incomplete PCA dataset is never loaded
+        pca_dataset_path, fingerprint_path = self.__get_pca_dataset_paths(dataset_path)
+        if os.path.exists(fingerprint_path):
+            os.remove(fingerprint_path)
+        self.pca_dataset.save(pca_dataset_path)
+        with open(fingerprint_path, 'w') as f:
+            f.write(fingerprint)
+
     def __prepare_original_dataset(self):
         logger.info('Preparing the original dataset.')
         self.original_dataset = self.prepare_original_dataset_helper(self.original_dataset)
@@ -187,8 +275,29 @@ class GaiaWrapper:
         search_metric = DistanceFunctionFactory.create(str(distance), self.pca_dataset.layout(), parameters)
         self.metrics['pca'] = search_metric
 
+    def __build_ann_indexes(self):
+        # Approximate nearest neighbour indexes (see ann_index.py) are built for the presets listed in ANN_PRESETS and
+        # used instead of Gaia views for the similarity search of these presets. Only the pca preset is supported as
+        # the rest of presets do not use an euclidean distance over a fixed-length vector.
+        self.ann_indexes = {}
+        for preset in getattr(sim_settings, 'ANN_PRESETS', []):
+            if preset != 'pca':
+                logger.info('WARNING: approximate nearest neighbour search is not supported for preset %s.' % preset)
+                continue
+            logger.info('Building approximate nearest neighbour index for preset pca')
+            tic = time.time()
+            names = self.pca_dataset.pointNames()
+            ann_index = IVFIndex(n_lists=getattr(sim_settings, 'ANN_NUMBER_OF_LISTS', None),
+                                 n_probes=getattr(sim_settings, 'ANN_NUMBER_OF_PROBES', 8))
+            ann_index.build(names, [self.pca_dataset.point(name).value('pca') for name in names])
+            self.ann_indexes['pca'] = ann_index
+            logger.info('Finished building approximate nearest neighbour index (done in %.2f seconds, %i points in '
+                        '%i lists).' % ((time.time() - tic), len(ann_index), len(ann_index.lists)))
+
     def add_point(self, point_location, point_name):
 
+        if self.descriptor_store is not None:
+            self.descriptor_store.invalidate(str(point_name))
         if self.original_dataset.contains(str(point_name)):
                 self.original_dataset.removePoint(str(point_name))
 
@@ -207,6 +316,9 @@ class GaiaWrapper:
                     # Add point to PCA dataset because it has been already created.
                     # PCA dataset will take care of adding the point to the original dataset as well.
                     self.pca_dataset.addPoint(p)
+                    if 'pca' in self.ann_indexes:
+                        self.ann_indexes['pca'].add(str(point_name),
+                                                    self.pca_dataset.point(str(point_name)).value('pca'))
                     msg = 'Added point with name %s. Index has now %i points (pca index has %i points).' % \
                           (str(point_name), self.original_dataset.size(), self.pca_dataset.size())
                     logger.info(msg)
@@ -245,19 +357,78 @@ class GaiaWrapper:
             self.view = view
 
             # Compute PCA and create pca view and metric
-            # NOTE: this step may take a long time if the dataset is big, but it only needs to be performed once
-            # when the similarity server is loaded-
-            self.pca_dataset = transform(self.original_dataset, 'pca',
-                                         {'descriptorNames': sim_settings.PCA_DESCRIPTORS,
-                                          'dimension': sim_settings.PCA_DIMENSIONS,
-                                          'resultName': 'pca'})
-            self.pca_dataset.setReferenceDataSet(self.original_dataset)
+            self.__compute_pca_dataset()
             self.view_pca = View(self.pca_dataset)
             self.__build_pca_metric()
+            self.__build_ann_indexes()
 
         return {'error': False, 'result': msg}
 
+    def add_points(self, point_locations, point_names):
+        """
+        Adds several points, returns the names of the points that were added and the error messages of the points
+        that could not be added. Once the PCA dataset has been created, points are loaded first and added to it all
+        at once (so the transformations of the dataset are applied once for all of them), until then points are
+        added one by one with add_point.
+        """
+        added = []
+        failed = dict()
+        if self.original_dataset.size() <= sim_settings.SIMILARITY_MINIMUM_POINTS or self.pca_dataset.size() == 0:
+            for point_location, point_name in zip(point_locations, point_names):
+                result = self.add_point(point_location, point_name)
+                if result['error']:
+                    failed[str(point_name)] = result['result']
+                else:
+                    added.append(str(point_name))
+            return {'error': False, 'result': {'added': added, 'failed': failed}}
+
+        points = OrderedDict()
+        for point_location, point_name in zip(point_locations, point_names):
+            point_name = str(point_name)
+            if self.descriptor_store is not None:
+                self.descriptor_store.invalidate(point_name)
+            if not os.path.exists(str(point_location)):
+                failed[point_name] = 'Point with name %s could NOT be added because analysis file does not exist ' \
+                                     '(%s).' % (point_name, str(point_location))
+                continue
+            p = Point()
+            try:
+                p.load(str(point_location))
+                p.setName(point_name)
+            except Exception as e:
+                failed[point_name] = 'Point with name %s could NOT be added (%s).' % (point_name, str(e))
+                continue
+            if self.original_dataset.contains(point_name):
+                self.original_dataset.removePoint(point_name)
+            points[point_name] = p
+
+        # PCA dataset will take care of adding the points to the original dataset as well
+        try:
+            self.pca_dataset.addPoints(points.values())
+        except Exception as e:
+            logger.info('Points could not be added at once (%s), adding them one by one.' % str(e))
+            for point_name, p in points.items():
+                if self.original_dataset.contains(point_name):
+                    continue
+                try:
+                    self.pca_dataset.addPoint(p)
+                except Exception as e:
+                    failed[point_name] = 'Point with name %s could NOT be added (%s).' % (point_name, str(e))
+        for point_name in points:
+            if point_name not in failed:
+                if 'pca' in self.ann_indexes:
+                    self.ann_indexes['pca'].add(point_name, self.pca_dataset.point(point_name).value('pca'))
+                added.append(point_name)
+
+        for msg in failed.values():
+            logger.info(msg)
+        logger.info('Added %i points (%i could not be added). Index has now %i points (pca index has %i points).' %
+                    (len(added), len(failed), self.original_dataset.size(), self.pca_dataset.size()))
+        return {'error': False, 'result': {'added': added, 'failed': failed}}
+
     def delete_point(self, point_name):
+        if self.descriptor_store is not None:
+            self.descriptor_store.invalidate(str(point_name))
         if self.original_dataset.contains(str(point_name)):
             if self.original_dataset.size() <= sim_settings.SIMILARITY_MINIMUM_POINTS:
                 # Remove from original dataset
@@ -265,6 +436,8 @@ class GaiaWrapper:
             else:
                 # Remove from pca dataset (pca dataset will take care of removing from original dataset too)
                 self.pca_dataset.removePoint(str(point_name))
+                if str(point_name) in self.ann_indexes.get('pca', []):
+                    self.ann_indexes['pca'].remove(str(point_name))
             logger.info('Deleted point with name %s. Index has now %i points (pca index has %i points).' %
                         (str(point_name), self.original_dataset.size(), self.pca_dataset.size()))
             return {'error': False, 'result': True}
@@ -288,8 +461,22 @@ class GaiaWrapper:
         path = self.original_dataset_path
         if filename:
             path = sim_settings.INDEX_DIR + filename + ".db"
+        if self.worker_process:
+            return {'error': False, 'result': path}
         logger.info('Saving index to (%s)...' % path + msg)
         self.original_dataset.save(path)
+        save_descriptor_store = getattr(sim_settings, 'DESCRIPTOR_STORE', False) and not self.indexing_only_mode and \
+            self.original_dataset.size() >= sim_settings.SIMILARITY_MINIMUM_POINTS
+        if self.pca_dataset.size() > 0 or save_descriptor_store:
+            fingerprint = self.__calculate_fingerprint(path)
+            if self.pca_dataset.size() > 0:
+                # Save PCA dataset too so that it does not need to be computed when the index is loaded
+                self.__save_pca_dataset(path, fingerprint)
+            if save_descriptor_store:
+                self.descriptor_store = DescriptorStore.save(self.__get_descriptor_store_path(path),
+                                                             self.original_dataset,
+                                                             self.descriptor_names['fixed-length'], fingerprint,
+                                                             previous_store=self.descriptor_store)
         toc = time.time()
         logger.info('Finished saving index (done in %.2f seconds, index has now %i points).' %
                     ((toc - tic), self.original_dataset.size()))
@@ -323,7 +510,17 @@ class GaiaWrapper:
         if type(required_descriptor_names) == dict:
             return required_descriptor_names  # There has been an error
 
+        # Points in the descriptor store are read from it all at once, the rest are read from the dataset
+        descriptor_store = self.descriptor_store
+        if descriptor_store is not None:
+            stored_point_names = [point_name for point_name in point_names if str(point_name) in descriptor_store]
+            if stored_point_names:
+                data.update(self.__get_stored_points_descriptors(descriptor_store, stored_point_names,
+                                                                 required_descriptor_names, normalization))
+
         for point_name in point_names:
+            if point_name in data:
+                continue
             sound_descriptors = self.__get_point_descriptors(point_name, required_descriptor_names, normalization)
             if 'error' not in sound_descriptors:
                 data[point_name] = sound_descriptors
@@ -360,7 +557,7 @@ class GaiaWrapper:
                     'result': 'Wrong descriptor names, unable to create layout.',
                     'status_code': sim_settings.BAD_REQUEST_CODE}
 
-    def __get_point_descriptors(self, point_name, required_descriptor_names, normalization=True):
+    def __get_normalization_coeffs(self, normalization=True):
         """
         Get normalization coefficients to transform the input data (get info from the last transformation which has
         been a normalization)
@@ -372,6 +569,10 @@ class GaiaWrapper:
             for i in range(0, len(trans_hist)):
                 if trans_hist[-(i+1)]['Analyzer name'] == 'normalize':
                     normalization_coeffs = trans_hist[-(i+1)]['Applier parameters']['coeffs']
+        return normalization_coeffs
+
+    def __get_point_descriptors(self, point_name, required_descriptor_names, normalization=True):
+        normalization_coeffs = self.__get_normalization_coeffs(normalization)
 
         required_layout = generate_structured_dict_from_layout(required_descriptor_names)
         try:
@@ -380,29 +581,65 @@ class GaiaWrapper:
             return {'error': True, 'result': 'Sound does not exist in gaia index.', 'status_code': sim_settings.NOT_FOUND_CODE}
 
         for descriptor_name in required_descriptor_names:
+            value = self.__get_point_descriptor_value(p, descriptor_name, normalization_coeffs)
+            if descriptor_name[0] == '.':
+                descriptor_name = descriptor_name[1:]
+            set_nested_dictionary_value(descriptor_name.split('.'), required_layout, value)
+        return required_layout
+
+    @staticmethod
+    def __get_point_descriptor_value(p, descriptor_name, normalization_coeffs):
+        try:
+            value = p.value(str(descriptor_name))
+            if normalization_coeffs:
+                if descriptor_name in normalization_coeffs:
+                    a = normalization_coeffs[descriptor_name]['a']
+                    b = normalization_coeffs[descriptor_name]['b']
+                    if len(a) == 1:
+                        value = float(value - b[0]) / a[0]
+                    else:
+                        normalized_value = []
+                        for i in range(0, len(a)):
+                            normalized_value.append(float(value[i]-b[i]) / a[i])
+                        value = normalized_value
+        except:
             try:
-                value = p.value(str(descriptor_name))
-                if normalization_coeffs:
-                    if descriptor_name in normalization_coeffs:
-                        a = normalization_coeffs[descriptor_name]['a']
-                        b = normalization_coeffs[descriptor_name]['b']
-                        if len(a) == 1:
-                            value = float(value - b[0]) / a[0]
-                        else:
-                            normalized_value = []
-                            for i in range(0, len(a)):
-                                normalized_value.append(float(value[i]-b[i]) / a[i])
-                            value = normalized_value
+                value = p.label(str(descriptor_name))
             except:
-                try:
-                    value = p.label(str(descriptor_name))
-                except:
-                    value = None
+                value = None
+        return value
+
+    def __get_stored_points_descriptors(self, descriptor_store, point_names, required_descriptor_names,
+                                        normalization=True):
+        """
+        Same as __get_point_descriptors for several points in the descriptor store, the values of every descriptor
+        of all points are read (and normalization coefficients applied) at once. Descriptors that are not in the
+        store (labels and variable-length descriptors) are read from the dataset.
+        """
+        normalization_coeffs = self.__get_normalization_coeffs(normalization)
+
+        required_layouts = [generate_structured_dict_from_layout(required_descriptor_names) for _ in point_names]
+        points = None
+        for descriptor_name in required_descriptor_names:
+            if descriptor_name in descriptor_store.descriptors:
+                values = descriptor_store.get_values(point_names, descriptor_name)
+                if normalization_coeffs and descriptor_name in normalization_coeffs:
+                    a = np.array(normalization_coeffs[descriptor_name]['a'], dtype=np.float64)
+                    b = np.array(normalization_coeffs[descriptor_name]['b'], dtype=np.float64)
+                    values = (values - b) / a
+                values = values.tolist()
+            else:
+                if points is None:
+                    points = [self.original_dataset.point(str(point_name)) for point_name in point_names]
+                values = [self.__get_point_descriptor_value(p, descriptor_name, normalization_coeffs)
+                          for p in points]
 
             if descriptor_name[0] == '.':
                 descriptor_name = descriptor_name[1:]
-            set_nested_dictionary_value(descriptor_name.split('.'), required_layout, value)
-        return required_layout
+            keys = descriptor_name.split('.')
+            for required_layout, value in zip(required_layouts, values):
+                set_nested_dictionary_value(keys, required_layout, value)
+        return dict(zip(point_names, required_layouts))
 
     # SIMILARITY SEARCH and CONTENT SEARCH
 
@@ -424,6 +661,11 @@ class GaiaWrapper:
             msg = "Sound with id %s doesn't exist in the dataset." % query_point
             logger.info(msg)
             return {'error': True, 'result': msg, 'status_code': sim_settings.NOT_FOUND_CODE}
+        if preset_name in self.ann_indexes:
+            # Search on approximate nearest neighbour index
+            results = self.ann_indexes[preset_name].search(query_point, int(number_of_results), offset=int(offset))
+            count = len(self.ann_indexes[preset_name])
+            return {'error': False, 'result': {'results': results, 'count': count}}
         if preset_name == 'pca':
             # Search on PCA view
             search = self.view_pca.nnSearch(query_point, self.metrics[preset_name])
@@ -435,6 +677,44 @@ class GaiaWrapper:
 
         return {'error': False, 'result': {'results': results, 'count': count}}
 
+    def search_dataset_batch(self, query_points, number_of_results, preset_name, in_ids=None):
+        preset_name = str(preset_name)
+        size = self.original_dataset.size()
+        if size < sim_settings.SIMILARITY_MINIMUM_POINTS:
+            msg = 'Not enough datapoints in the dataset (%s < %s).' % (size, sim_settings.SIMILARITY_MINIMUM_POINTS)
+            logger.info(msg)
+            return {'error': True, 'result': msg, 'status_code': sim_settings.SERVER_ERROR_CODE}
+
+        logger.info('NN search for %i points (preset = %s)' % (len(query_points), preset_name))
+        if in_ids:
+            # Same filter is used in all the searches of the batch
+            filter = parse_gaia_filter('WHERE point.id IN ("' + '", "'.join(in_ids) + '")')
+        else:
+            filter = ""
+        if preset_name == 'pca':
+            view = self.view_pca
+        else:
+            view = self.view
+        metric = self.metrics[preset_name]
+        # Approximate nearest neighbour indexes can't restrict the results to in_ids
+        ann_index = self.ann_indexes.get(preset_name) if not in_ids else None
+
+        results = dict()
+        not_found = []
+        for query_point in query_points:
+            query_point = str(query_point)
+            if not self.original_dataset.contains(query_point):
+                not_found.append(query_point)
+                continue
+            if ann_index is not None:
+                results[query_point] = {'results': ann_index.search(query_point, int(number_of_results)),
+                                        'count': len(ann_index)}
+            else:
+                search = view.nnSearch(query_point, metric, filter)
+                results[query_point] = {'results': search.get(int(number_of_results)), 'count': search.size()}
+
+        return {'error': False, 'result': {'results': results, 'not_found': not_found}}
+
     def api_search(self, target_type, target, filter, preset_name, metric_descriptor_names, num_results, offset,
                    in_ids):
 
@@ -41,6 +41,7 @@ import similarity_settings as sim_settings
 def server_interface(resource):
     return {
         'add_point': resource.add_point,  # location, sound_id
+        'add_points': resource.add_points,  # location, sound_id (one of each for every point, POST)
         'clear_memory': resource.clear_memory,
         'reload_gaia_wrapper': resource.reload_gaia_wrapper,
         'save': resource.save,  # filename (optional)
@@ -63,9 +64,15 @@ class SimilarityServer(resource.Resource):
     def render_GET(self, request):
         return self.methods[request.prepath[1]](request=request, **request.args)
 
+    def render_POST(self, request):
+        return self.methods[request.prepath[1]](request=request, **request.args)
+
     def add_point(self, request, location, sound_id):
         return json.dumps( self.gaia.add_point(location[0],sound_id[0]))
 
+    def add_points(self, request, location, sound_id):
+        return json.dumps(self.gaia.add_points(location, sound_id))
+
     def save(self, request, filename=None):
         if not filename:
             filename = [sim_settings.INDEXING_SERVER_INDEX_NAME]
@@ -20,7 +20,8 @@
 
 from __future__ import print_function
 from twisted.web import server, resource
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
 from gaia_wrapper import GaiaWrapper
 from similarity_settings import LISTEN_PORT, LOGFILE, DEFAULT_PRESET, DEFAULT_NUMBER_OF_RESULTS, INDEX_NAME, PRESETS, \
     BAD_REQUEST_CODE, NOT_FOUND_CODE, SERVER_ERROR_CODE, LOGSERVER_IP_ADDRESS, LOGSERVER_PORT, LOG_TO_STDOUT, \
@@ -28,8 +29,11 @@ from similarity_settings import LISTEN_PORT, LOGFILE, DEFAULT_PRESET, DEFAULT_NU
 import logging
 import graypy
 from logging.handlers import RotatingFileHandler
-from similarity_server_utils import parse_filter, parse_target, parse_metric_descriptors
+from similarity_server_utils import parse_filter, parse_target, parse_metric_descriptors, ReadWriteLock, \
+    GaiaWorkerProcesses
+import similarity_settings as sim_settings
 import json
+import time
 import yaml
 import cloghandler
 
@@ -37,17 +41,34 @@ import cloghandler
 def server_interface(resource):
     return {
         'add_point': resource.add_point,  # location, sound_id
+        'add_points': resource.add_points,  # location, sound_id (one of each for every point, POST)
         'delete_point': resource.delete_point, # sound_id
         'get_all_point_names': resource.get_all_point_names,
         'get_descriptor_names': resource.get_descriptor_names,
         'contains': resource.contains,  # sound_id
         'get_sounds_descriptors': resource.get_sounds_descriptors,  # sound_ids, descritor_names (optional), normalization (optional)
         'nnsearch': resource.nnsearch,  # sound_id, num_results (optional), preset (optional)
+        'nnsearch_batch': resource.nnsearch_batch,  # sound_ids, num_results (optional), preset (optional), in_ids (optional)
         'api_search': resource.api_search,
         'save': resource.save,  # filename (optional)
+        'search_stats': resource.search_stats,
     }
 
 
+# Searches are run in a pool of SEARCH_WORKERS threads. When SEARCH_MAX_QUEUED searches are already waiting for a
+# worker new searches are rejected, and searches that do not finish in SEARCH_DEADLINE seconds (waiting time included)
+# get an error response. Batch searches are run in groups of SEARCH_BATCH_GROUP_SIZE points and have their own
+# deadline (SEARCH_BATCH_DEADLINE). With SEARCH_WORKER_PROCESSES every search thread runs its searches in a forked
+# copy of the gaia wrapper, so that searches run in parallel even if Gaia holds the GIL while it searches.
+SEARCH_WORKERS = getattr(sim_settings, 'SEARCH_WORKERS', 4)
+SEARCH_MAX_QUEUED = getattr(sim_settings, 'SEARCH_MAX_QUEUED', 100)
+SEARCH_DEADLINE = getattr(sim_settings, 'SEARCH_DEADLINE', 30)
+SEARCH_BATCH_GROUP_SIZE = getattr(sim_settings, 'SEARCH_BATCH_GROUP_SIZE', 50)
+SEARCH_BATCH_DEADLINE = getattr(sim_settings, 'SEARCH_BATCH_DEADLINE', 55)
+SEARCH_WORKER_PROCESSES = getattr(sim_settings, 'SEARCH_WORKER_PROCESSES', True)
+SERVICE_UNAVAILABLE_CODE = 503
+
+
 class SimilarityServer(resource.Resource):
     def __init__(self):
         resource.Resource.__init__(self)
@@ -56,6 +77,33 @@ class SimilarityServer(resource.Resource):
         self.gaia = GaiaWrapper()
         self.request = None
 
+        # Gaia is used from threads so the reactor is not blocked. Searches run in their own pool so that other
+        # (cheap) requests are not delayed by them. Reads can run concurrently but operations that modify the dataset
+        # (adding and deleting points) need exclusive access.
+        self.gaia_lock = ReadWriteLock()
+        self.gaia_processes = None
+        if SEARCH_WORKER_PROCESSES:
+            # Processes are forked before any thread is started
+            self.gaia_processes = GaiaWorkerProcesses(self.gaia, SEARCH_WORKERS)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.gaia_processes.stop)
+        self.search_pool = ThreadPool(minthreads=1, maxthreads=SEARCH_WORKERS, name='gaia-search')
+        self.pool = ThreadPool(minthreads=1, maxthreads=1, name='gaia')
+        for pool in [self.search_pool, self.pool]:
+            pool.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', pool.stop)
+        self.pending_searches = 0
+        self.stats = {
+            'searches': 0,
+            'batch_searches': 0,
+            'rejected': 0,
+            'expired_in_queue': 0,
+            'deadline_exceeded': 0,
+            'total_queue_wait': 0.0,
+            'max_queue_wait': 0.0,
+            'total_compute_time': 0.0,
+            'max_compute_time': 0.0,
+        }
+
     def error(self,message):
         return json.dumps({'Error':message})
 
@@ -68,17 +116,202 @@ class SimilarityServer(resource.Resource):
     def render_POST(self, request):
         return self.methods[request.prepath[1]](request=request, **request.args)
 
+    def run_in_pool(self, request, function, args=(), exclusive=False, search=False):
+        """
+        Runs the gaia wrapper function in a pool of threads and writes its json encoded result to the request when
+        it finishes. Queue limit and deadline only apply to searches.
+        """
+        if search:
+            if self.pending_searches >= SEARCH_WORKERS + SEARCH_MAX_QUEUED:
+                self.stats['rejected'] += 1
+                return json.dumps({'error': True, 'result': 'Similarity server is busy, try again later.',
+                                   'status_code': SERVICE_UNAVAILABLE_CODE})
+            self.pending_searches += 1
+        queued_time = time.time()
+        finished = []
+
+        def run():
+            start_time = time.time()
+            if search and start_time - queued_time > SEARCH_DEADLINE:
+                # The request has already been answered with an error, don't waste time on it
+                return None, start_time - queued_time, 0.0
+            try:
+                with self.gaia_lock.write() if exclusive else self.gaia_lock.read():
+                    result = function(*args)
+            except Exception as e:
+                logger.error('Error running %s: %s' % (function.__name__, e))
+                result = {'error': True, 'result': str(e), 'status_code': SERVER_ERROR_CODE}
+            return result, start_time - queued_time, time.time() - start_time
+
+        def write_response(response):
+            if finished:
+                return
+            finished.append(True)
+            if deadline_call is not None and deadline_call.active():
+                deadline_call.cancel()
+            request.write(response)
+            request.finish()
+
+        def done(outcome):
+            result, queue_wait, compute_time = outcome
+            if search:
+                self.pending_searches -= 1
+                self.record_search_stats(queue_wait, compute_time)
+                if result is None:
+                    self.stats['expired_in_queue'] += 1
+                    return
+            write_response(json.dumps(result))
+
+        def deadline_exceeded():
+            self.stats['deadline_exceeded'] += 1
+            write_response(json.dumps({'error': True,
+                                       'result': 'Search did not finish in %g seconds.' % SEARCH_DEADLINE,
+                                       'status_code': SERVICE_UNAVAILABLE_CODE}))
+
+        deadline_call = reactor.callLater(SEARCH_DEADLINE, deadline_exceeded) if search else None
+        # If the client disconnects there is nothing to write
+        request.notifyFinish().addBoth(lambda _: finished.append(True))
+        threads.deferToThreadPool(reactor, self.search_pool if search else self.pool, run).addCallback(done)
+        return server.NOT_DONE_YET
+
+    def run_batch_in_pool(self, request, function, groups, args=()):
+        """
+        Runs the gaia wrapper batch search function for every group of query points (function(group, *args)) in the
+        search pool, one group after the other, and writes the merged results to the request when all of them have
+        finished. Every group is a separate job which takes the read lock, so a batch does not keep a search worker
+        nor block the operations that modify the dataset for longer than a group. A batch counts as a single search for
+        the queue limit and has its own deadline (SEARCH_BATCH_DEADLINE).
+        """
+        if self.pending_searches >= SEARCH_WORKERS + SEARCH_MAX_QUEUED:
+            self.stats['rejected'] += 1
+            return json.dumps({'error': True, 'result': 'Similarity server is busy, try again later.',
+                               'status_code': SERVICE_UNAVAILABLE_CODE})
+        self.pending_searches += 1
+        merged_result = {'results': dict(), 'not_found': []}
+        batch_time = {'queue_wait': 0.0, 'compute_time': 0.0}
+        finished = []
+
+        def run(group, queued_time):
+            start_time = time.time()
+            if finished:
+                # The request has already been answered, don't waste time on it
+                return None, start_time - queued_time, 0.0
+            try:
+                with self.gaia_lock.read():
+                    result = function(group, *args)
+            except Exception as e:
+                logger.error('Error running %s: %s' % (function.__name__, e))
+                result = {'error': True, 'result': str(e), 'status_code': SERVER_ERROR_CODE}
+            return result, start_time - queued_time, time.time() - start_time
+
+        def run_group(index):
+            threads.deferToThreadPool(reactor, self.search_pool, run, groups[index], time.time()) \
+                .addCallback(done, index)
+
+        def write_response(response):
+            if finished:
+                return
+            finished.append(True)
+            if deadline_call.active():
+                deadline_call.cancel()
+            request.write(response)
+            request.finish()
+
+        def done(outcome, index):
+            result, queue_wait, compute_time = outcome
+            batch_time['queue_wait'] += queue_wait
+            batch_time['compute_time'] += compute_time
+            if result is not None and not result['error']:
+                merged_result['results'].update(result['result']['results'])
+                merged_result['not_found'] += result['result']['not_found']
+                if index + 1 < len(groups) and not finished:
+                    # Next group is queued after the searches that arrived meanwhile
+                    run_group(index + 1)
+                    return
+                result = {'error': False, 'result': merged_result}
+
+            self.pending_searches -= 1
+            self.stats['batch_searches'] += 1
+            self.record_search_stats(batch_time['queue_wait'], batch_time['compute_time'])
+            if result is None:
+                self.stats['expired_in_queue'] += 1
+                return
+            write_response(json.dumps(result))
+
+        def deadline_exceeded():
+            self.stats['deadline_exceeded'] += 1
+            write_response(json.dumps({'error': True,
+                                       'result': 'Search did not finish in %g seconds.' % SEARCH_BATCH_DEADLINE,
+                                       'status_code': SERVICE_UNAVAILABLE_CODE}))
+
+        deadline_call = reactor.callLater(SEARCH_BATCH_DEADLINE, deadline_exceeded)
+        # If the client disconnects there is nothing to write
+        request.notifyFinish().addBoth(lambda _: finished.append(True))
+        run_group(0)
+        return server.NOT_DONE_YET
+
+    def search_function(self, function_name):
+        """
+        Returns the gaia wrapper search function, which runs in a worker process when SEARCH_WORKER_PROCESSES is set
+        (or in the server process if all worker processes died).
+        """
+        if self.gaia_processes is None:
+            return getattr(self.gaia, function_name)
+
+        def function(*args):
+            if not len(self.gaia_processes):
+                return getattr(self.gaia, function_name)(*args)
+            return self.gaia_processes.run(function_name, args, timeout=SEARCH_DEADLINE)
+        function.__name__ = function_name
+        return function
+
+    def modify_function(self, function_name):
+        """
+        Returns the gaia wrapper function that modifies the dataset, which is also run in the worker processes when
+        SEARCH_WORKER_PROCESSES is set (it must be run with exclusive access).
+        """
+        if self.gaia_processes is None:
+            return getattr(self.gaia, function_name)
+
+        def function(*args):
+            result = getattr(self.gaia, function_name)(*args)
+            self.gaia_processes.run_in_all(function_name, *args)
+            return result
+        function.__name__ = function_name
+        return function
+
+    def record_search_stats(self, queue_wait, compute_time):
+        self.stats['searches'] += 1
+        self.stats['total_queue_wait'] += queue_wait
+        self.stats['max_queue_wait'] = max(self.stats['max_queue_wait'], queue_wait)
+        self.stats['total_compute_time'] += compute_time
+        self.stats['max_compute_time'] = max(self.stats['max_compute_time'], compute_time)
+
+    def search_stats(self, request):
+        stats = dict(self.stats)
+        stats['pending_searches'] = self.pending_searches
+        stats['workers'] = SEARCH_WORKERS
+        if self.gaia_processes is not None:
+            stats['worker_processes_alive'] = len(self.gaia_processes)
+        if stats['searches']:
+            stats['mean_queue_wait'] = stats['total_queue_wait'] / stats['searches']
+            stats['mean_compute_time'] = stats['total_compute_time'] / stats['searches']
+        return json.dumps({'error': False, 'result': stats})
+
     def add_point(self, request, location, sound_id):
-        return json.dumps( self.gaia.add_point(location[0],sound_id[0]))
+        return self.run_in_pool(request, self.modify_function('add_point'), (location[0], sound_id[0]), exclusive=True)
+
+    def add_points(self, request, location, sound_id):
+        return self.run_in_pool(request, self.modify_function('add_points'), (location, sound_id), exclusive=True)
 
     def delete_point(self, request, sound_id):
-        return json.dumps(self.gaia.delete_point(sound_id[0]))
+        return self.run_in_pool(request, self.modify_function('delete_point'), (sound_id[0],), exclusive=True)
 
     def contains(self, request, sound_id):
-        return json.dumps(self.gaia.contains(sound_id[0]))
+        return self.run_in_pool(request, self.gaia.contains, (sound_id[0],))
 
     def get_all_point_names(self, request):
-        return json.dumps(self.gaia.get_all_point_names())
+        return self.run_in_pool(request, self.gaia.get_all_point_names)
 
     def get_descriptor_names(self, request):
         return json.dumps({'error': False, 'result': self.gaia.descriptor_names})
@@ -89,7 +322,7 @@ class SimilarityServer(resource.Resource):
             kwargs['descriptor_names'] = [name for name in descriptor_names[0].split(',') if name]
         kwargs['normalization'] = normalization[0] == '1'
         kwargs['only_leaf_descriptors'] = only_leaf_descriptors[0] == '1'
-        return json.dumps(self.gaia.get_sounds_descriptors(sound_ids[0].split(','), **kwargs))
+        return self.run_in_pool(request, lambda: self.gaia.get_sounds_descriptors(sound_ids[0].split(','), **kwargs))
 
     def nnsearch(self, request, sound_id=None, num_results=None, preset=None, offset=[0]):
 
@@ -98,7 +331,24 @@ class SimilarityServer(resource.Resource):
         if not num_results:
             num_results = [DEFAULT_NUMBER_OF_RESULTS]
 
-        return json.dumps(self.gaia.search_dataset(sound_id[0], num_results[0], preset_name=preset[0], offset=offset[0]))
+        return self.run_in_pool(request, self.search_function('search_dataset'),
+                                (sound_id[0], num_results[0], preset[0], offset[0]), search=True)
+
+    def nnsearch_batch(self, request, sound_ids, num_results=None, preset=None, in_ids=None):
+
+        preset = ['pca']  # For the moment we only admit pca preset, in the future we may allow more presets
+
+        if not num_results:
+            num_results = [DEFAULT_NUMBER_OF_RESULTS]
+
+        sound_ids = [sound_id for sound_id in sound_ids[0].split(',') if sound_id]
+        if in_ids:
+            in_ids = [sound_id for sound_id in in_ids[0].split(',') if sound_id]
+
+        groups = [sound_ids[i:i + SEARCH_BATCH_GROUP_SIZE]
+                  for i in range(0, max(len(sound_ids), 1), SEARCH_BATCH_GROUP_SIZE)]
+        return self.run_batch_in_pool(request, self.search_function('search_dataset_batch'), groups,
+                                      (num_results[0], preset[0], in_ids))
 
     def api_search(self, request, target_type=None, target=None, filter=None, preset=[DEFAULT_PRESET], metric_descriptor_names=None, num_results=[DEFAULT_NUMBER_OF_RESULTS], offset=[0], in_ids=None):
         '''
@@ -210,21 +460,16 @@ class SimilarityServer(resource.Resource):
         else:
             metric_descriptor_names = False  # For the moment metric_descriptor_names can only be set by us
 
-        return json.dumps(self.gaia.api_search(target_type,
-                                              target,
-                                              filter,
-                                              preset,
-                                              metric_descriptor_names,
-                                              num_results,
-                                              offset,
-                                              in_ids))
+        return self.run_in_pool(request, self.search_function('api_search'),
+                                (target_type, target, filter, preset, metric_descriptor_names, num_results, offset,
+                                 in_ids), search=True)
 
 
     def save(self, request, filename=None):
         if not filename:
             filename = [INDEX_NAME]
 
-        return json.dumps(self.gaia.save_index(filename[0]))
+        return self.run_in_pool(request, self.gaia.save_index, (filename[0],))
 
 
 if __name__ == '__main__':
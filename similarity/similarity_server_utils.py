@@ -18,6 +18,11 @@
 #     See AUTHORS file.
 #
 
+import Queue
+import multiprocessing
+import threading
+from contextlib import contextmanager
+
 
 def parse_filter(filter_string, layout_descriptor_names):
     ALLOWED_CONTENT_BASED_SEARCH_DESCRIPTORS = layout_descriptor_names
@@ -304,3 +309,139 @@ def get_nested_descriptor_names(structured_layout, accumulated_list=[], keys=[])
             keys.append(key)
             accumulated_list.append('.'.join(keys))
         keys.pop()
+
+
+class ReadWriteLock(object):
+    """
+    Lock that can be held by many readers at the same time or by a single writer. Writers waiting for the lock have
+    preference over new readers so that a continuous flow of searches does not block the addition of points.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writer or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class GaiaWorkerProcesses(object):
+    """
+    Copies of a gaia wrapper in forked processes where searches can run in parallel if Gaia does not release the GIL
+    while it searches. Every process runs one call at a time, a call waits until a process is free. Processes must be
+    created before any thread is started and operations that modify the dataset must be run in all of them (with
+    run_in_all) so that their datasets stay the same as the one of the gaia wrapper of the server (copies never save
+    the index). Processes that die are not replaced.
+    """
+
+    def __init__(self, gaia, n_processes):
+        self.connections = []
+        self.free_connections = Queue.Queue()
+        for i in range(n_processes):
+            connection, process_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=self.serve,
+                                              args=(gaia, process_connection, self.connections + [connection]))
+            process.daemon = True
+            process.start()
+            process_connection.close()
+            self.connections.append(connection)
+            self.free_connections.put(connection)
+
+    def __len__(self):
+        # Number of processes alive
+        return len(self.connections)
+
+    @staticmethod
+    def serve(gaia, connection, server_connections):
+        # Runs in the worker processes until the connection is closed. Connections of the server inherited when forking
+        # are closed so that processes get the end of their connection when the server closes it.
+        for server_connection in server_connections:
+            server_connection.close()
+        gaia.worker_process = True
+        while True:
+            try:
+                function_name, args = connection.recv()
+            except EOFError:
+                return
+            try:
+                connection.send((True, getattr(gaia, function_name)(*args)))
+            except Exception as e:
+                connection.send((False, str(e)))
+
+    def run(self, function_name, args=(), timeout=None):
+        """
+        Runs the gaia wrapper function in a free process and returns its result. Raises an exception if no process is
+        alive or none gets free in timeout seconds.
+        """
+        if not self.connections:
+            raise Exception('No gaia worker processes left')
+        try:
+            connection = self.free_connections.get(timeout=timeout)
+        except Queue.Empty:
+            raise Exception('No gaia worker process got free in %g seconds' % timeout)
+        try:
+            connection.send((function_name, args))
+            ok, result = connection.recv()
+        except (EOFError, IOError):
+            # The process died, it is not used anymore
+            self.connections.remove(connection)
+            raise Exception('Gaia worker process died, %i processes left' % len(self.connections))
+        self.free_connections.put(connection)
+        if not ok:
+            raise Exception(result)
+        return result
+
+    def run_in_all(self, function_name, *args):
+        """
+        Runs the gaia wrapper function in all processes (waiting until all of them are free).
+        """
+        connections = [self.free_connections.get() for connection in list(self.connections)]
+        dead_connections = []
+        for connection in connections:
+            try:
+                connection.send((function_name, args))
+            except IOError:
+                dead_connections.append(connection)
+        for connection in connections:
+            if connection not in dead_connections:
+                try:
+                    connection.recv()
+                except (EOFError, IOError):
+                    dead_connections.append(connection)
+        for connection in connections:
+            if connection in dead_connections:
+                self.connections.remove(connection)
+            else:
+                self.free_connections.put(connection)
+
+    def stop(self):
+        for connection in self.connections:
+            connection.close()
@@ -34,6 +34,18 @@ LOGFILE_INDEXING_SERVER     = '/var/log/freesound/similarity_indexing.log'
 LISTEN_PORT                 = 8008
 INDEXING_SERVER_LISTEN_PORT = 8009
 PCA_DIMENSIONS              = 100
+SEARCH_WORKERS              = 4    # Threads running searches
+SEARCH_MAX_QUEUED           = 100  # Searches waiting for a free thread before new searches are rejected
+SEARCH_DEADLINE             = 30   # Seconds after which a search request gets an error response
+SEARCH_BATCH_GROUP_SIZE     = 50   # Points of a batch search searched at once (the dataset can be modified between groups)
+SEARCH_BATCH_DEADLINE       = 55   # Seconds after which a batch search request gets an error response (keep it lower
+                                   # than the nnsearch_batch timeout of the client)
+SEARCH_WORKER_PROCESSES     = True # Run searches in SEARCH_WORKERS forked copies of the index instead of threads (set
+                                   # it to False if Gaia releases the GIL, check with benchmark_search_workers.py)
+ANN_PRESETS                 = []   # Presets searched with an approximate nearest neighbour index (only 'pca')
+ANN_NUMBER_OF_LISTS         = None # Lists of the approximate index (None for the square root of the index size)
+ANN_NUMBER_OF_PROBES        = 8    # Lists searched for every query (more probes give better recall but slower search)
+DESCRIPTOR_STORE            = True # Save a columnar copy of descriptor values with the index for get_sounds_descriptors
 PCA_DESCRIPTORS             = [
                                  "*lowlevel*mean",
                                  "*lowlevel*dmean",
@@ -47,6 +59,10 @@ PCA_DESCRIPTORS             = [
 SIMILARITY_ADDRESS               = 'localhost'
 SIMILARITY_PORT                  = 8008
 SIMILARITY_INDEXING_SERVER_PORT  = 8009
+# Optional client settings (defaults in similarity/client/__init__.py)
+# SIMILARITY_CLIENT_TIMEOUTS             = {'nnsearch/': 10, 'api_search/': 30}  # Request timeouts per endpoint
+# SIMILARITY_CLIENT_MAX_IDLE_CONNECTIONS = 8  # Keep-alive connections kept per server and process
+# SIMILARITY_CLIENT_COALESCE_REQUESTS    = True  # Share identical concurrent read requests
 
 # OTHER
 SIMILAR_SOUNDS_TO_CACHE = 100
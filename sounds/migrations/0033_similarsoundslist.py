@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sounds', '0032_auto_20180905_1301'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarSoundsList',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('preset', models.CharField(max_length=32)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('count', models.IntegerField(default=0)),
+                ('results_data', models.BinaryField()),
+                ('sound', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_sounds_lists', to='sounds.Sound')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='similarsoundslist',
+            unique_together=set([('sound', 'preset')]),
+        ),
+    ]
@@ -60,6 +60,7 @@ import gearman
 import subprocess
 import datetime
 import json
+import struct
 import zlib
 
 
@@ -444,6 +445,11 @@ class Sound(SocialModel):
                                                                                                    sound_user_id)),
                         url=settings.DISPLAYS_URL + "%s/%d_%d_wave_L.png" % (id_folder, self.id, sound_user_id)
                     )
+                ),
+                peaks=dict(
+                    path=os.path.join(settings.DISPLAYS_PATH, id_folder, "%d_%d_peaks.dat" % (self.id,
+                                                                                              sound_user_id)),
+                    url=settings.DISPLAYS_URL + "%s/%d_%d_peaks.dat" % (id_folder, self.id, sound_user_id)
                 )
             ),
             analysis=dict(
@@ -583,6 +589,9 @@ class Sound(SocialModel):
 
     def set_similarity_state(self, state):
         self.set_single_field('similarity_state', state)
+        # Precomputed similar sounds are outdated once the sound changes in the similarity index, they are computed
+        # again by the next run of similarity_precompute_neighbours
+        SimilarSoundsList.objects.filter(sound_id=self.id).delete()
 
     def set_moderation_state(self, state):
         self.set_single_field('moderation_state', state)
@@ -684,6 +693,7 @@ class Sound(SocialModel):
             self.locations()['display']['spectral']['M']['path'],  # spectrogram M
             self.locations()['display']['wave']['L']['path'],  # waveform L
             self.locations()['display']['wave']['M']['path'],  # waveform M
+            self.locations()['display']['peaks']['path'],  # multi-resolution waveform peaks
             self.locations()['preview']['HQ']['mp3']['path'],  # preview HQ mp3
             self.locations()['preview']['HQ']['ogg']['path'],  # preview HQ ogg
             self.locations()['preview']['LQ']['mp3']['path'],  # preview LQ mp3
@@ -1203,6 +1213,33 @@ class SoundAnalysis(models.Model):
         unique_together = (("sound", "extractor"),)
 
 
+class SimilarSoundsList(models.Model):
+    """Precomputed results of the similarity search of a sound for a similarity preset (computed by the
+    similarity_precompute_neighbours command). Results are stored in a compact binary form: sound ids as 32 bit
+    integers followed by distances as 32 bit floats.
+    """
+    sound = models.ForeignKey(Sound, related_name='similar_sounds_lists')
+    preset = models.CharField(max_length=32)
+    created = models.DateTimeField(auto_now_add=True)
+    count = models.IntegerField(default=0)  # Total number of results of the similarity search
+    results_data = models.BinaryField()
+
+    @staticmethod
+    def pack_results(results):
+        return struct.pack('<%ii%if' % (len(results), len(results)),
+                           *([int(sound_id) for sound_id, _ in results] + [float(distance) for _, distance in results]))
+
+    def get_results(self):
+        """Returns the list of [sound id, distance] results"""
+        data = bytes(self.results_data)
+        n = len(data) // 8
+        values = struct.unpack('<%ii%if' % (n, n), data)
+        return [[values[i], values[n + i]] for i in range(n)]
+
+    class Meta:
+        unique_together = (("sound", "preset"),)
+
+
 class BulkUploadProgress(models.Model):
     """Store progress status for a Bulk Describe process."""
 
@@ -42,12 +42,13 @@ import accounts
 from comments.models import Comment
 from general.templatetags.filter_img import replace_img
 from sounds.models import Pack, Sound, SoundOfTheDay, License, DeletedSound, Flag
-from sounds.models import Download, PackDownload, PackDownloadSound, SoundAnalysis
+from sounds.models import Download, PackDownload, PackDownloadSound, SoundAnalysis, SimilarSoundsList
 from sounds.views import get_sound_of_the_day_id
 from accounts.models import EmailPreferenceType
 from utils.encryption import encrypt
 from utils.tags import clean_and_split_tags
 from utils.cache import get_template_cache_key
+from utils.similarity_utilities import get_similar_sounds
 
 from bs4 import BeautifulSoup
 
@@ -1117,8 +1118,9 @@ class SoundTemplateCacheTests(TestCase):
         self.assertInHTML('1 download', resp.content)
 
     # Similarity link (cached in display and view)
-    @mock.patch('general.management.commands.similarity_update.Similarity.add', return_value='Dummy response')
-    def _test_similarity_update(self, cache_keys, check_present, similarity_add):
+    @mock.patch('general.management.commands.similarity_update.Similarity.add_points')
+    def _test_similarity_update(self, cache_keys, check_present, similarity_add_points):
+        similarity_add_points.return_value = {'added': [str(self.sound.id)], 'failed': {}}
         # Default analysis_state is 'PE', but for similarity update it should be 'OK', otherwise sound gets ignored
         self.sound.analysis_state = 'OK'
         self.sound.save()
@@ -1134,7 +1136,9 @@ class SoundTemplateCacheTests(TestCase):
 
         # Update similarity
         call_command('similarity_update', freesound_extractor_version=None)
-        similarity_add.assert_called_once_with(self.sound.id, self.sound.locations('analysis.statistics.path'))
+        similarity_add_points.assert_called_once_with([self.sound.id],
+                                                      [self.sound.locations('analysis.statistics.path')],
+                                                      indexing_server=False)
         self._assertCacheAbsent(cache_keys)
 
         # Check similarity icon
@@ -1401,6 +1405,37 @@ class SoundAnalysisModel(TestCase):
         self.assertEquals(sa3.get_analysis(), None)
 
 
+class SimilarSoundsListModel(TestCase):
+
+    fixtures = ['initial_data']
+
+    def setUp(self):
+        _, _, sounds = create_user_and_sounds(num_sounds=1)
+        self.sound = sounds[0]
+        self.results = [[self.sound.id, 0.0], [12, 0.5], [7, 1.25]]
+        SimilarSoundsList.objects.create(sound=self.sound, preset='pca', count=50,
+                                         results_data=SimilarSoundsList.pack_results(self.results))
+
+    def test_get_results(self):
+        similar_sounds_list = SimilarSoundsList.objects.get(sound=self.sound, preset='pca')
+        self.assertEqual(similar_sounds_list.get_results(), self.results)
+
+    @mock.patch('utils.similarity_utilities.Similarity.search')
+    def test_get_similar_sounds_precomputed(self, search):
+        # Precomputed results are used if they include all requested results
+        self.assertEqual(get_similar_sounds(self.sound, 'pca', num_results=2, offset=1), (self.results[1:], 50))
+        search.assert_not_called()
+
+        # Otherwise the similarity service is queried
+        search.return_value = {'results': [[3, 2.0]], 'count': 50}
+        self.assertEqual(get_similar_sounds(self.sound, 'pca', num_results=2, offset=2), ([[3, 2.0]], 50))
+        search.assert_called_once_with(self.sound.id, preset='pca', num_results=2, offset=2)
+
+    def test_set_similarity_state_deletes_lists(self):
+        self.sound.set_similarity_state('PE')
+        self.assertFalse(SimilarSoundsList.objects.filter(sound=self.sound).exists())
+
+
 class SoundManagerQueryMethods(TestCase):
 
     fixtures = ['initial_data']
@@ -0,0 +1,103 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+# Benchmark of the construction of the association matrix (see index_to_association_matrix) with a synthetic index
+# of tag assignments. The previous implementation (which counted occurrences with list.count and looked up resource
+# and tag positions with list.index) is run with a smaller part of the index as it is quadratic.
+
+from recommendationDataProcessor import index_to_association_matrix
+from numpy import random
+import optparse
+import time
+
+parser = optparse.OptionParser("usage: %prog [options]")
+parser.add_option("-n", "--num_sounds", action="store", dest="num_sounds", type="int",
+                  help="number of sounds of the synthetic index (default %default)")
+parser.add_option("-l", "--num_sounds_legacy", action="store", dest="num_sounds_legacy", type="int",
+                  help="number of sounds used with the previous implementation (default %default)")
+parser.add_option("-v", "--vocabulary_size", action="store", dest="vocabulary_size", type="int",
+                  help="number of different tags (default %default)")
+parser.add_option("-t", "--tag_threshold", action="store", dest="tag_threshold", type="int",
+                  help="minimum number of occurrences of a tag (default %default)")
+parser.set_defaults(num_sounds=1000000, num_sounds_legacy=5000, vocabulary_size=100000, tag_threshold=10)
+(options, args) = parser.parse_args()
+
+
+def synthetic_index(num_sounds, vocabulary_size):
+    """ sounds with 3 to 12 tags, tag popularity following a zipf distribution """
+    random.seed(0)
+    num_tags = random.randint(3, 13, num_sounds)
+    tags = random.zipf(1.3, num_tags.sum()) % vocabulary_size
+    index_items = []
+    position = 0
+    for sound_id, n in enumerate(num_tags):
+        index_items.append((str(sound_id), ['tag%i' % tag for tag in tags[position:position + n]]))
+        position += n
+    return index_items
+
+
+def legacy_index_to_association_matrix(index_items, tag_threshold):
+    ts = []
+    for sid, tags in index_items:
+        ts += tags
+    tag_occurrences = dict()
+    unique_ts = list(set(ts))
+    for t in unique_ts:
+        tag_occurrences[t] = ts.count(t)
+    tags = [t for t in unique_ts if tag_occurrences[t] >= tag_threshold]
+    res_tags = {}
+    for sid, stags in index_items:
+        assigned_tags_filt = list(set(stags).intersection(set(tags)))
+        if len(assigned_tags_filt) > 0:
+            res_tags[sid] = assigned_tags_filt
+    resources = res_tags.keys()
+    M = dict()
+    for r_id in resources:
+        for t in res_tags[r_id]:
+            M[resources.index(r_id), tags.index(t)] = 1
+    return M, resources, tags
+
+
+def associations(M, resources, tags):
+    if isinstance(M, dict):
+        return set((resources[r], tags[t]) for r, t in M)
+    M = M.tocoo()
+    return set((resources[r], tags[t]) for r, t in zip(M.row, M.col))
+
+
+print "Generating synthetic index of %i sounds..." % options.num_sounds
+index_items = synthetic_index(options.num_sounds, options.vocabulary_size)
+
+start = time.time()
+M, resources, tags, tags_ids = index_to_association_matrix(index_items, tag_threshold=options.tag_threshold)
+print "%i sounds: %.2f seconds (association matrix of %i x %i, %i associations)" % \
+      (options.num_sounds, time.time() - start, M.shape[0], M.shape[1], M.nnz)
+
+legacy_items = index_items[:options.num_sounds_legacy]
+start = time.time()
+M, resources, tags, tags_ids = index_to_association_matrix(legacy_items, tag_threshold=options.tag_threshold)
+new_time = time.time() - start
+start = time.time()
+legacy_M, legacy_resources, legacy_tags = legacy_index_to_association_matrix(legacy_items, options.tag_threshold)
+legacy_time = time.time() - start
+print "%i sounds: %.2f seconds, previous implementation %.2f seconds (%.0fx)" % \
+      (len(legacy_items), new_time, legacy_time, legacy_time / max(new_time, 1e-6))
+print "Same associations: %s" % (associations(M, resources, tags) ==
+                                 associations(legacy_M, legacy_resources, legacy_tags))
@@ -20,12 +20,21 @@
 
 from tagrecommendation.tagrecommendation_settings import TAGRECOMMENDATION_ADDRESS, TAGRECOMMENDATION_PORT
 import json
+import urllib
 import urllib2
 
 _BASE_URL                     = 'http://%s:%i/tagrecommendation/' % (TAGRECOMMENDATION_ADDRESS, TAGRECOMMENDATION_PORT)
 _URL_RECOMMEND_TAGS           = 'recommend_tags/'
+_URL_RECOMMEND_TAGS_BATCH     = 'recommend_tags_batch/'
 _URL_LAST_INDEXED_ID          = 'last_indexed_id/'
 _URL_ADD_TO_INDEX             = 'add_to_index/'
+_MAX_INPUT_TAGSS_PER_BATCH    = 100
+
+
+def _post_url_as_json(url, data):
+    f = urllib2.urlopen(url, urllib.urlencode(data))
+    resp = f.read()
+    return json.loads(resp)
 
 
 def _get_url_as_json(url):
@@ -50,6 +59,19 @@ class TagRecommendation():
             url += '&max_number_of_tags=' + str(max_number_of_tags)
         return _result_or_exception(_get_url_as_json(url))
 
+    @classmethod
+    def recommend_tags_batch(cls, input_tagss, max_number_of_tags=None):
+        # Sets of input tags are sent in groups of _MAX_INPUT_TAGSS_PER_BATCH (one request per group)
+        url = _BASE_URL + _URL_RECOMMEND_TAGS_BATCH
+        results = []
+        for i in range(0, len(input_tagss), _MAX_INPUT_TAGSS_PER_BATCH):
+            data = {'input_tagss': "-!-!-".join([",".join(input_tags)
+                                                 for input_tags in input_tagss[i:i + _MAX_INPUT_TAGSS_PER_BATCH]])}
+            if max_number_of_tags:
+                data['max_number_of_tags'] = str(max_number_of_tags)
+            results += _result_or_exception(_post_url_as_json(url, data))
+        return results
+
     @classmethod
     def get_last_indexed_id(cls):
         url = _BASE_URL + _URL_LAST_INDEXED_ID
@@ -22,8 +22,9 @@
 from tagRecommendation import TagRecommender
 from communityDetection import CommunityDetector
 from tagrecommendation_settings import RECOMMENDATION_DATA_DIR
-from utils import loadFromJson
-from numpy import load
+from utils import loadFromJson, loadSparseMatrix
+from numpy import load, memmap
+import os
 
 
 class CommunityBasedTagRecommender():
@@ -69,10 +70,19 @@ class CommunityBasedTagRecommender():
             self.recommenders[class_name] = TagRecommender()
             self.recommenders[class_name].set_heuristic(self.recommendation_heuristic)
 
+            path = RECOMMENDATION_DATA_DIR + self.dataset + '_%s_SIMILARITY_MATRIX_' % class_name + self.metric + '_SUBSET'
             data = {
-                'TAG_NAMES': load(RECOMMENDATION_DATA_DIR + self.dataset + '_%s_SIMILARITY_MATRIX_' % class_name + self.metric + '_SUBSET_TAG_NAMES.npy'),
-                'SIMILARITY_MATRIX': load(RECOMMENDATION_DATA_DIR + self.dataset + '_%s_SIMILARITY_MATRIX_' % class_name + self.metric + '_SUBSET.npy'),
+                'TAG_NAMES': load(path + '_TAG_NAMES.npy'),
             }
+            if os.path.exists(path + '_NEIGHBOR_IDS.npy'):
+                # Neighbor tables are memory mapped, only the rows of the requested tags are read
+                data['NEIGHBOR_IDS'] = load(path + '_NEIGHBOR_IDS.npy', mmap_mode='r')
+                data['NEIGHBOR_SCORES'] = load(path + '_NEIGHBOR_SCORES.npy', mmap_mode='r')
+            elif os.path.exists(path + '.npz'):
+                data['SIMILARITY_MATRIX'] = loadSparseMatrix(path + '.npz')
+            else:
+                # Dense matrices generated before similarity matrices were stored as sparse matrices
+                data['SIMILARITY_MATRIX'] = load(path + '.npy')
 
             self.recommenders[class_name].load_data(
                 data=data,
@@ -82,8 +92,38 @@ class CommunityBasedTagRecommender():
 
             print self.recommenders[class_name]
 
+    def validate(self):
+        # Check that the loaded data is consistent and can be used to recommend tags
+        if not self.recommenders:
+            raise Exception("No class recommenders were loaded")
+        for class_name, recommender in self.recommenders.items():
+            data = recommender.data
+            n_tags = len(data['TAG_NAMES'])
+            if data['NEIGHBOR_IDS'].shape[0] != n_tags or data['NEIGHBOR_SCORES'].shape != data['NEIGHBOR_IDS'].shape:
+                raise Exception("Inconsistent neighbor tables for class %s" % class_name)
+            if n_tags:
+                recommender.recommend_tags([data['TAG_NAMES'][0]])
+        self.communityDetector.detect_communities([[]])
+
+    def memory_footprint(self):
+        # Size in bytes of the loaded recommendation data (memory mapped arrays are only read from disk when used)
+        footprint = {'in_memory_bytes': 0, 'memory_mapped_bytes': 0}
+        for recommender in self.recommenders.values():
+            for key in ['TAG_NAMES', 'NEIGHBOR_IDS', 'NEIGHBOR_SCORES']:
+                if isinstance(recommender.data[key], memmap):
+                    footprint['memory_mapped_bytes'] += recommender.data[key].nbytes
+                else:
+                    footprint['in_memory_bytes'] += recommender.data[key].nbytes
+        return footprint
+
     def recommend_tags(self, input_tags, max_number_of_tags=None):
         com_name = self.communityDetector.detectCommunity(input_tags)
         rec = self.recommenders[com_name].recommend_tags(input_tags)
 
-        return rec[0:max_number_of_tags], com_name
\ No newline at end of file
+        return rec[0:max_number_of_tags], com_name
+
+    def recommend_tags_batch(self, input_tagss, max_number_of_tags=None):
+        # The communities of all sets of input tags are detected at once
+        com_names = self.communityDetector.detect_communities(input_tagss)
+        return [(self.recommenders[com_name].recommend_tags(input_tags)[0:max_number_of_tags], com_name)
+                for input_tags, com_name in zip(input_tagss, com_names)]
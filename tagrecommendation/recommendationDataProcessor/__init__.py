@@ -20,20 +20,133 @@
 
 from tagrecommendation_settings import RECOMMENDATION_TMP_DATA_DIR, RECOMMENDATION_DATA_DIR, TAGRECOMMENDATION_ADDRESS, TAGRECOMMENDATION_PORT
 import fileinput, sys, os
-from utils import saveToJson, mtx2npy, loadFromJson
-from numpy import save, load, where, in1d
-from math import sqrt
-from pysparse import spmatrix
+from utils import saveToJson, loadFromJson, saveSparseMatrix, loadSparseMatrix, similarityToNeighborTables
+from numpy import save, load, where, in1d, array, bincount, ones, zeros, arange, int32, float32, sqrt, diff, repeat, \
+    lexsort
+from scipy.sparse import coo_matrix, csr_matrix, diags
+from itertools import islice
 from communityDetection import CommunityDetector
+from tag_index import TagIndex
 from datetime import datetime
 import urllib
 
 
+def index_to_association_matrix(index_items, tag_threshold=0, verbose=False):
+    '''
+    Builds the binary resources x tags association matrix from a list of (resource id, tags) items, only with the
+    tags that appear at least tag_threshold times (resources with no such tags are not included).
+    Tag names are dictionary-encoded to integer ids while reading the items so occurrences can be counted with
+    bincount and the matrix is created at once from the (resource, tag) coordinates.
+    Returns the matrix (as a scipy CSR matrix), resource ids and tag names of the rows and columns of the matrix,
+    and the ids of the tags (position in the list of all tags before filtering).
+    '''
+    tag_to_id = dict()
+    resource_ids = []
+    association_resources = []
+    association_tags = []
+    for position, (resource_id, resource_tags) in enumerate(index_items):
+        resource_ids.append(resource_id)
+        association_resources.extend([position] * len(resource_tags))
+        association_tags.extend([tag_to_id.setdefault(tag, len(tag_to_id)) for tag in resource_tags])
+    association_resources = array(association_resources, dtype=int32)
+    association_tags = array(association_tags, dtype=int32)
+
+    # Compute tag occurrences and filter tags
+    all_tags = [None] * len(tag_to_id)
+    for tag, tag_id in tag_to_id.iteritems():
+        all_tags[tag_id] = tag
+    tag_occurrences = bincount(association_tags, minlength=len(all_tags))
+    tags_ids = where(tag_occurrences >= tag_threshold)[0]
+    tags = [all_tags[tag_id] for tag_id in tags_ids]
+    if verbose:
+        print "\tOriginal number of tags: " + str(len(all_tags))
+        print "\tTags after filtering: " + str(len(tags))
+
+    # Map tag ids to matrix columns (-1 for filtered tags) and resources with some remaining tag to matrix rows
+    tag_columns = -ones(len(all_tags), dtype=int32)
+    tag_columns[tags_ids] = arange(len(tags_ids), dtype=int32)
+    association_columns = tag_columns[association_tags]
+    kept = association_columns >= 0
+    association_resources = association_resources[kept]
+    association_columns = association_columns[kept]
+
+    resource_has_tags = zeros(len(resource_ids), dtype=bool)
+    resource_has_tags[association_resources] = True
+    resource_positions = where(resource_has_tags)[0]
+    resource_rows = -ones(len(resource_ids), dtype=int32)
+    resource_rows[resource_positions] = arange(len(resource_positions), dtype=int32)
+    resources = [resource_ids[position] for position in resource_positions]
+
+    # Build matrix (repeated tags of a resource are summed by tocsr, set them back to 1)
+    M = coo_matrix((ones(len(association_columns), dtype=float32),
+                    (resource_rows[association_resources], association_columns)),
+                   shape=(len(resources), len(tags))).tocsr()
+    M.sum_duplicates()
+    M.data[:] = 1
+    if verbose:
+        print "\tOriginal number of associations: " + str(len(association_tags))
+        print "\tAssociations after filtering: " + str(M.nnz)
+        print "\tAssociation matrix of %i x %i" % M.shape
+
+    return M, resources, tags, tags_ids
+
+
+# Number of most similar tags kept for every tag in the similarity matrices (the recommendation heuristics use the 100
+# most similar tags, see tagRecommendation.heuristics). Use None to keep all non-zero similarities.
+SIMILARITY_TOP_K = 200
+
+# Number of most similar tags stored for every tag in the neighbor tables loaded by the recommendation server (must
+# not be smaller than the cNMostSimilar_N option of the recommendation heuristics)
+NEIGHBOR_TABLE_SIZE = 100
+
+# Number of resources classified at once when computing the class of every resource
+CLASSIFICATION_BATCH_SIZE = 10000
+
+
+def similarity_from_cooccurrence(MM, metric="cosine"):
+    '''
+    Computes the tag similarity matrix from the sparse (CSR) tag co-occurrence matrix MM (M^T M, with the number of
+    occurrences of each tag in the diagonal) without leaving the non-zero pattern of MM:
+      cosine: D^-1/2 MM D^-1/2 (D is the diagonal of MM)
+      jaccard: MM(i, j) / (MM(i, i) + MM(j, j) - MM(i, j))
+      binary: 1 for every co-occurring pair of tags
+      coocurrence: MM
+    '''
+    occurrences = MM.diagonal().astype(float32)
+    if metric == 'cosine':
+        scale = diags(1.0 / sqrt(occurrences), 0)
+        return (scale * MM * scale).tocsr()
+    sim_matrix = MM.tocoo()
+    if metric == 'jaccard':
+        data = sim_matrix.data / (occurrences[sim_matrix.row] + occurrences[sim_matrix.col] - sim_matrix.data)
+    elif metric == 'binary':
+        data = ones(sim_matrix.nnz, dtype=float32)
+    elif metric == 'coocurrence':
+        data = sim_matrix.data
+    else:
+        raise Exception("Wrong similarity metric specified")
+    return csr_matrix((data, (sim_matrix.row, sim_matrix.col)), shape=MM.shape)
+
+
+def prune_top_k(sim_matrix, k):
+    '''
+    Keeps only the k biggest values of every row of the sparse similarity matrix (including the similarity of a
+    tag with itself), so that the size of the matrix grows linearly with the number of tags.
+    '''
+    sim_matrix = sim_matrix.tocsr()
+    rows = repeat(arange(sim_matrix.shape[0]), diff(sim_matrix.indptr))
+    # Sort values by row and then by decreasing value, rank of each value in its row
+    order = lexsort((-sim_matrix.data, rows))
+    ranks = arange(sim_matrix.nnz) - sim_matrix.indptr[rows[order]]
+    keep = order[ranks < k]
+    return csr_matrix((sim_matrix.data[keep], (rows[keep], sim_matrix.indices[keep])), shape=sim_matrix.shape)
+
+
 class RecommendationDataProcessor:
     '''
     This class has methods to generate all the files that the tag recommendation systems needs to recommend tags.
-    To generate these files the data processor needs the Index.json file with the tag association information from freesound.
-    The Index.json file must have the following form:
+    To generate these files the data processor needs the index with the tag association information from freesound
+    (Index.snapshot and Index.log files, see tag_index.TagIndex). The index maps sound ids to their tags:
 
     {
         "1142": [
@@ -52,8 +165,10 @@ class RecommendationDataProcessor:
 
     The files that are generated by the system are:
     (for every sound class: Soundscape, Music, Fx, Samples, Speech)
-    [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET.npy
+    [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET.npz (sparse CSR matrix, see utils.saveSparseMatrix)
     [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_TAG_NAMES.npy
+    [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_NEIGHBOR_IDS.npy (most similar tags of every tag)
+    [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_NEIGHBOR_SCORES.npy
     '''
 
     verbose = None
@@ -66,139 +181,52 @@ class RecommendationDataProcessor:
 
     def tas_to_association_matrix(self, tag_threshold=0, line_limit=1000000000):
 
-        index = loadFromJson(RECOMMENDATION_DATA_DIR + "Index.json")
-        # Get tags from file
-        ts = []
-        idx = 0
-        n_original_associations = 0
-        sound_ids = []
+        index = TagIndex(RECOMMENDATION_DATA_DIR, read_only=True).index
         if self.verbose:
-            print "Reading index file (%i entries)..." % len(index.items()),
-        for sid, tags in index.items():
-            ts += tags
-            n_original_associations += len(tags)
-            sound_ids.append(sid)
-
-            idx += 1
-            if idx > line_limit:
-                break
+            print "Reading index file (%i entries)..." % len(index)
+        index_items = list(islice(index.iteritems(), line_limit + 1))
 
         stats = {
-            'n_sounds_in_matrix': len(sound_ids),
+            'n_sounds_in_matrix': len(index_items),
             #'biggest_id': max([int(sid) for sid in sound_ids])
         }
         saveToJson(RECOMMENDATION_TMP_DATA_DIR + 'Current_index_stats.json', stats)
-        if self.verbose:
-            print "done!"
 
-        # Compute tag ocurrences after loading the file
-        tag_occurrences = dict()
-        unique_ts = list(set(ts))
-        for id, t in enumerate(unique_ts):
-            tag_occurrences[t] = ts.count(t)
+        M, resources, tags, tags_ids = index_to_association_matrix(index_items, tag_threshold=tag_threshold,
+                                                                   verbose=self.verbose)
 
-            if self.verbose:
-                sys.stdout.write("\rComputing tag occurrences %.2f%%"%(float(100*(id+1))/len(unique_ts)))
-                sys.stdout.flush()
-        print ""
-        tags = []
-        tags_ids = []
-        for id, t in enumerate(unique_ts):
-
-            if tag_occurrences[t] >= tag_threshold:
-                tags.append(t)
-                tags_ids.append(id)
-
-            if self.verbose:
-                sys.stdout.write("\rFiltering tags %.2f%%"%(float(100*(id+1))/len(unique_ts)))
-                sys.stdout.flush()
-
-        nTags = len(tags)
-        if self.verbose:
-            print ""
-            print "\tOriginal number of tags: " + str(len(unique_ts))
-            print "\tTags after filtering: " + str(nTags)
-
-        # Generate resource-tags dictionary only with filtered tags
-        if self.verbose:
-            print "Reading file for resources...",
-        sys.stdout.flush()
-        res_tags = {}
-        res_user = {}
-        res_tags_no_filt = {}
-        idx = 0
-        n_filtered_associations = 0
-        for sid, stags in index.items():
-            resource = sid
-            user = None
-            assigned_tags = stags
-            assigned_tags_filt = list(set(assigned_tags).intersection(set(tags)))
-            res_tags_no_filt[resource] = assigned_tags
-            res_user[resource] = user
-            if len(assigned_tags_filt) > 0:
-                res_tags[resource] = assigned_tags_filt
-                n_filtered_associations += len(assigned_tags_filt)
-
-            idx += 1
-            if idx > line_limit:
-                break
-
-        resources = res_tags.keys()
-        nResources = len(resources)
-        resources_ids = range(0,nResources)
-        if self.verbose:
-            print "done!"
-
-        # Generate assocoation matrix
-        if self.verbose:
-            print "\tOriginal number of associations: " + str(n_original_associations)
-            print "\tAssociations after filtering: " + str(n_filtered_associations)
-
-        if self.verbose:
-            print 'Creating empty array of ' + str(nResources) + ' x ' + str(nTags) + '...',
-        M = spmatrix.ll_mat(nResources, nTags)
-        if self.verbose:
-            print 'done!'
-
-        done = 0
-        for r_id in resources:
-            for t in res_tags[r_id]:
-                M[resources.index(r_id),tags.index(t)] = 1
-                done += 1
-                if self.verbose:
-                    sys.stdout.write("\rGenerating association matrix %.2f%%" % (float(100*done)/n_filtered_associations))
-                    sys.stdout.flush()
-        if self.verbose:
-            print ""
+        # Resources tags dictionary only with filtered tags
+        tag_names = array(tags, dtype=object)
+        res_tags = dict()
+        for position, resource in enumerate(resources):
+            res_tags[resource] = tag_names[M.indices[M.indptr[position]:M.indptr[position + 1]]].tolist()
 
         # Save data
         if self.verbose:
             print "Saving association matrix, resource ids, tag ids and tag names"
 
         filename = "FS%.4i%.2i%.2i" % (datetime.today().year, datetime.today().month, datetime.today().day)
-        M.export_mtx(RECOMMENDATION_TMP_DATA_DIR + filename + '_ASSOCIATION_MATRIX.mtx')
+        saveSparseMatrix(RECOMMENDATION_TMP_DATA_DIR + filename + '_ASSOCIATION_MATRIX.npz', M)
         save(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCE_IDS.npy',resources)
         save(RECOMMENDATION_TMP_DATA_DIR + filename + '_TAG_IDS.npy',tags_ids)
         save(RECOMMENDATION_TMP_DATA_DIR + filename + '_TAG_NAMES.npy',tags)
         saveToJson(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCES_TAGS.json',res_tags, verbose = self.verbose)
-        #saveToJson(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCES_TAGS_NO_FILTER.json',res_tags_no_filt, verbose = self.verbose)
-        #saveToJson(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCES_USER.json',res_user, verbose = self.verbose)
 
         return filename
 
-
     def association_matrix_to_similarity_matrix(self,
                                                 metric="cosine",
                                                 dataset="FREESOUND",
                                                 save_sim=False,
                                                 training_set=None,
                                                 out_name_prefix="",
-                                                is_general_recommender=False):
+                                                is_general_recommender=False,
+                                                top_k=None):
 
         if self.verbose:
             print "Loading association matrix and tag names, ids files..."
         try:
-            M = spmatrix.ll_mat_from_mtx(RECOMMENDATION_TMP_DATA_DIR + dataset + "_ASSOCIATION_MATRIX.mtx")
+            M = loadSparseMatrix(RECOMMENDATION_TMP_DATA_DIR + dataset + "_ASSOCIATION_MATRIX.npz")
             resource_ids = load(RECOMMENDATION_TMP_DATA_DIR + dataset + "_RESOURCE_IDS.npy")
             tag_names = load(RECOMMENDATION_TMP_DATA_DIR + dataset + "_TAG_NAMES.npy")
         except Exception:
@@ -213,50 +241,51 @@ class RecommendationDataProcessor:
         resource_id_positions = where(in1d(resource_ids, training_set, assume_unique=True))[0]
 
         # Matrix multiplication (only taking in account resources in training set and ALL tags)
-        MM = spmatrix.dot(M[resource_id_positions, :], M[resource_id_positions, :])
-
-        # Get similarity matrix
-        sim_matrix = spmatrix.ll_mat(MM.shape[0],MM.shape[0])
-        non_zero_index = MM.keys()
-        for index in non_zero_index:
-            if metric == 'cosine':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]] * (1 / (sqrt(MM[index[0], index[0]]) * sqrt(MM[index[1], index[1]])))
-            elif metric == 'coocurrence':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]]
-            elif metric == 'binary':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]]/MM[index[0], index[1]]
-            elif metric == 'jaccard':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]] * (1 / (MM[index[0], index[0]] + MM[index[1], index[1]] - MM[index[0], index[1]]))
+        M = M[resource_id_positions, :]
+        MM = (M.T * M).tocsr()
 
         # Clean out similarity matrix (clean tags that are not used)
-        tag_positions = []
-        for i in range(0, sim_matrix.shape[0]):
-            if sim_matrix[i, i] != 0.0:
-                tag_positions.append(i)
-
-        # Transform sparse similarity matrix to npy format
-        sim_matrix_npy = mtx2npy(sim_matrix[tag_positions,tag_positions])
+        tag_positions = where(MM.diagonal() != 0)[0]
+        MM = MM[tag_positions, :][:, tag_positions]
         tag_names_sim_matrix = tag_names[tag_positions]
 
+        # Get similarity matrix
+        sim_matrix = similarity_from_cooccurrence(MM, metric)
+        if top_k is not None:
+            sim_matrix = prune_top_k(sim_matrix, top_k)
+        if self.verbose:
+            print "Similarity matrix of %i tags (%i non-zero values)" % (sim_matrix.shape[0], sim_matrix.nnz)
+
         if save_sim:
             if not is_general_recommender:
                 # Save sim
-                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_%s_SIMILARITY_MATRIX_" % out_name_prefix + metric + "_SUBSET.npy"
+                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_%s_SIMILARITY_MATRIX_" % out_name_prefix + metric + "_SUBSET.npz"
                 if self.verbose:
                     print "Saving to " + path + "..."
-                save(path, sim_matrix_npy)
+                saveSparseMatrix(path, sim_matrix)
 
                 # Save tag names
                 path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_%s_SIMILARITY_MATRIX_" % out_name_prefix + metric + "_SUBSET_TAG_NAMES.npy"
                 if self.verbose:
                     print "Saving to " + path + "..."
                 save(path, tag_names_sim_matrix)
+
+                # Save neighbor tables
+                neighbor_ids, neighbor_scores = similarityToNeighborTables(sim_matrix, NEIGHBOR_TABLE_SIZE)
+                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_%s_SIMILARITY_MATRIX_" % out_name_prefix + metric + "_SUBSET_NEIGHBOR_IDS.npy"
+                if self.verbose:
+                    print "Saving to " + path + "..."
+                save(path, neighbor_ids)
+                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_%s_SIMILARITY_MATRIX_" % out_name_prefix + metric + "_SUBSET_NEIGHBOR_SCORES.npy"
+                if self.verbose:
+                    print "Saving to " + path + "..."
+                save(path, neighbor_scores)
             else:
                 # Save sim
-                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_SIMILARITY_MATRIX_" + metric + ".npy"
+                path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_SIMILARITY_MATRIX_" + metric + ".npz"
                 if self.verbose:
                     print "Saving to " + path + "..."
-                save(path, sim_matrix_npy)
+                saveSparseMatrix(path, sim_matrix)
 
                 # Save tag names
                 path = RECOMMENDATION_TMP_DATA_DIR + dataset + "_SIMILARITY_MATRIX_" + metric + "_TAG_NAMES.npy"
@@ -264,14 +293,15 @@ class RecommendationDataProcessor:
                     print "Saving to " + path + "..."
                 save(path, tag_names_sim_matrix)
 
-        return {'SIMILARITY_MATRIX': sim_matrix_npy, 'TAG_NAMES': tag_names_sim_matrix}
+        return {'SIMILARITY_MATRIX': sim_matrix, 'TAG_NAMES': tag_names_sim_matrix}
 
     def process_tag_recommendation_data(self,
                                         resources_limit=None,
                                         tag_threshold=10,
                                         line_limit=99999999999999,
                                         recompute_all_classes=False,
-                                        similarity_metric="cosine"):
+                                        similarity_metric="cosine",
+                                        similarity_top_k=SIMILARITY_TOP_K):
 
         # Process tas file and turn into association matrix and derived files
         database_name = self.tas_to_association_matrix(tag_threshold=tag_threshold, line_limit=line_limit)
@@ -288,15 +318,14 @@ class RecommendationDataProcessor:
         except Exception as e:
             resource_class = dict()
 
-        for count, id in enumerate(instances_ids):
-            if not recompute_all_classes:
-                if id not in resource_class:
-                    resource_class[id] = cd.detectCommunity(input_tags=resources_tags[id])
-            else:
-                resource_class[id] = cd.detectCommunity(input_tags=resources_tags[id])
+        ids_to_classify = [id for id in instances_ids if recompute_all_classes or id not in resource_class]
+        for start in range(0, len(ids_to_classify), CLASSIFICATION_BATCH_SIZE):
+            batch_ids = ids_to_classify[start:start + CLASSIFICATION_BATCH_SIZE]
+            batch_classes = cd.detect_communities([resources_tags[id] for id in batch_ids])
+            resource_class.update(zip(batch_ids, batch_classes))
 
             if self.verbose:
-                sys.stdout.write("\rClassifying resources... %.2f%%"%(float(100*(count+1))/len(instances_ids)))
+                sys.stdout.write("\rClassifying resources... %.2f%%"%(float(100*(start+len(batch_ids)))/len(ids_to_classify)))
                 sys.stdout.flush()
 
         print ""
@@ -310,6 +339,7 @@ class RecommendationDataProcessor:
             save_sim=True,
             is_general_recommender=True,
             metric=similarity_metric,
+            top_k=similarity_top_k,
         )
 
         print "\nComputing data for class recommenders..."
@@ -346,6 +376,7 @@ class RecommendationDataProcessor:
                 out_name_prefix=collection_id,
                 is_general_recommender=False,
                 metric=similarity_metric,
+                top_k=similarity_top_k,
             )
 
     def clear_temp_files(self):
@@ -361,7 +392,7 @@ class RecommendationDataProcessor:
 
         for filename in os.listdir(RECOMMENDATION_DATA_DIR):
             file_extension = filename.split(".")[-1]
-            if file_extension in ['npy', 'json', 'pkl']:
+            if file_extension in ['npy', 'npz', 'json', 'pkl']:
                 if "Classifier" not in filename and "Index" not in filename:  # Do not alter Classifier files
                     if filename[0:6] == "backup":
                         # Delete old backups
@@ -406,7 +437,7 @@ class RecommendationDataProcessor:
 
         for filename in os.listdir(RECOMMENDATION_DATA_DIR):
             file_extension = filename.split(".")[-1]
-            if file_extension in ['npy', 'json']:
+            if file_extension in ['npy', 'npz', 'json']:
                 if "Classifier" not in filename and "Index" not in filename:  # Do not alter Classifier files and index
                     if filename[0:6] != "backup":
                         print "Removing %s" % RECOMMENDATION_DATA_DIR + filename
@@ -414,7 +445,7 @@ class RecommendationDataProcessor:
 
         for filename in os.listdir(RECOMMENDATION_DATA_DIR):
             file_extension = filename.split(".")[-1]
-            if file_extension in ['npy', 'json']:
+            if file_extension in ['npy', 'npz', 'json']:
                 if "Classifier" not in filename:  # Do not alter Classifier files
                     if filename[0:6] == "backup":
                         # Set previous matrixs to "backup mode" (will be deleted in the next update)
@@ -19,6 +19,7 @@
 #
 
 from heuristics import heuristics
+from utils import similarityToNeighborTables
 
 
 class TagRecommender:
@@ -34,7 +35,7 @@ class TagRecommender:
 
     def __repr__(self):
         if self.data:
-            size = self.data['SIMILARITY_MATRIX'].shape[0]
+            size = len(self.data['TAG_NAMES'])
         else:
             size = -1
 
@@ -50,6 +51,17 @@ class TagRecommender:
             raise Exception("Wrong heuristic given")
 
     def load_data(self, dataset=None, metric=None, data=None):
+        # data must include TAG_NAMES and either the NEIGHBOR_IDS and NEIGHBOR_SCORES tables (see
+        # utils.similarityToNeighborTables) or a SIMILARITY_MATRIX from which the tables are computed
+        if 'NEIGHBOR_IDS' not in data:
+            data = data.copy()
+            similarity_matrix = data.pop('SIMILARITY_MATRIX')
+            data['NEIGHBOR_IDS'], data['NEIGHBOR_SCORES'] = \
+                similarityToNeighborTables(similarity_matrix, self.heuristic['options']['cNMostSimilar_N'])
+        if 'TAG_IDS' not in data:
+            data = data.copy()
+            data['TAG_IDS'] = dict((t.decode('utf-8') if isinstance(t, str) else t, idx)
+                                   for idx, t in enumerate(data['TAG_NAMES']))
         self.data = data
         self.dataset = dataset
         self.metric = metric
@@ -69,7 +81,7 @@ class TagRecommender:
         selectAlgorithm = self.heuristic['s']
 
         # CHOOSE candidate tags
-        candidate_tags = chooseAlgorithm(input_tags, self.data['TAG_NAMES'], self.data['SIMILARITY_MATRIX'], self.heuristic['options'])
+        candidate_tags = chooseAlgorithm(input_tags, self.data, self.heuristic['options'])
 
         # AGGREGATE candidate tags
         aggregated_candiate_tags, aggregated_candiate_tags_list = aggregateAlgorithm(candidate_tags, input_tags, self.heuristic['options'])
@@ -23,27 +23,24 @@ import operator
 from numpy import *
 
 
-def cNMostSimilar(input_tags, tag_names, similarity_matrix, options):
+def cNMostSimilar(input_tags, data, options):
 
     N = options['cNMostSimilar_N']
-    unicode_tag_names = [t.decode('utf-8') for t in tag_names]
+    tag_names = data['TAG_NAMES']
     candidate_tags = []
     for tag in input_tags:
         # Check that tag exists in the tag matrix, if it does not exist we cannot recommend similar tags
-        if tag in unicode_tag_names:
-            # Find N most similar tags in the row
-            idx = unicode_tag_names.index(tag)
-            #where(tag_names == tag)[0][0]
-            row_idx = nonzero(similarity_matrix[idx,:])
-            row_idx = row_idx[0]
-            row = similarity_matrix[idx,row_idx]
-            MAX = N
-            most_similar_idx = row.argsort()[-MAX-1:-1][::-1] # We pick the first N most similar tags (practically the same as no threshold but more efficient)
-            most_similar_dist = row[most_similar_idx]
-            most_similar_tags = tag_names[row_idx[most_similar_idx]]
+        idx = data['TAG_IDS'].get(tag)
+        if idx is not None:
+            # N most similar tags are precomputed in the neighbor tables (sorted by decreasing similarity, padded with -1)
+            most_similar_ids = data['NEIGHBOR_IDS'][idx, :N]
+            most_similar_dist = data['NEIGHBOR_SCORES'][idx, :N]
 
             rank = N
-            for count,item in enumerate(most_similar_tags):
+            for count, item_id in enumerate(most_similar_ids):
+                if item_id < 0:
+                    break
+                item = tag_names[item_id]
                 if item not in input_tags:
                     candidate_tags.append( {'name':item, 'rank':rank, 'dist':most_similar_dist[count], 'from':tag} )
                     rank -= 1
@@ -0,0 +1,120 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import cPickle
+import json
+import os
+
+from utils import loadFromJson
+
+
+class TagIndex:
+    '''
+    Index of the tags of every sound used to compute the tag recommendation data, persisted in a data directory as:
+        Index.snapshot  (pickled dictionary of sound id -> tags and biggest sound id)
+        Index.log       (sounds added after the snapshot was written, one JSON [sound id, tags] record per line)
+    Sounds are appended to the log as they are added and every compact_every records the index is compacted into
+    a new snapshot and the log is emptied. When loading, the records of the log are applied on top of the snapshot
+    (an incomplete last record left by a crash is discarded). If there is no snapshot, the index is imported from the
+    Index.json file used by previous versions (if it exists) before applying the log, and a first snapshot is written.
+    '''
+
+    compact_every = 100000
+
+    def __init__(self, data_dir, read_only=False):
+        self.snapshot_path = data_dir + 'Index.snapshot'
+        self.log_path = data_dir + 'Index.log'
+        self.json_path = data_dir + 'Index.json'
+        self.read_only = read_only
+        self.index = dict()
+        self.biggest_id = 0
+        self.n_log_records = 0
+        self.log_file = None
+        self.load()
+
+    def __len__(self):
+        return len(self.index)
+
+    def load(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = cPickle.load(f)
+            self.index = snapshot['index']
+            self.biggest_id = snapshot['biggest_id']
+        elif os.path.exists(self.json_path):
+            # Also when there is a log, the server might have stopped before the first snapshot was written
+            self.index = loadFromJson(self.json_path)
+            self.biggest_id = max([int(key) for key in self.index.keys()] or [0])
+
+        valid_log_size = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith('\n'):
+                            raise ValueError
+                        sound_id, tags = json.loads(line)
+                    except ValueError:
+                        break  # Incomplete record written when the server stopped, ignore it and the rest of the log
+                    self.set(sound_id, tags)
+                    valid_log_size += len(line)
+
+        if not self.read_only:
+            self.log_file = open(self.log_path, 'ab')
+            # Remove an incomplete record at the end of the log so new records are appended after a valid one
+            self.log_file.truncate(valid_log_size)
+            if not os.path.exists(self.snapshot_path) and self.index:
+                # First snapshot (index imported from Index.json and/or from the log)
+                self.compact()
+
+    def set(self, sound_id, tags):
+        self.index[sound_id] = tags
+        self.biggest_id = max(self.biggest_id, int(sound_id))
+        self.n_log_records += 1
+
+    def add(self, sound_ids, sound_tags):
+        if self.read_only:
+            raise Exception("Can't add sounds to a read only index")
+        records = []
+        for sound_id, tags in zip(sound_ids, sound_tags):
+            self.set(sound_id, tags)
+            records.append(json.dumps([sound_id, tags], separators=(',', ':')) + '\n')
+        self.log_file.write(''.join(records))
+        self.log_file.flush()
+
+        if self.n_log_records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        # The new snapshot replaces the previous one atomically, if the server stops before the log is emptied the
+        # records of the log will be applied again when loading (which does not change the index)
+        tmp_snapshot_path = self.snapshot_path + '.tmp'
+        with open(tmp_snapshot_path, 'wb') as f:
+            cPickle.dump({'index': self.index, 'biggest_id': self.biggest_id}, f, cPickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_snapshot_path, self.snapshot_path)
+        self.log_file.truncate(0)
+        self.n_log_records = 0
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
@@ -27,21 +27,26 @@ from __future__ import print_function
 
 import json
 import logging
+import resource as process_resource
+import time
 
 import cloghandler
 import graypy
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.web import server, resource
 
 from communityBasedTagRecommendation import CommunityBasedTagRecommender
 import tagrecommendation_settings as tr_settings
-from utils import loadFromJson, saveToJson
+from tag_index import TagIndex
+from utils import loadFromJson, LRUCache
 
 
 def server_interface(resource):
     return {
         'recommend_tags': resource.recommend_tags,  # input_tags (tags separated by commas), max_number_of_tags (optional)
+        'recommend_tags_batch': resource.recommend_tags_batch,  # input_tagss (sets of tags separated by -!-!-), max_number_of_tags (optional)
         'reload': resource.reload,
+        'stats': resource.stats,
         'last_indexed_id': resource.last_indexed_id,
         'add_to_index': resource.add_to_index,  # sound_ids (str separated by commas), sound_tagss (sets of tags separated by #)
     }
@@ -52,40 +57,60 @@ class TagRecommendationServer(resource.Resource):
         resource.Resource.__init__(self)
         self.methods = server_interface(self)
         self.isLeaf = False
+        self.index = None
+        self.reload_stats = {
+            'reloading': False,
+            'last_reload_start': None,
+            'last_reload_duration': None,
+            'last_reload_error': None,
+        }
 
         self.load()
 
     def load(self):
         try:
-            tag_recommendation_data = loadFromJson(
-                tr_settings.RECOMMENDATION_DATA_DIR + 'Current_database_and_class_names.json')
-            DATABASE = tag_recommendation_data['database']
-            CLASSES = tag_recommendation_data['classes']
-            self.cbtr = CommunityBasedTagRecommender(dataset=DATABASE, classes=CLASSES)
-            self.cbtr.load_recommenders()
-
-        except:
-            self.cbtr = None
+            cbtr = self.load_recommender()
+        except Exception:
+            cbtr = None
             logger.info("No computed matrices were found, recommendation system not loading for the moment (but service listening for data to come).")
-
+        self.set_recommender(cbtr, self.load_index_stats())
+
+    def load_recommender(self):
+        # Builds and validates a new recommender with the data currently in the data dir
+        tag_recommendation_data = loadFromJson(
+            tr_settings.RECOMMENDATION_DATA_DIR + 'Current_database_and_class_names.json')
+        DATABASE = tag_recommendation_data['database']
+        CLASSES = tag_recommendation_data['classes']
+        cbtr = CommunityBasedTagRecommender(dataset=DATABASE, classes=CLASSES)
+        cbtr.load_recommenders()
+        cbtr.validate()
+        return cbtr
+
+    def load_index_stats(self):
         try:
-            self.index_stats = loadFromJson(tr_settings.RECOMMENDATION_DATA_DIR + 'Current_index_stats.json')
-            logger.info("Matrices computed out of information from %i sounds" % self.index_stats['n_sounds_in_matrix'])
+            index_stats = loadFromJson(tr_settings.RECOMMENDATION_DATA_DIR + 'Current_index_stats.json')
+            logger.info("Matrices computed out of information from %i sounds" % index_stats['n_sounds_in_matrix'])
         except Exception as e:
             print(e)
-            self.index_stats = {
+            index_stats = {
                 'n_sounds_in_matrix': 0,
             }
-
-        try:
-            self.index = loadFromJson(tr_settings.RECOMMENDATION_DATA_DIR + 'Index.json')
-            self.index_stats['biggest_id_in_index'] = max([int(key) for key in self.index.keys()])
-            self.index_stats['n_sounds_in_index'] = len(self.index.keys())
-        except Exception as e:
-            logger.info("Index file not present. Listening for indexing data from appservers.")
-            self.index_stats['biggest_id_in_index'] = 0
-            self.index_stats['n_sounds_in_index'] = 0
-            self.index = dict()
+        return index_stats
+
+    def set_recommender(self, cbtr, index_stats):
+        # Runs in the reactor thread so requests either use the previous or the new recommender and cache
+        self.cbtr = cbtr
+        # Recommendations computed with previous data are no longer valid
+        self.recommendation_cache = LRUCache(getattr(tr_settings, 'RECOMMENDATION_CACHE_SIZE', 10000))
+        self.index_stats = index_stats
+
+        if self.index is None:
+            # The index is only loaded when starting the server, it is kept up to date by add_to_index
+            self.index = TagIndex(tr_settings.RECOMMENDATION_DATA_DIR)
+            if not len(self.index):
+                logger.info("Index file not present. Listening for indexing data from appservers.")
+        self.index_stats['biggest_id_in_index'] = self.index.biggest_id
+        self.index_stats['n_sounds_in_index'] = len(self.index)
 
     def error(self,message):
         return json.dumps({'Error': message})
@@ -96,6 +121,31 @@ class TagRecommendationServer(resource.Resource):
     def render_GET(self, request):
         return self.methods[request.prepath[1]](**request.args)
 
+    def render_POST(self, request):
+        # Arguments of POST requests are form encoded in the body of the request
+        return self.methods[request.prepath[1]](**request.args)
+
+    def get_recommendations(self, input_tagss, max_number_of_tags=None):
+        # Recommendations are cached by input tag set (the order of the input tags is not relevant), recommendations
+        # not in the cache are computed all together
+        cache_keys = [tuple(sorted(set(input_tags))) for input_tags in input_tagss]
+        recommendations = [self.recommendation_cache.get(cache_key) for cache_key in cache_keys]
+        missing_positions = dict()
+        for i, recommendation in enumerate(recommendations):
+            if recommendation is None:
+                missing_positions.setdefault(cache_keys[i], i)
+        if missing_positions:
+            missing_keys = missing_positions.keys()
+            new_recommendations = self.cbtr.recommend_tags_batch([input_tagss[missing_positions[cache_key]]
+                                                                  for cache_key in missing_keys])
+            new_recommendations = dict(zip(missing_keys, new_recommendations))
+            for cache_key, recommendation in new_recommendations.items():
+                self.recommendation_cache.set(cache_key, recommendation)
+            recommendations = [recommendation if recommendation is not None else new_recommendations[cache_key]
+                               for cache_key, recommendation in zip(cache_keys, recommendations)]
+        return [{'tags': recommended_tags[0:max_number_of_tags], 'community': com_name}
+                for recommended_tags, com_name in recommendations]
+
     def recommend_tags(self, input_tags, max_number_of_tags=None):
 
         try:
@@ -103,9 +153,8 @@ class TagRecommendationServer(resource.Resource):
             input_tags = input_tags[0].split(",")
             if max_number_of_tags:
                 max_number_of_tags = int(max_number_of_tags[0])
-            recommended_tags, com_name = self.cbtr.recommend_tags(input_tags,
-                                                                  max_number_of_tags=max_number_of_tags)
-            result = {'error': False, 'result': {'tags': recommended_tags, 'community': com_name}}
+            result = {'error': False, 'result': self.get_recommendations([input_tags],
+                                                                         max_number_of_tags=max_number_of_tags)[0]}
 
         except Exception as e:
             logger.debug('Errors occurred while recommending tags to %s' % input_tags)
@@ -113,10 +162,60 @@ class TagRecommendationServer(resource.Resource):
 
         return json.dumps(result)
 
+    def recommend_tags_batch(self, input_tagss, max_number_of_tags=None):
+
+        try:
+            input_tagss = [input_tags.split(",") for input_tags in input_tagss[0].split("-!-!-")]
+            logger.debug('Getting recommendation for %i sets of input tags' % len(input_tagss))
+            if max_number_of_tags:
+                max_number_of_tags = int(max_number_of_tags[0])
+            result = {'error': False, 'result': self.get_recommendations(input_tagss,
+                                                                         max_number_of_tags=max_number_of_tags)}
+
+        except Exception as e:
+            logger.debug('Errors occurred while recommending tags to %i sets of input tags' % len(input_tagss))
+            result = {'error': True, 'result': str(e)}
+
+        return json.dumps(result)
+
     def reload(self):
+        if self.reload_stats['reloading']:
+            result = {'error': False, 'result': "Server already reloading"}
+            return json.dumps(result)
+
+        # New data is loaded in a thread while the current recommender keeps serving requests
         logger.info('Reloading tagrecommendation server...')
-        self.load()
-        result = {'error': False, 'result': "Server reloaded"}
+        self.reload_stats['reloading'] = True
+        self.reload_stats['last_reload_start'] = time.time()
+        d = threads.deferToThread(lambda: (self.load_recommender(), self.load_index_stats()))
+        d.addCallbacks(self.reload_finished, self.reload_failed)
+        result = {'error': False, 'result': "Server reloading"}
+        return json.dumps(result)
+
+    def reload_finished(self, new_data):
+        cbtr, index_stats = new_data
+        self.set_recommender(cbtr, index_stats)
+        self.reload_stats['reloading'] = False
+        self.reload_stats['last_reload_duration'] = time.time() - self.reload_stats['last_reload_start']
+        self.reload_stats['last_reload_error'] = None
+        logger.info('Tagrecommendation server reloaded (%.2f seconds)' % self.reload_stats['last_reload_duration'])
+
+    def reload_failed(self, failure):
+        # The current recommender is kept
+        self.reload_stats['reloading'] = False
+        self.reload_stats['last_reload_duration'] = time.time() - self.reload_stats['last_reload_start']
+        self.reload_stats['last_reload_error'] = failure.getErrorMessage()
+        logger.error('Errors occurred while reloading tagrecommendation server: %s' % failure.getErrorMessage())
+
+    def stats(self):
+        stats = dict(self.reload_stats)
+        stats.update(self.index_stats)
+        stats['recommender_loaded'] = self.cbtr is not None
+        if self.cbtr is not None:
+            stats.update(self.cbtr.memory_footprint())
+        stats['n_cached_recommendations'] = len(self.recommendation_cache)
+        stats['max_rss_kb'] = process_resource.getrusage(process_resource.RUSAGE_SELF).ru_maxrss
+        result = {'error': False, 'result': stats}
         return json.dumps(result)
 
     def last_indexed_id(self):
@@ -131,17 +230,9 @@ class TagRecommendationServer(resource.Resource):
         sound_tags = [stags.split(",") for stags in sound_tagss[0].split("-!-!-")]
         logger.info('Adding %i sounds to recommendation index' % len(sound_ids))
 
-        for count, sound_id in enumerate(sound_ids):
-            sid = sound_id
-            stags = sound_tags[count]
-            self.index[sid] = stags
-
-        if len(self.index.keys()) % 1000 == 0:
-            # Every 1000 indexed sounds, save the index
-            logger.info('Saving tagrecommendation index...')
-            saveToJson(tr_settings.RECOMMENDATION_DATA_DIR + 'Index.json', self.index, verbose=False)
-            self.index_stats['biggest_id_in_index'] = max([int(key) for key in self.index.keys()])
-            self.index_stats['n_sounds_in_index'] = len(self.index.keys())
+        self.index.add(sound_ids, sound_tags)
+        self.index_stats['biggest_id_in_index'] = self.index.biggest_id
+        self.index_stats['n_sounds_in_index'] = len(self.index)
 
         result = {'error': False, 'result': True}
         return json.dumps(result)
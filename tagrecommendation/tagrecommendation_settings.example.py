@@ -26,6 +26,7 @@ LOGFILE                     = '/var/log/freesound/tagrecommendation.log'
 LISTEN_PORT                 = 8010
 RECOMMENDATION_DATA_DIR     = '/home/fsweb/freesound/freesound-tagrecommendation/'
 RECOMMENDATION_TMP_DATA_DIR = RECOMMENDATION_DATA_DIR + 'tmp/'
+RECOMMENDATION_CACHE_SIZE   = 10000  # Max number of input tag sets whose recommendations are cached by the server
 
 # CLIENT SETTINGS (to be moved to django settings?)
 TAGRECOMMENDATION_ADDRESS          = 'localhost'
@@ -51,16 +52,20 @@ LOG_TO_STDOUT = False
 #
 # Having this classifier the recommendation server can be started. Once the server is running
 # a command from the appservers must be run so the recomendation is feeded with tag assignement data
-# from freesound which is stored in a file called Index.json. This fille incrementally stores
-# all tag assingment information from freesound. Once this file exists and has some data, the
+# from freesound which is stored in the Index.snapshot and Index.log files (see tag_index.py). These files
+# incrementally store all tag assingment information from freesound. Once the index has some data, the
 # "update_tagrecommendation_data.py" script can be run and will generate the following files:
 #
 # For every class used:
-#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET.npy
+#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET.npz
 #   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_TAG_NAMES.npy
+#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_NEIGHBOR_IDS.npy
+#   [[DATABASE]]_[[CLASSNAME]]_SIMILARITY_MATRIX_cosine_SUBSET_NEIGHBOR_SCORES.npy
 # Example:
-#   FREESOUND2012_CFX_SIMILARITY_MATRIX_cosine_SUBSET.npy
+#   FREESOUND2012_CFX_SIMILARITY_MATRIX_cosine_SUBSET.npz
 #   FREESOUND2012_CFX_SIMILARITY_MATRIX_cosine_SUBSET_TAG_NAMES.npy
+#   FREESOUND2012_CFX_SIMILARITY_MATRIX_cosine_SUBSET_NEIGHBOR_IDS.npy
+#   FREESOUND2012_CFX_SIMILARITY_MATRIX_cosine_SUBSET_NEIGHBOR_SCORES.npy
 #   ...
 #
 # Once the files are generated the recommendation service is restarted and ready.
@@ -0,0 +1,109 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from tag_index import TagIndex
+
+
+class TagIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp() + '/'
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def write_json_index(self, index):
+        with open(self.data_dir + 'Index.json', 'w') as f:
+            json.dump(index, f)
+
+    def test_add_and_load(self):
+        index = TagIndex(self.data_dir)
+        index.add(['3', '12'], [['rain', 'field-recording'], ['piano']])
+        index.add(['7'], [['wind']])
+        index.close()
+
+        # Sounds are loaded from the log (there is no snapshot yet)
+        index = TagIndex(self.data_dir, read_only=True)
+        self.assertEqual(index.index, {'3': ['rain', 'field-recording'], '12': ['piano'], '7': ['wind']})
+        self.assertEqual(index.biggest_id, 12)
+        self.assertEqual(len(index), 3)
+        self.assertRaises(Exception, index.add, ['8'], [['bird']])
+
+    def test_snapshot_and_log(self):
+        index = TagIndex(self.data_dir)
+        index.compact_every = 2
+        index.add(['1', '2'], [['a'], ['b']])  # Compacted into a snapshot
+        index.add(['2', '5'], [['c'], ['d']])  # Compacted again
+        index.add(['3'], [['e']])  # Only in the log
+        index.close()
+        self.assertTrue(os.path.exists(self.data_dir + 'Index.snapshot'))
+        with open(self.data_dir + 'Index.log') as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+        index = TagIndex(self.data_dir)
+        self.assertEqual(index.index, {'1': ['a'], '2': ['c'], '5': ['d'], '3': ['e']})
+        self.assertEqual(index.biggest_id, 5)
+        index.close()
+
+    def test_truncated_last_record(self):
+        index = TagIndex(self.data_dir)
+        index.add(['1', '2'], [['a'], ['b']])
+        index.close()
+        with open(self.data_dir + 'Index.log', 'ab') as f:
+            f.write('["3",["c"')  # Record left incomplete by a crash
+
+        index = TagIndex(self.data_dir)
+        self.assertEqual(index.index, {'1': ['a'], '2': ['b']})
+        # New records are appended after the last valid one
+        index.add(['4'], [['d']])
+        index.close()
+        index = TagIndex(self.data_dir, read_only=True)
+        self.assertEqual(index.index, {'1': ['a'], '2': ['b'], '4': ['d']})
+        self.assertEqual(index.biggest_id, 4)
+
+    def test_import_json_index(self):
+        self.write_json_index({'10': ['a'], '2': ['b']})
+        index = TagIndex(self.data_dir)
+        self.assertEqual(index.index, {'10': ['a'], '2': ['b']})
+        self.assertEqual(index.biggest_id, 10)
+        # A first snapshot is written so the json index is not imported again
+        self.assertTrue(os.path.exists(self.data_dir + 'Index.snapshot'))
+        index.add(['11'], [['c']])
+        index.close()
+        self.write_json_index({'10': ['old']})
+        index = TagIndex(self.data_dir, read_only=True)
+        self.assertEqual(index.index, {'10': ['a'], '2': ['b'], '11': ['c']})
+
+    def test_import_json_index_with_log_and_no_snapshot(self):
+        # Server stopped after the log was created but before the first snapshot was written
+        self.write_json_index({'10': ['a'], '2': ['b']})
+        with open(self.data_dir + 'Index.log', 'w') as f:
+            f.write('["2",["c"]]\n["12",["d"]]\n')
+        index = TagIndex(self.data_dir)
+        self.assertEqual(index.index, {'10': ['a'], '2': ['c'], '12': ['d']})
+        self.assertEqual(index.biggest_id, 12)
+        self.assertTrue(os.path.exists(self.data_dir + 'Index.snapshot'))
+        index.close()
@@ -19,7 +19,9 @@
 #
 
 import json
-from numpy import zeros
+from collections import OrderedDict
+from numpy import zeros, load, savez, array, ones, arange, repeat, diff, lexsort, bincount, cumsum, int32, float32
+from scipy.sparse import csr_matrix
 import sys
 
 
@@ -35,6 +37,72 @@ def saveToJson(path="", data="", verbose=True):
             print "Saving data to '" + path + "'"
         json.dump(data,f,indent=4)
 
+def saveSparseMatrix(path, M):
+    # Same format as scipy.sparse.save_npz (CSR) so files can also be loaded with scipy.sparse.load_npz
+    M = M.tocsr()
+    savez(path, data=M.data, indices=M.indices, indptr=M.indptr, format=array('csr'), shape=array(M.shape))
+
+def loadSparseMatrix(path):
+    with load(path) as npz:
+        return csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+
+def similarityToNeighborTables(sim_matrix, n):
+    '''
+    Computes, for every tag (row) of the similarity matrix, the ids and similarities of its n most similar tags
+    (excluding the tag itself) sorted by decreasing similarity. Returns two tags x n arrays (int32 ids and float32
+    similarities), rows of tags with less than n similar tags are padded with id -1 and similarity 0.
+    '''
+    sim_matrix = csr_matrix(sim_matrix)
+    n_tags = sim_matrix.shape[0]
+    rows = repeat(arange(n_tags, dtype=int32), diff(sim_matrix.indptr))
+    keep = (sim_matrix.indices != rows) & (sim_matrix.data != 0)
+    rows = rows[keep]
+    columns = sim_matrix.indices[keep]
+    data = sim_matrix.data[keep]
+
+    # Sort values by row and then by decreasing value, rank of each value in its row
+    order = lexsort((-data, rows))
+    row_counts = bincount(rows, minlength=n_tags)
+    row_starts = cumsum(row_counts) - row_counts
+    ranks = arange(len(order)) - row_starts[rows[order]]
+    order = order[ranks < n]
+    ranks = ranks[ranks < n]
+
+    neighbor_ids = -ones((n_tags, n), dtype=int32)
+    neighbor_scores = zeros((n_tags, n), dtype=float32)
+    neighbor_ids[rows[order], ranks] = columns[order]
+    neighbor_scores[rows[order], ranks] = data[order]
+    return neighbor_ids, neighbor_scores
+
+class LRUCache(object):
+    '''
+    Dictionary-like cache that keeps at most max_size items, discarding the least recently used ones.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def set(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
 def mtx2npy(M, verbose = True):
     n = M.shape[0]
     m = M.shape[1]
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+# Compares the time and memory needed to compute the data for the waveform and spectrogram images of a file column by
+# column (calling AudioProcessor.peaks and AudioProcessor.spectral_centroid for every column, as create_wave_images
+# used to do) and in a single pass with AudioProcessor.analyze. Each implementation runs in a separate process so
+# that its peak memory usage (RSS) can be measured.
+#
+# Example: python benchmark_wave_images.py --generate 3600 /tmp/long_file.wav
+
+from processing import AudioProcessor
+import numpy
+import optparse
+import os
+import struct
+import subprocess
+import sys
+import time
+import wave
+
+IMPLEMENTATIONS = ['column_by_column', 'single_pass']
+
+parser = optparse.OptionParser("usage: %prog [options] input-filename", conflict_handler="resolve")
+parser.add_option("-w", "--width", action="store", dest="image_width", type="int",
+                  help="image width in pixels (default %default)")
+parser.add_option("-f", "--fft", action="store", dest="fft_size", type="int",
+                  help="fft size, power of 2 for increased performance (default %default)")
+parser.add_option("-g", "--generate", action="store", dest="generate", type="int",
+                  help="generate a stereo 44.1kHz test file of this many seconds at input-filename before running "
+                       "the benchmark")
+parser.add_option("-i", "--implementation", action="store", dest="implementation", type="choice",
+                  choices=IMPLEMENTATIONS, help="only run this implementation in the current process")
+
+parser.set_defaults(image_width=900, fft_size=2048, generate=None, implementation=None)
+
+(options, args) = parser.parse_args()
+
+if len(args) != 1:
+    parser.print_help()
+    parser.error("wrong number of arguments")
+
+input_filename = args[0]
+
+
+def generate_test_file(filename, duration, samplerate=44100):
+    """ write a stereo 16 bit file with a sweep plus noise, one second at a time """
+    output = wave.open(filename, 'wb')
+    output.setnchannels(2)
+    output.setsampwidth(2)
+    output.setframerate(samplerate)
+    for second in range(duration):
+        t = numpy.arange(second * samplerate, (second + 1) * samplerate) / float(samplerate)
+        samples = 0.5 * numpy.sin(2 * numpy.pi * (100 + 10 * (second % 60)) * t) + \
+                  0.1 * (numpy.random.random(samplerate) * 2 - 1)
+        samples = (numpy.repeat(samples, 2) * 32767).astype(numpy.int16)
+        output.writeframes(struct.pack('<%ih' % len(samples), *samples))
+    output.close()
+
+
+def column_by_column(processor, image_width):
+    samples_per_pixel = processor.audio_file.nframes / float(image_width)
+    for x in range(image_width):
+        seek_point = int(x * samples_per_pixel)
+        next_seek_point = int((x + 1) * samples_per_pixel)
+        processor.spectral_centroid(seek_point)
+        processor.peaks(seek_point, next_seek_point)
+
+
+def single_pass(processor, image_width):
+    processor.analyze(image_width)
+
+
+if options.implementation:
+    processor = AudioProcessor(input_filename, options.fft_size, numpy.hanning)
+    globals()[options.implementation](processor, options.image_width)
+    sys.exit(0)
+
+if options.generate:
+    print "generating %i seconds test file %s" % (options.generate, input_filename)
+    generate_test_file(input_filename, options.generate)
+
+for implementation in IMPLEMENTATIONS:
+    start = time.time()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--implementation", implementation,
+                                "--width", str(options.image_width), "--fft", str(options.fft_size), input_filename])
+    pid, status, rusage = os.wait4(process.pid, 0)
+    if status != 0:
+        print "%s: failed with status %i" % (implementation, status)
+        continue
+    print "%s: %.2f seconds, %.1f MB peak RSS" % (implementation, time.time() - start, rusage.ru_maxrss / 1024.0)
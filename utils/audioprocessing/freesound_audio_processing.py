@@ -204,11 +204,13 @@ def process(sound):
         return False
     success("created previews, medium")
 
-    # create waveform images L
+    # create waveform images L and the multi-resolution peaks file (computed while reading the file for the images)
     waveform_path_l = sound.locations("display.wave.L.path")
     spectral_path_l = sound.locations("display.spectral.L.path")
+    peaks_path = sound.locations("display.peaks.path")
     try:
-        audioprocessing.create_wave_images(tmp_wavefile2, waveform_path_l, spectral_path_l, 900, 201, 2048)
+        audioprocessing.create_wave_images(tmp_wavefile2, waveform_path_l, spectral_path_l, 900, 201, 2048,
+                                           output_filename_peaks=peaks_path)
     except AudioProcessingException as e:
         cleanup(to_cleanup)
         failure("creation of images (L) has failed", e)
@@ -21,13 +21,14 @@
 #
 
 from __future__ import print_function
-from PIL import Image, ImageDraw
+from PIL import Image
 from color_schemes import COLOR_SCHEMES, DEFAULT_COLOR_SCHEME_KEY
 import math
 import numpy
 import os
 import re
 import signal
+import struct
 import subprocess
 try:
     from utils.audioprocessing import get_sound_type
@@ -105,9 +106,12 @@ class AudioProcessor(object):
     The audio processor processes chunks of audio an calculates the spectrac centroid and the peak
     samples in that chunk of audio.
     """
-    def __init__(self, input_filename, fft_size, window_function=numpy.hanning):
-        max_level = get_max_level(input_filename)
 
+    # number of samples read at once when processing the whole file in a single pass (see AudioProcessor.analyze)
+    block_size = 2 ** 20
+
+    def __init__(self, input_filename, fft_size, window_function=numpy.hanning):
+        self.input_filename = input_filename
         self.audio_file = audiolab.Sndfile(input_filename, 'r')
         self.fft_size = fft_size
         self.window = window_function(self.fft_size)
@@ -120,9 +124,17 @@ class AudioProcessor(object):
 
         # figure out what the maximum value is for an FFT doing the FFT of a DC signal
         fft = numpy.fft.rfft(numpy.ones(fft_size) * self.window)
-        max_fft = (numpy.abs(fft)).max()
-        # set the scale to normalized audio and normalized FFT
-        self.scale = 1.0/max_level/max_fft if max_level > 0 else 1
+        self.max_fft = (numpy.abs(fft)).max()
+        self._scale = None
+
+    @property
+    def scale(self):
+        """ scale to normalized audio and normalized FFT, only needed (and computed) when processing column by
+        column with spectral_centroid as analyze already finds the maximum level while reading the file """
+        if self._scale is None:
+            max_level = get_max_level(self.input_filename)
+            self._scale = 1.0/max_level/self.max_fft if max_level > 0 else 1
+        return self._scale
 
     def read(self, start, size, resize_if_less=False):
         """ read size samples starting at start, if resize_if_less is True and less than size
@@ -248,6 +260,226 @@ class AudioProcessor(object):
 
         return (min_value, max_value) if min_index < max_index else (max_value, min_value)
 
+    def analyze(self, image_width, spec_range=110.0, progress_callback=None, progress_callback_steps=10,
+                samples_callback=None):
+        """ compute the peaks, spectral centroid and spectrum of every column of an image of image_width pixels
+        reading the audio file only once. The result is the same as calling peaks and spectral_centroid for every
+        column, but the file is read sequentially in blocks of about block_size samples, the peaks of each column are
+        found on slices of the block and the FFTs of all the columns of a block are computed at once. Returns
+        (peaks, spectral_centroids, db_spectra) arrays of shapes (image_width, 2), (image_width,) and
+        (image_width, fft_size/2 + 1). If given, samples_callback is called with every new block of samples
+        read from the file (see BlockReader). """
+
+        half_fft_size = self.fft_size / 2
+        samples_per_pixel = self.audio_file.nframes / float(image_width)
+        seek_points = (numpy.arange(image_width + 1) * samples_per_pixel).astype(numpy.int64)
+        # columns with no samples get the value of the sample at their seek point as peaks
+        peak_starts = seek_points[:-1]
+        peak_ends = numpy.maximum(seek_points[1:], peak_starts + 1)
+
+        # limit the number of columns per block so that neither the samples nor the fft frames of a block are much
+        # bigger than block_size
+        columns_per_block = max(1, min(int(self.block_size / max(samples_per_pixel, 1)),
+                                       self.block_size / self.fft_size))
+        if progress_callback:
+            columns_per_block = min(columns_per_block, max(1, image_width / progress_callback_steps))
+
+        peaks = numpy.zeros((image_width, 2))
+        spectra = numpy.zeros((image_width, half_fft_size + 1))
+        reader = BlockReader(self.audio_file, samples_callback)
+        next_progress = 0
+
+        for first in range(0, image_width, columns_per_block):
+            last = min(first + columns_per_block, image_width)
+
+            if progress_callback:
+                percentage = (first * 100) / image_width
+                if percentage >= next_progress:
+                    progress_callback(percentage)
+                    next_progress = percentage + 100 / progress_callback_steps
+
+            block_start = peak_starts[first] - half_fft_size
+            block_end = max(peak_ends[last - 1], peak_starts[last - 1] - half_fft_size + self.fft_size)
+            samples = reader.read(block_start, block_end)
+
+            # the first FFT window of each column is centered around its seek point
+            frame_starts = peak_starts[first:last] - half_fft_size - block_start
+            frames = samples[frame_starts[:, numpy.newaxis] + numpy.arange(self.fft_size)]
+            spectra[first:last] = numpy.abs(numpy.fft.rfft(frames * self.window, axis=1))
+
+            # min and max of each column, in the order they were found. Columns are slices (not copies) of the block
+            # and have different lengths, so this is faster than padding them to a 2d array
+            for x in range(first, last):
+                column_samples = samples[peak_starts[x] - block_start:peak_ends[x] - block_start]
+                max_index = numpy.argmax(column_samples)
+                min_index = numpy.argmin(column_samples)
+                if min_index < max_index:
+                    peaks[x] = (column_samples[min_index], column_samples[max_index])
+                else:
+                    peaks[x] = (column_samples[max_index], column_samples[min_index])
+
+        # normalized abs(FFT) between 0 and 1, the max level is known now that the whole file has been read
+        spectra *= 1.0/reader.max_level/self.max_fft if reader.max_level > 0 else 1
+
+        # scale the db spectrum from [- spec_range db ... 0 db] > [0..1]
+        db_spectra = ((20*(numpy.log10(spectra + 1e-60))).clip(-spec_range, 0.0) + spec_range)/spec_range
+
+        # spectral centroids: clip > log10 > scale between 0 and 1 (0 for columns without energy)
+        length = numpy.float64(spectra.shape[1])
+        energy = spectra.sum(axis=1)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            spectral_centroids = spectra.dot(numpy.arange(length)) / (energy * (length - 1)) * \
+                                 self.audio_file.samplerate * 0.5
+            spectral_centroids = (numpy.log10(spectral_centroids.clip(self.lower, self.higher)) - self.lower_log) / \
+                                 (self.higher_log - self.lower_log)
+        spectral_centroids[~(energy > 1e-60)] = 0
+
+        return peaks, spectral_centroids, db_spectra
+
+
+class BlockReader(object):
+    """
+    Reads the left channel of an audio file from start to end, only once, and returns the samples of consecutive
+    (possibly overlapping) ranges. Ranges must be requested with non-decreasing start positions so that samples
+    before the current range can be discarded. Parts of a range outside the file are filled with zeros. The maximum
+    absolute value of the samples read is kept in max_level, and samples_callback (if given) is called with all the
+    samples of the file, in order and only once, as they are read.
+    """
+    def __init__(self, audio_file, samples_callback=None):
+        self.audio_file = audio_file
+        self.samples_callback = samples_callback
+        self.nframes = audio_file.nframes
+        self.buffer = numpy.zeros(0)
+        self.buffer_start = 0
+        self.position = 0
+        self.max_level = 0
+
+    def read(self, start, end):
+        # samples before start won't be requested anymore
+        drop = min(max(start, 0), self.position) - self.buffer_start
+        if drop > 0:
+            self.buffer = self.buffer[drop:]
+            self.buffer_start += drop
+
+        to_read = min(end, self.nframes) - self.position
+        if to_read > 0:
+            try:
+                samples = self.audio_file.read_frames(to_read)
+            except RuntimeError:
+                # this can happen for wave files with broken headers, consider the file ends here
+                self.nframes = self.position
+            else:
+                # convert to mono by selecting left channel only
+                if self.audio_file.channels > 1:
+                    samples = samples[:,0]
+                if len(samples):
+                    self.max_level = max(self.max_level, numpy.abs(samples).max())
+                    if self.samples_callback:
+                        self.samples_callback(samples)
+                self.buffer = numpy.concatenate((self.buffer, samples))
+                self.position += len(samples)
+
+        if start >= self.position:
+            return numpy.zeros(end - start)
+        lower = max(start, 0)
+        upper = min(end, self.position)
+        samples = self.buffer[lower - self.buffer_start:upper - self.buffer_start]
+        if lower > start or upper < end:
+            samples = numpy.concatenate((numpy.zeros(lower - start), samples, numpy.zeros(end - upper)))
+        return samples
+
+
+class MultiResolutionPeaks(object):
+    """
+    Computes the min and max peaks of an audio file at several resolutions (samples per pixel) from all its samples,
+    given in consecutive blocks of any size to add_samples, and saves them to a compact binary peaks file which
+    players can use to draw and zoom the waveform without decoding the audio. Peaks files contain (little endian):
+      - header: 'FSPK', version (uint8), number of levels (uint8), samplerate (uint32), number of samples (uint64)
+      - for each level: samples per pixel (uint32) and number of pixels (uint32)
+      - for each level: (min, max) pairs of every pixel as int8 (sample value * 127)
+    """
+    MAGIC = 'FSPK'
+    VERSION = 1
+
+    # each level must be a multiple of the previous one as levels are computed from the first one
+    DEFAULT_SAMPLES_PER_PIXEL = (256, 1024, 4096, 16384, 65536)
+
+    def __init__(self, samples_per_pixel=DEFAULT_SAMPLES_PER_PIXEL):
+        self.samples_per_pixel = samples_per_pixel
+        self.num_samples = 0
+        self.min_values = []
+        self.max_values = []
+        self.remainder = numpy.zeros(0)
+
+    def add_samples(self, samples):
+        block_size = self.samples_per_pixel[0]
+        self.num_samples += len(samples)
+
+        # complete the last pixel of the previous block
+        if len(self.remainder):
+            to_complete = block_size - len(self.remainder)
+            first_pixel = numpy.concatenate((self.remainder, samples[:to_complete]))
+            samples = samples[to_complete:]
+            if len(first_pixel) < block_size:
+                self.remainder = first_pixel
+                return
+            self.min_values.append(numpy.array([first_pixel.min()]))
+            self.max_values.append(numpy.array([first_pixel.max()]))
+
+        num_pixels = len(samples) / block_size
+        pixels = samples[:num_pixels * block_size].reshape((num_pixels, block_size))
+        self.min_values.append(pixels.min(axis=1))
+        self.max_values.append(pixels.max(axis=1))
+        self.remainder = samples[num_pixels * block_size:].copy()
+
+    def get_levels(self):
+        """ returns a list with (samples_per_pixel, min_values, max_values) for every level, the last pixel of each
+        level may be computed with less samples """
+        min_values = self.min_values + ([numpy.array([self.remainder.min()])] if len(self.remainder) else [])
+        max_values = self.max_values + ([numpy.array([self.remainder.max()])] if len(self.remainder) else [])
+        min_values = numpy.concatenate(min_values) if min_values else numpy.zeros(0)
+        max_values = numpy.concatenate(max_values) if max_values else numpy.zeros(0)
+
+        levels = [(self.samples_per_pixel[0], min_values, max_values)]
+        for samples_per_pixel in self.samples_per_pixel[1:]:
+            previous_samples_per_pixel, min_values, max_values = levels[-1]
+            if len(min_values):
+                indices = numpy.arange(0, len(min_values), samples_per_pixel / previous_samples_per_pixel)
+                min_values = numpy.minimum.reduceat(min_values, indices)
+                max_values = numpy.maximum.reduceat(max_values, indices)
+            levels.append((samples_per_pixel, min_values, max_values))
+        return levels
+
+    def save(self, filename, samplerate):
+        levels = self.get_levels()
+        with open(filename, 'wb') as f:
+            f.write(struct.pack('<4sBBIQ', self.MAGIC, self.VERSION, len(levels), samplerate, self.num_samples))
+            for samples_per_pixel, min_values, max_values in levels:
+                f.write(struct.pack('<II', samples_per_pixel, len(min_values)))
+            for samples_per_pixel, min_values, max_values in levels:
+                values = numpy.column_stack((min_values, max_values)) if len(min_values) else numpy.zeros(0)
+                f.write(numpy.round(numpy.clip(values, -1, 1) * 127).astype(numpy.int8).tostring())
+
+
+def read_peaks_file(filename):
+    """ read a peaks file written by MultiResolutionPeaks, returns a dictionary with the samplerate, number of
+    samples and levels (list of (samples_per_pixel, peaks) with peaks as an int8 array of (min, max) pairs) """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    header_size = struct.calcsize('<4sBBIQ')
+    magic, version, num_levels, samplerate, num_samples = struct.unpack('<4sBBIQ', data[:header_size])
+    if magic != MultiResolutionPeaks.MAGIC or version != MultiResolutionPeaks.VERSION:
+        raise AudioProcessingException("%s is not a valid peaks file" % filename)
+
+    levels = []
+    offset = header_size + num_levels * struct.calcsize('<II')
+    for i in range(num_levels):
+        samples_per_pixel, num_pixels = struct.unpack_from('<II', data, header_size + i * struct.calcsize('<II'))
+        peaks = numpy.frombuffer(data, dtype=numpy.int8, count=num_pixels * 2, offset=offset).reshape((num_pixels, 2))
+        levels.append((samples_per_pixel, peaks))
+        offset += num_pixels * 2
+    return dict(samplerate=samplerate, num_samples=num_samples, levels=levels)
+
 
 def interpolate_colors(colors, flat=False, num_colors=256):
     """ given a list of colors, create a larger list of colors interpolating
@@ -282,7 +514,8 @@ def interpolate_colors(colors, flat=False, num_colors=256):
 class WaveformImage(object):
     """
     Given peaks and spectral centroids from the AudioProcessor, this class will construct
-    a wavefile image which can be saved as PNG.
+    a wavefile image which can be saved as PNG. The image is rendered into a numpy array
+    (rows x columns x RGB) which is only converted to a PIL image when saving.
     """
     def __init__(self, image_width, image_height, color_scheme):
         if image_height % 2 == 0:
@@ -292,88 +525,105 @@ class WaveformImage(object):
         background_color = waveform_colors[0]
         colors = waveform_colors[1:]
 
-        self.image = Image.new("RGB", (image_width, image_height), background_color)
-
         self.image_width = image_width
         self.image_height = image_height
 
-        self.draw = ImageDraw.Draw(self.image)
-        self.previous_x, self.previous_y = None, None
-
-        self.color_lookup = interpolate_colors(colors)
-        self.pix = self.image.load()
-
-    def draw_peaks(self, x, peaks, spectral_centroid):
-        """ draw 2 peaks at x using the spectral_centroid for color """
-
-        y1 = self.image_height * 0.5 - peaks[0] * (self.image_height - 4) * 0.5
-        y2 = self.image_height * 0.5 - peaks[1] * (self.image_height - 4) * 0.5
-
-        line_color = self.color_lookup[int(spectral_centroid*255.0)]
-
-        if self.previous_y != None:
-            self.draw.line([self.previous_x, self.previous_y, x, y1, x, y2], line_color)
-        else:
-            self.draw.line([x, y1, x, y2], line_color)
-
-        self.previous_x, self.previous_y = x, y2
-
-        self.draw_anti_aliased_pixels(x, y1, y2, line_color)
-
-    def draw_anti_aliased_pixels(self, x, y1, y2, color):
-        """ vertical anti-aliasing at y1 and y2 """
-
-        y_max = max(y1, y2)
-        y_max_int = int(y_max)
+        self.background_color = numpy.array(background_color, dtype=numpy.uint8)
+        self.pixels = numpy.empty((image_height, image_width, 3), dtype=numpy.uint8)
+        self.pixels[:, :] = self.background_color
+
+        self.color_lookup = numpy.array(interpolate_colors(colors), dtype=numpy.uint8)
+
+    def draw_peaks(self, peaks, spectral_centroids):
+        """ draw the 2 peaks of every column (peaks is an array of shape (image_width, 2)) using the
+        spectral centroids for color. Each column is a vertical line between its peaks joined to the
+        last peak of the previous column, the same lines PIL draws for [previous_x, previous_y, x, y1, x, y2] """
+
+        rows = numpy.arange(self.image_height)[:, numpy.newaxis]
+        y1 = self.image_height * 0.5 - peaks[:, 0] * (self.image_height - 4) * 0.5
+        y2 = self.image_height * 0.5 - peaks[:, 1] * (self.image_height - 4) * 0.5
+        line_colors = self.color_lookup[(spectral_centroids * 255.0).astype(int)]
+
+        # PIL truncates the coordinates of lines to integers
+        y1_int = y1.astype(int)
+        y2_int = y2.astype(int)
+
+        # the line joining the last peak of the previous column with the first peak of a column (drawn with the color
+        # of the column) takes the first half of its pixels in the previous column and the second half in the column
+        previous_y = numpy.append(y1_int[:1], y2_int[:-1])
+        direction = numpy.where(y1_int >= previous_y, 1, -1)
+        join_length = numpy.abs(y1_int - previous_y) + 1
+        join_length_previous = numpy.maximum(1, join_length // 2)
+        join_length_current = numpy.maximum(1, join_length - join_length_previous)
+        join_start = y1_int - direction * (join_length_current - 1)
+
+        # vertical line of each column, from the join to both peaks
+        line_min = numpy.minimum(numpy.minimum(y1_int, y2_int), join_start)
+        line_max = numpy.maximum(numpy.maximum(y1_int, y2_int), join_start)
+        line_mask = (rows >= line_min) & (rows <= line_max)
+        self.pixels = numpy.where(line_mask[:, :, numpy.newaxis], line_colors, self.pixels)
+
+        self.draw_anti_aliased_pixels(y1, y2, line_min, line_max, line_colors)
+
+        # the first half of the joining lines is drawn over the previous column (and its anti-aliased pixels)
+        previous_end = previous_y + direction * (join_length_previous - 1)
+        previous_mask = (rows >= numpy.minimum(previous_y, previous_end)) & \
+                        (rows <= numpy.maximum(previous_y, previous_end))
+        self.pixels[:, :-1] = numpy.where(previous_mask[:, 1:, numpy.newaxis], line_colors[1:], self.pixels[:, :-1])
+
+    def draw_anti_aliased_pixels(self, y1, y2, line_min, line_max, colors):
+        """ vertical anti-aliasing at y1 and y2 of every column, blending the color of the line with the
+        pixels after both ends of the line (line_min, line_max) """
+
+        columns = numpy.arange(self.image_width)
+
+        y_max = numpy.maximum(y1, y2)
+        y_max_int = y_max.astype(int)
         alpha = y_max - y_max_int
+        self.blend_pixels(columns, y_max_int + 1, alpha, line_min, line_max, colors)
 
-        if alpha > 0.0 and alpha < 1.0 and y_max_int + 1 < self.image_height:
-            current_pix = self.pix[x, y_max_int + 1]
-
-            r = int((1-alpha)*current_pix[0] + alpha*color[0])
-            g = int((1-alpha)*current_pix[1] + alpha*color[1])
-            b = int((1-alpha)*current_pix[2] + alpha*color[2])
-
-            self.pix[x, y_max_int + 1] = (r,g,b)
-
-        y_min = min(y1, y2)
-        y_min_int = int(y_min)
+        y_min = numpy.minimum(y1, y2)
+        y_min_int = y_min.astype(int)
         alpha = 1.0 - (y_min - y_min_int)
+        self.blend_pixels(columns, y_min_int - 1, alpha, line_min, line_max, colors)
 
-        if alpha > 0.0 and alpha < 1.0 and y_min_int - 1 >= 0:
-            current_pix = self.pix[x, y_min_int - 1]
+    def blend_pixels(self, columns, rows, alpha, line_min, line_max, colors):
+        valid = (alpha > 0.0) & (alpha < 1.0) & (rows >= 0) & (rows < self.image_height)
+        columns, rows, alpha = columns[valid], rows[valid], alpha[valid][:, numpy.newaxis]
+        colors = colors[valid]
 
-            r = int((1-alpha)*current_pix[0] + alpha*color[0])
-            g = int((1-alpha)*current_pix[1] + alpha*color[1])
-            b = int((1-alpha)*current_pix[2] + alpha*color[2])
+        # the current pixel is either part of the line of the column or the background
+        in_line = ((rows >= line_min[valid]) & (rows <= line_max[valid]))[:, numpy.newaxis]
+        current_pixels = numpy.where(in_line, colors, self.background_color)
 
-            self.pix[x, y_min_int - 1] = (r,g,b)
+        self.pixels[rows, columns] = ((1-alpha)*current_pixels + alpha*colors).astype(numpy.uint8)
 
     def save(self, filename):
         # draw a zero "zero" line
         a = 25
-        for x in range(self.image_width):
-            self.pix[x, self.image_height/2] = tuple(map(lambda p: p+a, self.pix[x, self.image_height/2]))
+        pixels = self.pixels.copy()
+        pixels[self.image_height/2] = numpy.minimum(pixels[self.image_height/2].astype(int) + a, 255)
 
-        self.image.save(filename)
+        Image.fromarray(pixels, "RGB").save(filename)
 
 
 class SpectrogramImage(object):
     """
     Given spectra from the AudioProcessor, this class will construct a wavefile image which
-    can be saved as PNG.
+    can be saved as PNG. The image is rendered into a numpy array (rows x columns x RGB) which
+    is only converted to a PIL image when saving.
     """
     def __init__(self, image_width, image_height, fft_size, color_scheme):
         self.image_width = image_width
         self.image_height = image_height
         self.fft_size = fft_size
 
-        self.image = Image.new("RGB", (image_height, image_width))
-        self.palette = interpolate_colors(COLOR_SCHEMES.get(color_scheme,
-                                                            COLOR_SCHEMES[DEFAULT_COLOR_SCHEME_KEY])['spec_colors'])
+        self.palette = numpy.array(interpolate_colors(COLOR_SCHEMES.get(color_scheme,
+                                                      COLOR_SCHEMES[DEFAULT_COLOR_SCHEME_KEY])['spec_colors']),
+                                   dtype=numpy.uint8)
 
         # generate the lookup which translates y-coordinate to fft-bin
-        self.y_to_bin = []
+        y_to_bin = []
         f_min = 100.0
         f_max = 22050.0
         y_min = math.log10(f_min)
@@ -385,30 +635,31 @@ class SpectrogramImage(object):
             if bin < self.fft_size/2:
                 alpha = bin - int(bin)
 
-                self.y_to_bin.append((int(bin), alpha * 255))
+                y_to_bin.append((int(bin), alpha * 255))
 
-        # this is a bit strange, but using image.load()[x,y] = ... is
-        # a lot slower than using image.putadata and then rotating the image
-        # so we store all the pixels in an array and then create the image when saving
-        self.pixels = []
+        self.y_to_bin_index = numpy.array([index for index, alpha in y_to_bin], dtype=int)
+        self.y_to_bin_alpha = numpy.array([alpha for index, alpha in y_to_bin])
 
-    def draw_spectrum(self, x, spectrum):
-        # for all frequencies, draw the pixels
-        for (index, alpha) in self.y_to_bin:
-            self.pixels.append(self.palette[int((255.0-alpha) * spectrum[index] + alpha * spectrum[index + 1])])
+        # if the FFT is too small to fill up the image, the top stays black
+        self.pixels = numpy.empty((image_height, image_width, 3), dtype=numpy.uint8)
+        self.pixels[:, :] = self.palette[0]
 
-        # if the FFT is too small to fill up the image, fill with black to the top
-        for y in range(len(self.y_to_bin), self.image_height):
-            self.pixels.append(self.palette[0])
+    def draw_spectra(self, spectra):
+        """ draw the spectra of every column (spectra is an array of shape (image_width, fft_size/2 + 1)),
+        low frequencies at the bottom of the image """
+        alpha = self.y_to_bin_alpha
+        values = ((255.0-alpha) * spectra[:, self.y_to_bin_index] + alpha * spectra[:, self.y_to_bin_index + 1])
+        rows = self.image_height - 1 - numpy.arange(len(self.y_to_bin_index))
+        self.pixels[rows] = self.palette[values.astype(int).T]
 
     def save(self, filename, quality=80):
         assert filename.lower().endswith(".jpg")
-        self.image.putdata(self.pixels)
-        self.image.transpose(Image.ROTATE_90).save(filename, quality=quality)
+        Image.fromarray(self.pixels, "RGB").save(filename, quality=quality)
 
 
 def create_wave_images(input_filename, output_filename_w, output_filename_s, image_width, image_height, fft_size,
-                       progress_callback=None, progress_callback_steps=10, color_scheme=None):
+                       progress_callback=None, progress_callback_steps=10, color_scheme=None,
+                       output_filename_peaks=None):
     """
     Utility function for creating both wavefile and spectrum images from an audio input file.
     :param input_filename: input audio filename (must be PCM)
@@ -420,26 +671,23 @@ def create_wave_images(input_filename, output_filename_w, output_filename_s, ima
     :param progress_callback: function to iteratively call while images are being created
     :param progress_callback_steps: number of times the progress_callback will be called until 100% progress is reached
     :param color_scheme: color scheme to use for the generated images (defaults to Freesound2 color scheme)
+    :param output_filename_peaks: if given, a multi-resolution peaks file is also written (see MultiResolutionPeaks),
+    computed while reading the file for the images
     """
     processor = AudioProcessor(input_filename, fft_size, numpy.hanning)
-    samples_per_pixel = processor.audio_file.nframes / float(image_width)
-
-    waveform = WaveformImage(image_width, image_height, color_scheme)
-    spectrogram = SpectrogramImage(image_width, image_height, fft_size, color_scheme)
+    multi_resolution_peaks = MultiResolutionPeaks() if output_filename_peaks else None
+    peaks, spectral_centroids, db_spectra = processor.analyze(
+        image_width, progress_callback=progress_callback, progress_callback_steps=progress_callback_steps,
+        samples_callback=multi_resolution_peaks.add_samples if multi_resolution_peaks else None)
 
-    for x in range(image_width):
+    if multi_resolution_peaks:
+        multi_resolution_peaks.save(output_filename_peaks, processor.audio_file.samplerate)
 
-        if progress_callback and x % (image_width/progress_callback_steps) == 0:
-            progress_callback((x*100)/image_width)
-
-        seek_point = int(x * samples_per_pixel)
-        next_seek_point = int((x + 1) * samples_per_pixel)
-
-        (spectral_centroid, db_spectrum) = processor.spectral_centroid(seek_point)
-        peaks = processor.peaks(seek_point, next_seek_point)
+    waveform = WaveformImage(image_width, image_height, color_scheme)
+    waveform.draw_peaks(peaks, spectral_centroids)
 
-        waveform.draw_peaks(x, peaks, spectral_centroid)
-        spectrogram.draw_spectrum(x, db_spectrum)
+    spectrogram = SpectrogramImage(image_width, image_height, fft_size, color_scheme)
+    spectrogram.draw_spectra(db_spectra)
 
     if progress_callback:
         progress_callback(100)
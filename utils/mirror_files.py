@@ -93,8 +93,8 @@ def copy_previews_to_mirror_locations(sound):
 
 def copy_displays_to_mirror_locations(sound):
     copy_files_to_mirror_locations(
-        sound, ['display.spectral.L.path', 'display.spectral.M.path', 'display.wave.L.path', 'display.wave.M.path'],
-        settings.DISPLAYS_PATH, settings.MIRROR_DISPLAYS)
+        sound, ['display.spectral.L.path', 'display.spectral.M.path', 'display.wave.L.path', 'display.wave.M.path',
+                'display.peaks.path'], settings.DISPLAYS_PATH, settings.MIRROR_DISPLAYS)
 
 
 def copy_analysis_to_mirror_locations(sound):
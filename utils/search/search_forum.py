@@ -18,12 +18,22 @@
 #     See AUTHORS file.
 #
 
-from solr import Solr, SolrException
+from solr import Solr, SolrException, SolrJsonResponseDecoder
 from django.conf import settings
 import logging
 
 logger = logging.getLogger("search")
 
+# Fields of the forum index holding dates (see forum/conf/schema.xml)
+SOLR_FORUM_DATE_FIELDS = ['thread_created', 'post_created']
+
+
+def get_forum_solr():
+    """Returns a Solr object for the forum index which decodes responses using the date fields of the schema.
+    """
+    return Solr(settings.SOLR_FORUM_URL, decoder=SolrJsonResponseDecoder(date_fields=SOLR_FORUM_DATE_FIELDS))
+
+
 def convert_to_solr_document(post):
     #logger.info("creating solr XML from forum post %d" % post.id)
     document = {}
@@ -18,23 +18,41 @@
 #     See AUTHORS file.
 #
 
+import hashlib
 import logging
 import math
 import random
 import socket
+import threading
+import time
+import urllib
 
 from django.conf import settings
+from django.core.cache import cache
 
 import sounds
 from search import forms
 from search.forms import SEARCH_SORT_OPTIONS_WEB
 from utils.search.solr import Solr, SolrQuery, SolrResponseInterpreter, SolrException, \
-    SolrResponseInterpreterPaginator
+    SolrResponseInterpreterPaginator, SolrJsonResponseDecoder, SolrJsonAddEncoder, Multidict
 from utils.text import remove_control_chars
 
 logger = logging.getLogger("search")
 console_logger = logging.getLogger("console")
 
+# Fields of the sounds index holding dates (see the "date" fields in fs2/conf/schema.xml). Only these fields are
+# converted to datetime objects when decoding Solr responses.
+SOLR_SOUNDS_DATE_FIELDS = ['created']
+
+
+def get_sounds_solr():
+    """Returns a Solr object for the sounds index which decodes responses using the date fields of the schema and
+    sends documents using Solr's JSON update format.
+    """
+    return Solr(settings.SOLR_URL,
+                encoder=SolrJsonAddEncoder(),
+                decoder=SolrJsonResponseDecoder(date_fields=SOLR_SOUNDS_DATE_FIELDS))
+
 
 def search_prepare_sort(sort, options):
     """ for ordering by rating order by rating, then by number of ratings """
@@ -147,13 +165,81 @@ def search_prepare_query(search_query,
     return query
 
 
+SOLR_QUERY_CACHE_GENERATION_KEY = 'solr-query-cache-generation'
+
+
+class SolrQueryCacheStats(object):
+    """Thread-safe hit/miss counters of the search results cache for the current process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def incr(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / total if total else 0.0,
+            }
+
+
+solr_query_cache_stats = SolrQueryCacheStats()
+
+
+def get_solr_query_cache_key(query):
+    """Returns the cache key for the results of a SolrQuery. The key only depends on the (non empty) parameters of the
+    query and not on the order in which they were set. Keys include a generation number which is increased every time
+    the index changes (see invalidate_solr_query_cache), so old results are never returned after an update.
+    """
+    params = urllib.urlencode(sorted(Multidict(query.params).items()))
+    generation = cache.get(SOLR_QUERY_CACHE_GENERATION_KEY)
+    if generation is None:
+        generation = 0
+        cache.add(SOLR_QUERY_CACHE_GENERATION_KEY, generation, None)
+    return 'solr-query-%s-%s' % (generation, hashlib.md5(params).hexdigest())
+
+
+def invalidate_solr_query_cache():
+    try:
+        cache.incr(SOLR_QUERY_CACHE_GENERATION_KEY)
+    except ValueError:
+        cache.set(SOLR_QUERY_CACHE_GENERATION_KEY, 1, None)
+
+
+def get_solr_results(query, use_cache=True):
+    """Performs a query to the sounds index and returns a SolrResponseInterpreter with the results. Results are cached
+    for settings.SEARCH_RESULTS_CACHE_TIMEOUT seconds so identical queries (e.g. paginating or clicking on the same
+    tag) do not hit Solr again.
+    """
+    use_cache = use_cache and settings.SEARCH_RESULTS_CACHE_TIMEOUT > 0
+    if use_cache:
+        cache_key = get_solr_query_cache_key(query)
+        results = cache.get(cache_key)
+        if results is not None:
+            solr_query_cache_stats.incr('hits')
+            return results
+        solr_query_cache_stats.incr('misses')
+
+    results = SolrResponseInterpreter(get_sounds_solr().select(unicode(query)))
+    if use_cache:
+        cache.set(cache_key, results, settings.SEARCH_RESULTS_CACHE_TIMEOUT)
+    return results
+
+
 def perform_solr_query(q, current_page):
     """
     This util function performs the query to SOLR and returns needed parameters to continue with the view.
     The main reason to have this util function is to facilitate mocking in unit tests for this view.
     """
-    solr = Solr(settings.SOLR_URL)
-    results = SolrResponseInterpreter(solr.select(unicode(q)))
+    results = get_solr_results(q)
     paginator = SolrResponseInterpreterPaginator(results, settings.SOUNDS_PER_PAGE)
     page = paginator.page(current_page)
     return results.non_grouped_number_of_matches, results.facets, paginator, page, results.docs
@@ -213,33 +299,79 @@ def convert_to_solr_document(sound):
 
 
 def add_sounds_to_solr(sounds):
-    solr = Solr(settings.SOLR_URL)
-    console_logger.info("creating XML")
+    solr = get_sounds_solr()
+    console_logger.info("creating documents")
     documents = [convert_to_solr_document(s) for s in sounds]
     console_logger.info("adding %d sounds to solr index" % len(documents))
     console_logger.info("posting to Solr")
     solr.add(documents)
 
 
-def add_all_sounds_to_solr(sound_queryset, slice_size=1000, mark_index_clean=False):
+class SolrAddThread(threading.Thread):
+    """Posts a batch of documents to Solr in the background so that the next batch can be fetched from the database
+    in the meantime. Exceptions raised while posting are re-raised when calling wait().
+    """
+
+    def __init__(self, solr, documents):
+        super(SolrAddThread, self).__init__()
+        self.daemon = True
+        self.solr = solr
+        self.documents = documents
+        self.exception = None
+
+    def run(self):
+        try:
+            self.solr.add(self.documents)
+        except Exception as e:
+            self.exception = e
+
+    def wait(self):
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+
+
+def add_all_sounds_to_solr(sound_queryset, slice_size=1000, mark_index_clean=False, pipelined=True):
+    """Indexes all sounds of sound_queryset in slices of slice_size sounds. If pipelined is True, the documents of
+    slice N+1 are fetched from the database while slice N is being posted to Solr.
+    """
+    solr = get_sounds_solr()
     num_correctly_indexed_sounds = 0
-    all_sound_ids = sound_queryset.values_list('id', flat=True).all()
+    all_sound_ids = list(sound_queryset.values_list('id', flat=True))
     n_slices = int(math.ceil(float(len(all_sound_ids))/slice_size))
-    for i in range(0, len(all_sound_ids), slice_size):
-        console_logger.info("Adding %i sounds to solr, slice %i of %i", slice_size, (i/slice_size) + 1, n_slices)
-        try:
-            sound_ids = all_sound_ids[i:i+slice_size]
-            sounds_qs = sounds.models.Sound.objects.bulk_query_solr(sound_ids)
-            add_sounds_to_solr(sounds_qs)
+    start_time = time.time()
 
-            if mark_index_clean:
-                console_logger.info("Marking sounds as clean.")
-                sounds.models.Sound.objects.filter(pk__in=sound_ids).update(is_index_dirty=False)
-            num_correctly_indexed_sounds += len(sound_ids)
-        except SolrException as e:
-            console_logger.error("failed to add sound batch to solr index, reason: %s", str(e))
-            raise
+    def finish_add(add_thread, sound_ids):
+        add_thread.wait()
+        if mark_index_clean:
+            console_logger.info("Marking sounds as clean.")
+            sounds.models.Sound.objects.filter(pk__in=sound_ids).update(is_index_dirty=False)
+        return len(sound_ids)
 
+    pending = None  # (SolrAddThread, sound_ids) of the slice currently being posted
+    try:
+        for i in range(0, len(all_sound_ids), slice_size):
+            console_logger.info("Adding %i sounds to solr, slice %i of %i", slice_size, (i/slice_size) + 1, n_slices)
+            sound_ids = all_sound_ids[i:i+slice_size]
+            documents = [convert_to_solr_document(s)
+                         for s in sounds.models.Sound.objects.bulk_query_solr(sound_ids)]
+            if pending is not None:
+                num_correctly_indexed_sounds += finish_add(*pending)
+            pending = (SolrAddThread(solr, documents), sound_ids)
+            pending[0].start()
+            if not pipelined:
+                num_correctly_indexed_sounds += finish_add(*pending)
+                pending = None
+        if pending is not None:
+            num_correctly_indexed_sounds += finish_add(*pending)
+    except SolrException as e:
+        console_logger.error("failed to add sound batch to solr index, reason: %s", str(e))
+        raise
+
+    invalidate_solr_query_cache()
+    elapsed = time.time() - start_time
+    console_logger.info("Indexed %i sounds in %.2f seconds (%.2f sounds/sec)", num_correctly_indexed_sounds, elapsed,
+                        num_correctly_indexed_sounds / elapsed if elapsed else 0)
     return num_correctly_indexed_sounds
 
 
@@ -247,7 +379,7 @@ def get_all_sound_ids_from_solr(limit=False):
     logger.info("getting all sound ids from solr.")
     if not limit:
         limit = 99999999999999
-    solr = Solr(settings.SOLR_URL)
+    solr = get_sounds_solr()
     solr_ids = []
     solr_count = None
     PAGE_SIZE = 2000
@@ -264,7 +396,7 @@ def get_all_sound_ids_from_solr(limit=False):
 
 
 def check_if_sound_exists_in_solr(sound):
-    solr = Solr(settings.SOLR_URL)
+    solr = get_sounds_solr()
     response = SolrResponseInterpreter(
         solr.select(unicode(search_prepare_query(
             '', 'id:%i' % sound.id, search_prepare_sort('created asc', SEARCH_SORT_OPTIONS_WEB), 1, 1))))
@@ -276,7 +408,7 @@ def get_random_sound_from_solr():
     This is used for random sound browsing. We filter explicit sounds,
     but otherwise don't have any other restrictions on sound attributes
     """
-    solr = Solr(settings.SOLR_URL)
+    solr = get_sounds_solr()
     query = SolrQuery()
     rand_key = random.randint(1, 10000000)
     sort = ['random_%d asc' % rand_key]
@@ -296,6 +428,7 @@ def get_random_sound_from_solr():
 def delete_sound_from_solr(sound_id):
     logger.info("deleting sound with id %d" % sound_id)
     try:
-        Solr(settings.SOLR_URL).delete_by_id(sound_id)
+        get_sounds_solr().delete_by_id(sound_id)
+        invalidate_solr_query_cache()
     except (SolrException, socket.error) as e:
         logger.error('could not delete sound with id %s (%s).' % (sound_id, e))
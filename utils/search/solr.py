@@ -25,8 +25,25 @@ from time import strptime
 from xml.etree import cElementTree as ET
 import itertools, re, urllib
 import httplib, urlparse
+import json
+import select
+import socket
+import threading
+import time
 import cjson
 from socket import error
+
+
+# Default settings for the process-wide Solr connection pools (see SolrConnectionPool)
+DEFAULT_POOL_MAX_SIZE = 10
+DEFAULT_TIMEOUT = 30
+
+# Select queries with longer query strings are sent as POST requests to avoid hitting URL length limits
+MAX_GET_QUERY_LENGTH = 4000
+
+# Streamed (chunked) request bodies are buffered up to this size before being written to the socket
+STREAMING_CHUNK_SIZE = 64 * 1024
+
 class Multidict(dict):
     """A dictionary that represents a query string. If values in the dics are tuples, they are expanded.
     None values are skipped and all values are utf-encoded. We need this because in solr, we can have multiple
@@ -301,6 +318,8 @@ class BaseSolrAddEncoder(object):
     >>> encoder.encode([{"id": 5, "name": "guido", "tag":["python", "coder"], "status":"bdfl"}])
     '<add><doc><field name="status">bdfl</field><field name="tag">python</field><field name="tag">coder</field><field name="id">5</field><field name="name">guido</field></doc></add>'
     """
+    content_type = 'text/xml'
+
     def encode(self, docs):
         """Encodes a document as an XML tree. this particular one takes a dictionary and
         translates the key value pairs to <field name="key">value<f/field>
@@ -343,23 +362,114 @@ class BaseSolrAddEncoder(object):
 
 
 
+class SolrJsonAddEncoder(BaseSolrAddEncoder):
+    """Encodes documents for Solr's JSON update handler. Unlike BaseSolrAddEncoder, documents can be encoded
+    incrementally with iter_encode, so the request body can be streamed to Solr while it is being generated without
+    ever building the whole message in memory.
+
+    >>> encoder = SolrJsonAddEncoder()
+    >>> encoder.encode([{"id": 5, "tag":["python", "coder"], "created": datetime(2010, 1, 1), "is_remix": False}])
+    '[{"created":"2010-01-01T00:00:00.000Z","id":5,"is_remix":false,"tag":["python","coder"]}]'
+    """
+    content_type = 'application/json'
+
+    def __init__(self):
+        self.json_encoder = json.JSONEncoder(default=self._encode_value, separators=(',', ':'), sort_keys=True)
+
+    def _encode_value(self, value):
+        """Converts python values not natively supported by JSON to a form suitable for Solr.
+        """
+        if isinstance(value, datetime):
+            return value.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        elif isinstance(value, date):
+            return value.strftime('%Y-%m-%dT00:00:00.000Z')
+        return unicode(value)
+
+    def iter_encode(self, docs):
+        """Generator that yields the encoded message in pieces, one per document.
+        """
+        yield '['
+        for index, doc in enumerate(docs):
+            if index > 0:
+                yield ','
+            yield self.json_encoder.encode(doc)
+        yield ']'
+
+    def encode(self, docs):
+        return ''.join(self.iter_encode(docs))
+
+
 class SolrResponseDecoderException(Exception):
     pass
 
 
 class BaseSolrResponseDecoder(object):
-    """The BaseSolrResponseDecoder takes the Response object from urllib2 and decodes it"""
+    """The BaseSolrResponseDecoder takes the raw body of a Solr response and decodes it"""
 
 
 class SolrJsonResponseDecoder(BaseSolrResponseDecoder):
 
-    def __init__(self):
+    def __init__(self, date_fields=None, field_list=None):
+        """Creates a decoder for JSON responses
+        date_fields: names of the schema fields that hold dates, e.g. ['created']. If given, only these fields of the
+                     returned documents are converted to datetime objects and the rest of the response (facets,
+                     highlighting, params...) is not inspected. If None, every string in the response is checked
+                     against a date regex, which dominates decoding time for big responses.
+        field_list: if given, fields of the returned documents which are not in this list are dropped
+        """
         # matches returned dates in JSON strings
         self.date_match = re.compile("-?\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d\.?\d*[a-zA-Z]*")
+        self.date_fields = date_fields
+        self.field_list = set(field_list) if field_list and '*' not in field_list else None
+
+    def decode(self, raw_response):
+        #return self._decode_dates(json.loads(raw_response))
+        response = cjson.decode(unicode(raw_response, 'utf-8')) #@UndefinedVariable
+        if self.date_fields is None:
+            response = self._decode_dates(response)
+            if self.field_list is None:
+                return response
+        for docs in self._iter_docs(response):
+            self._decode_docs(docs)
+        return response
 
-    def decode(self, response_object):
-        #return self._decode_dates(json.load(response_object))
-        return self._decode_dates(cjson.decode(unicode(response_object.read(),'utf-8'))) #@UndefinedVariable
+    def _iter_docs(self, response):
+        """Yields all the lists of documents of a response, including the ones inside groups.
+        """
+        if "response" in response:
+            yield response["response"]["docs"]
+        for grouped in response.get("grouped", {}).values():
+            if "groups" in grouped:
+                for group in grouped["groups"]:
+                    yield group["doclist"]["docs"]
+            elif "doclist" in grouped:
+                yield grouped["doclist"]["docs"]
+
+    def _decode_docs(self, docs):
+        """Drops the fields not in self.field_list and converts self.date_fields of a list of documents.
+        """
+        for doc in docs:
+            if self.field_list is not None:
+                for key in doc.keys():
+                    if key not in self.field_list:
+                        del doc[key]
+            if self.date_fields is not None:
+                for key in self.date_fields:
+                    value = doc.get(key)
+                    if value is None:
+                        continue
+                    if isinstance(value, list):
+                        doc[key] = [self._parse_date(v) for v in value]
+                    else:
+                        doc[key] = self._parse_date(value)
+
+    def _parse_date(self, d):
+        """Converts a Solr date string (e.g. 2010-01-01T10:30:00.123Z) to a datetime object. Faster than strptime.
+        """
+        try:
+            return datetime(int(d[0:4]), int(d[5:7]), int(d[8:10]), int(d[11:13]), int(d[14:16]), int(d[17:19]))
+        except (ValueError, TypeError):
+            raise SolrResponseDecoderException, u"Response object has unknown date format: %s" % d
 
     def _decode_dates(self, d):
         """Recursively decode date strings to datetime objects.
@@ -383,8 +493,209 @@ class SolrException(Exception):
     pass
 
 
+class SolrConnectionPoolStats(object):
+    """Thread-safe counters for a SolrConnectionPool. 'hits' counts requests served by an already open (keep-alive)
+    connection, 'misses' counts requests that had to open a new connection, 'dropped' counts idle connections found
+    closed by the server before being used and 'reconnects' counts requests retried because a pooled connection had
+    been closed by the server while sending them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.hits = 0
+            self.misses = 0
+            self.reconnects = 0
+            self.dropped = 0
+            self.errors = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+
+    def incr(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def record_request(self, elapsed):
+        with self._lock:
+            self.requests += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'avg_time_ms': 1000.0 * self.total_time / self.requests if self.requests else 0.0,
+                'max_time_ms': 1000.0 * self.max_time,
+            }
+
+
+class SolrConnectionPool(object):
+    """A bounded, thread-safe pool of keep-alive HTTP connections to a single Solr host.
+    At most max_size connections are in use at the same time; if all of them are busy, callers wait up to
+    timeout seconds for one to be released. Idle connections are reused (LIFO) and, if the server closed them in
+    the meantime, the request is transparently retried once on a fresh connection. Request bodies can also be
+    iterables of strings, in which case they are streamed using chunked transfer encoding (and not retried).
+    """
+
+    def __init__(self, host, port, max_size=DEFAULT_POOL_MAX_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.timeout = timeout
+        self.stats = SolrConnectionPoolStats()
+        self._idle = []
+        self._in_use = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def _new_connection(self, timeout):
+        self.stats.incr('misses')
+        return httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _acquire(self, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while not self._idle and self._in_use >= self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SolrException, "timed out waiting for a connection to %s:%s" % (self.host, self.port)
+                self._condition.wait(remaining)
+            self._in_use += 1
+            while self._idle:
+                conn = self._idle.pop()
+                if not self._is_connection_dropped(conn):
+                    self.stats.incr('hits')
+                    return conn, True
+                self.stats.incr('dropped')
+                conn.close()
+        return self._new_connection(timeout), False
+
+    def _is_connection_dropped(self, conn):
+        # An idle keep-alive socket only becomes readable if the server closed it (or sent garbage)
+        if conn.sock is None:
+            return False
+        try:
+            return bool(select.select([conn.sock], [], [], 0.0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _release(self, conn, reusable=True):
+        with self._condition:
+            self._in_use -= 1
+            if reusable and len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                conn = None
+            self._condition.notify()
+        if conn is not None:
+            conn.close()
+
+    def _send(self, conn, method, path, body, headers, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        if body is None or isinstance(body, basestring):
+            conn.request(method, path, body, headers)
+        else:
+            self._send_chunked(conn, method, path, body, headers)
+        response = conn.getresponse()
+        # The whole body must be consumed before the connection can be used for the next request
+        return response, response.read()
+
+    def _send_chunked(self, conn, method, path, body, headers):
+        conn.putrequest(method, path, skip_accept_encoding=True)
+        for header, value in headers.items():
+            conn.putheader(header, value)
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        buf = []
+        buf_size = 0
+        for piece in body:
+            if isinstance(piece, unicode):
+                piece = piece.encode('utf-8')
+            buf.append(piece)
+            buf_size += len(piece)
+            if buf_size >= STREAMING_CHUNK_SIZE:
+                conn.send('%x\r\n%s\r\n' % (buf_size, ''.join(buf)))
+                buf = []
+                buf_size = 0
+        if buf_size:
+            conn.send('%x\r\n%s\r\n' % (buf_size, ''.join(buf)))
+        conn.send('0\r\n\r\n')
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        """Performs an HTTP request using a pooled connection and returns a (response, body) tuple.
+        The response body is always fully read so the connection can go back to the pool.
+        """
+        timeout = timeout or self.timeout
+        headers = headers or {}
+        start = time.time()
+        conn, reused = self._acquire(timeout)
+        try:
+            try:
+                response, data = self._send(conn, method, path, body, headers, timeout)
+            except socket.timeout:
+                raise
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused or not (body is None or isinstance(body, basestring)):
+                    raise
+                # The server closed the keep-alive connection while it was idle, retry once with a new one
+                self.stats.incr('reconnects')
+                conn = self._new_connection(timeout)
+                response, data = self._send(conn, method, path, body, headers, timeout)
+        except:
+            self.stats.incr('errors')
+            self._release(conn, reusable=False)
+            raise
+        self._release(conn, reusable=not response.will_close)
+        self.stats.record_request(time.time() - start)
+        return response, data
+
+    def close(self):
+        """Closes all idle connections. Connections currently in use are closed when released."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(host, port, max_size=DEFAULT_POOL_MAX_SIZE, timeout=DEFAULT_TIMEOUT):
+    """Returns the process-wide SolrConnectionPool for host:port, creating it the first time it is requested.
+    """
+    key = (host, port)
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = SolrConnectionPool(host, port, max_size=max_size, timeout=timeout)
+        return _connection_pools[key]
+
+
+def get_connection_pools_stats():
+    """Returns a dictionary with the stats of all the connection pools of the current process, keyed by host:port.
+    """
+    with _connection_pools_lock:
+        pools = _connection_pools.items()
+    return dict(('%s:%s' % key, pool.stats.as_dict()) for key, pool in pools)
+
+
 class Solr(object):
-    def __init__(self, url="http://localhost:8983/solr", auto_commit=True, verbose=False, persistent=False, encoder=BaseSolrAddEncoder(), decoder=SolrJsonResponseDecoder()):
+    def __init__(self, url="http://localhost:8983/solr", auto_commit=True, verbose=False, persistent=False, encoder=BaseSolrAddEncoder(), decoder=SolrJsonResponseDecoder(), timeout=None):
+        """Connections are taken from a process-wide keep-alive pool shared by all Solr objects pointing to the same
+        host, so creating a Solr object is cheap. The persistent parameter is kept for backwards compatibility only.
+        timeout: seconds to wait for Solr to answer each request, defaults to the pool timeout
+        """
         url_split = urlparse.urlparse(url)
 
         self.host = url_split.hostname
@@ -397,11 +708,10 @@ class Solr(object):
         self.auto_commit = auto_commit
 
         self.persistent = persistent
+        self.timeout = timeout
+        self.pool = get_connection_pool(self.host, self.port)
 
-        if self.persistent:
-            self.conn = httplib.HTTPConnection(self.host, self.port)
-
-    def _request(self, query_string="", message=""):
+    def _request(self, query_string="", message="", content_type='text/xml'):
         if query_string != "":
             path = '%s/select/?%s' % (self.path, query_string)
         else:
@@ -412,33 +722,35 @@ class Solr(object):
             print "\tPath:", path
             print "\tSending data:", message
 
-        if self.persistent:
-            conn = self.conn
+        if query_string and len(query_string) > MAX_GET_QUERY_LENGTH:
+            response, data = self.pool.request('POST', '%s/select' % self.path, query_string,
+                                               {'Content-type': 'application/x-www-form-urlencoded'},
+                                               timeout=self.timeout)
+        elif query_string:
+            response, data = self.pool.request('GET', path, timeout=self.timeout)
         else:
-            conn = httplib.HTTPConnection(self.host, self.port)
-
-        if query_string:
-            conn.request('GET', path)
-        elif message:
-            conn.request('POST', path, message, {'Content-type': 'text/xml'})
-
-        response = conn.getresponse()
+            response, data = self.pool.request('POST', path, message, {'Content-type': content_type},
+                                               timeout=self.timeout)
 
         if response.status != 200:
             raise SolrException, response.reason
 
-        return response
+        return data
 
     def select(self, query_string, raw=False):
         if raw:
-            return unicode(self._request(query_string=query_string).read())
+            return unicode(self._request(query_string=query_string), 'utf-8')
         else:
             return self.decoder.decode(self._request(query_string=query_string))
 
     def add(self, docs):
-        encoded_docs = self.encoder.encode(docs)
+        if hasattr(self.encoder, 'iter_encode'):
+            # Stream the documents to Solr while they are being encoded
+            encoded_docs = self.encoder.iter_encode(docs)
+        else:
+            encoded_docs = self.encoder.encode(docs)
         try:
-            self._request(message=encoded_docs)
+            self._request(message=encoded_docs, content_type=self.encoder.content_type)
         except error as e:
             raise SolrException, e
         #if self.auto_commit:
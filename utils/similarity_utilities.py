@@ -34,6 +34,11 @@ def get_similar_sounds(sound, preset=DEFAULT_PRESET, num_results=settings.SOUNDS
     if preset not in PRESETS:
         preset = DEFAULT_PRESET
 
+    # Use the precomputed results of the sound (see similarity_precompute_neighbours command) if there are enough
+    similar_sounds, count = get_precomputed_similar_sounds(sound, preset, num_results, offset)
+    if similar_sounds is not None:
+        return similar_sounds, count
+
     cache_key = "similar-for-sound-%s-%s-%i" % (sound.id, preset, offset)
 
     # Don't use the cache when we're debugging
@@ -67,6 +72,20 @@ def get_similar_sounds(sound, preset=DEFAULT_PRESET, num_results=settings.SOUNDS
     return similar_sounds[0:num_results], count
 
 
+def get_precomputed_similar_sounds(sound, preset, num_results, offset=0):
+    """Returns the (similar_sounds, count) results of the similarity search of the sound from its precomputed
+    similar sounds, or (None, None) if they have not been precomputed or do not include all the requested results."""
+    from sounds.models import SimilarSoundsList
+
+    similar_sounds_list = SimilarSoundsList.objects.filter(sound_id=sound.id, preset=preset).first()
+    if similar_sounds_list is None:
+        return None, None
+    results = similar_sounds_list.get_results()
+    if offset + num_results > len(results) and len(results) < similar_sounds_list.count:
+        return None, None
+    return results[offset:offset + num_results], similar_sounds_list.count
+
+
 def api_search(target=None, filter=None, preset=None, metric_descriptor_names=None, num_results=None, offset=None, target_file=None, in_ids=None):
 
     cache_key = 'api-search-t-%s-f-%s-nr-%s-o-%s' % (str(target).replace(" ", ""), str(filter).replace(" ", ""), num_results, offset)
@@ -59,6 +59,34 @@ def get_recommended_tags(input_tags, max_number_of_tags=30):
     return recommended_tags['tags'][:max_number_of_tags], recommended_tags['community']
 
 
+def get_recommended_tags_batch(input_tagss, max_number_of_tags=30):
+    """Same as get_recommended_tags for a list of sets of input tags. Recommendations that are not cached are
+    requested to the tag recommendation service all together in batch requests.
+    Returns a list of (tags, community) tuples (one for each set of input tags)."""
+
+    cache_keys = ["recommended-tags-for-%s" % md5(",".join(sorted(input_tags))).hexdigest()
+                  for input_tags in input_tagss]
+
+    cached_recommended_tags = dict()
+    # Don't use the cache when we're debugging
+    if not settings.DEBUG:
+        cached_recommended_tags = cache.get_many(cache_keys)
+
+    missing_positions = [i for i, cache_key in enumerate(cache_keys) if cache_key not in cached_recommended_tags]
+    if missing_positions:
+        new_recommended_tags = dict()
+        results = TagRecommendation.recommend_tags_batch([input_tagss[i] for i in missing_positions])
+        for i, recommended_tags in zip(missing_positions, results):
+            if not recommended_tags['tags']:
+                recommended_tags['community'] = "-"
+            new_recommended_tags[cache_keys[i]] = recommended_tags
+        cache.set_many(new_recommended_tags, TAGRECOMMENDATION_CACHE_TIME)
+        cached_recommended_tags.update(new_recommended_tags)
+
+    return [(cached_recommended_tags[cache_key]['tags'][:max_number_of_tags],
+             cached_recommended_tags[cache_key]['community']) for cache_key in cache_keys]
+
+
 def get_recommended_tags_view(request):
     if request.is_ajax() and request.method == 'POST':
         input_tags = request.POST.get('input_tags', False)
@@ -18,7 +18,7 @@
 #     See AUTHORS file.
 #
 
-from django.test import TestCase, override_settings
+from django.test import TestCase, SimpleTestCase, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.conf import settings
@@ -26,6 +26,11 @@ from django.core.cache import cache
 from utils.forms import filename_has_valid_extension
 from utils.tags import clean_and_split_tags
 from utils.text import clean_html
+from utils.tagrecommendation_utilities import get_recommended_tags_batch
+from utils.audioprocessing.processing import AudioProcessor, WaveformImage, SpectrogramImage, MultiResolutionPeaks, \
+    read_peaks_file, interpolate_colors
+from utils.audioprocessing.color_schemes import COLOR_SCHEMES, DEFAULT_COLOR_SCHEME_KEY
+from PIL import Image, ImageDraw
 from utils.sound_upload import get_csv_lines, validate_input_csv_file, bulk_describe_from_csv, create_sound, \
     NoAudioException, AlreadyExistsException
 from sounds.models import Sound, Pack, License, Download
@@ -35,6 +40,10 @@ import datetime
 import utils.downloads
 import tempfile
 import os
+import mock
+import numpy
+import timeit
+import math
 
 
 class UtilsTest(TestCase):
@@ -562,3 +571,219 @@ class BulkDescribeUtils(TestCase):
         # Delete tmp directories
         shutil.rmtree(settings.UPLOADS_PATH)
         shutil.rmtree(settings.CSV_PATH)
+
+
+class FakeSndfile(object):
+    """Mimics audiolab.Sndfile reading the samples from an array"""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.nframes = samples.shape[0]
+        self.channels = samples.shape[1] if samples.ndim > 1 else 1
+        self.samplerate = 44100
+        self.position = 0
+
+    def seek(self, position):
+        self.position = position
+
+    def read_frames(self, frames_to_read):
+        samples = self.samples[self.position:self.position + frames_to_read].copy()
+        self.position += len(samples)
+        return samples
+
+    def close(self):
+        pass
+
+
+class AudioProcessorTest(SimpleTestCase):
+
+    def test_analyze_same_as_column_by_column(self):
+        # Stereo file (only left channel is used) with silence at the beginning
+        numpy.random.seed(0)
+        samples = 0.5 * numpy.sin(numpy.arange(20000) * 0.05) * numpy.random.random(20000)
+        samples[:2000] = 0
+        samples = numpy.column_stack((samples, -samples))
+
+        for image_width in [8, 900, 25000]:  # Columns longer than the fft, shorter than the fft, and with no samples
+            with mock.patch('utils.audioprocessing.processing.audiolab', create=True) as audiolab:
+                audiolab.Sndfile.side_effect = lambda filename, mode: FakeSndfile(samples)
+                processor = AudioProcessor('test.wav', 256)
+                processor.block_size = 2 ** 12  # Use several blocks
+                peaks, spectral_centroids, db_spectra = processor.analyze(image_width)
+
+                samples_per_pixel = samples.shape[0] / float(image_width)
+                for x in range(0, image_width, max(1, image_width / 50)):
+                    seek_point = int(x * samples_per_pixel)
+                    next_seek_point = int((x + 1) * samples_per_pixel)
+                    spectral_centroid, db_spectrum = processor.spectral_centroid(seek_point)
+                    self.assertEqual(tuple(peaks[x]), processor.peaks(seek_point, next_seek_point))
+                    self.assertAlmostEqual(spectral_centroids[x], spectral_centroid)
+                    self.assertTrue(numpy.allclose(db_spectra[x], db_spectrum))
+
+
+class MultiResolutionPeaksTest(SimpleTestCase):
+
+    def test_peaks_file(self):
+        numpy.random.seed(0)
+        samples = numpy.random.random(10000) * 2 - 1
+        multi_resolution_peaks = MultiResolutionPeaks(samples_per_pixel=(16, 64, 256))
+        # Add samples in blocks which are not multiple of the samples per pixel
+        for i in range(0, len(samples), 1000):
+            multi_resolution_peaks.add_samples(samples[i:i + 1000])
+
+        output_dir = tempfile.mkdtemp()
+        peaks_path = os.path.join(output_dir, 'peaks.dat')
+        multi_resolution_peaks.save(peaks_path, 44100)
+        peaks_file = read_peaks_file(peaks_path)
+        shutil.rmtree(output_dir)
+
+        self.assertEqual(peaks_file['samplerate'], 44100)
+        self.assertEqual(peaks_file['num_samples'], len(samples))
+        self.assertEqual([samples_per_pixel for samples_per_pixel, peaks in peaks_file['levels']], [16, 64, 256])
+        for samples_per_pixel, peaks in peaks_file['levels']:
+            # Last pixel is computed with the remaining samples
+            self.assertEqual(len(peaks), (len(samples) + samples_per_pixel - 1) / samples_per_pixel)
+            for pixel in [0, 7, len(peaks) - 1]:
+                pixel_samples = samples[pixel * samples_per_pixel:(pixel + 1) * samples_per_pixel]
+                self.assertEqual(peaks[pixel][0], int(round(pixel_samples.min() * 127)))
+                self.assertEqual(peaks[pixel][1], int(round(pixel_samples.max() * 127)))
+
+    def test_peaks_computed_while_analyzing(self):
+        samples = numpy.sin(numpy.arange(30000) * 0.01)
+        with mock.patch('utils.audioprocessing.processing.audiolab', create=True) as audiolab:
+            audiolab.Sndfile.side_effect = lambda filename, mode: FakeSndfile(samples)
+            processor = AudioProcessor('test.wav', 256)
+            processor.block_size = 2 ** 12
+            multi_resolution_peaks = MultiResolutionPeaks(samples_per_pixel=(100,))
+            processor.analyze(50, samples_callback=multi_resolution_peaks.add_samples)
+
+        self.assertEqual(multi_resolution_peaks.num_samples, len(samples))
+        samples_per_pixel, min_values, max_values = multi_resolution_peaks.get_levels()[0]
+        self.assertTrue(numpy.array_equal(min_values, samples.reshape((300, 100)).min(axis=1)))
+        self.assertTrue(numpy.array_equal(max_values, samples.reshape((300, 100)).max(axis=1)))
+
+
+def draw_waveform_with_pil(image_width, image_height, peaks, spectral_centroids):
+    # Waveform drawn column by column with PIL as in previous versions of WaveformImage
+    waveform_colors = COLOR_SCHEMES[DEFAULT_COLOR_SCHEME_KEY]['wave_colors']
+    color_lookup = interpolate_colors(waveform_colors[1:])
+    image = Image.new("RGB", (image_width, image_height), waveform_colors[0])
+    draw = ImageDraw.Draw(image)
+    pix = image.load()
+    previous_x, previous_y = None, None
+    for x in range(image_width):
+        y1 = image_height * 0.5 - peaks[x][0] * (image_height - 4) * 0.5
+        y2 = image_height * 0.5 - peaks[x][1] * (image_height - 4) * 0.5
+        line_color = color_lookup[int(spectral_centroids[x] * 255.0)]
+        if previous_y is not None:
+            draw.line([previous_x, previous_y, x, y1, x, y2], line_color)
+        else:
+            draw.line([x, y1, x, y2], line_color)
+        previous_x, previous_y = x, y2
+        # Vertical anti-aliasing below and above the line
+        for y, alpha, row in [(max(y1, y2), max(y1, y2) - int(max(y1, y2)), int(max(y1, y2)) + 1),
+                              (min(y1, y2), 1.0 - (min(y1, y2) - int(min(y1, y2))), int(min(y1, y2)) - 1)]:
+            if 0.0 < alpha < 1.0 and 0 <= row < image_height:
+                current_pix = pix[x, row]
+                pix[x, row] = tuple(int((1 - alpha) * current_pix[i] + alpha * line_color[i]) for i in range(3))
+    return numpy.array(image)
+
+
+def draw_spectrogram_with_pil(image_width, image_height, fft_size, spectra):
+    # Spectrogram drawn column by column with PIL as in previous versions of SpectrogramImage
+    palette = interpolate_colors(COLOR_SCHEMES[DEFAULT_COLOR_SCHEME_KEY]['spec_colors'])
+    y_to_bin = []
+    y_min, y_max = math.log10(100.0), math.log10(22050.0)
+    for y in range(image_height):
+        freq = math.pow(10.0, y_min + y / (image_height - 1.0) * (y_max - y_min))
+        bin = freq / 22050.0 * (fft_size / 2 + 1)
+        if bin < fft_size / 2:
+            y_to_bin.append((int(bin), (bin - int(bin)) * 255))
+    pixels = []
+    for spectrum in spectra:
+        for (index, alpha) in y_to_bin:
+            pixels.append(palette[int((255.0 - alpha) * spectrum[index] + alpha * spectrum[index + 1])])
+        for y in range(len(y_to_bin), image_height):
+            pixels.append(palette[0])
+    image = Image.new("RGB", (image_height, image_width))
+    image.putdata(pixels)
+    return numpy.array(image.transpose(Image.ROTATE_90))
+
+
+class WaveImagesTest(SimpleTestCase):
+
+    def test_waveform_image_pixels(self):
+        waveform = WaveformImage(3, 11, 'Freesound2')
+        waveform.draw_peaks(numpy.array([[0.5, -0.5], [0.0, 0.0], [-0.5, 0.5]]), numpy.zeros(3))
+        line_color = (50, 0, 200)  # Lowest spectral centroid color of Freesound2 color scheme
+
+        # First column: line between both peaks, anti-aliased pixels above and below
+        self.assertEqual([tuple(pixel) for pixel in waveform.pixels[3:8, 0]], [line_color] * 5)
+        self.assertEqual(tuple(waveform.pixels[2, 0]), (12, 0, 50))
+        self.assertEqual(tuple(waveform.pixels[8, 0]), (12, 0, 50))
+        self.assertEqual(tuple(waveform.pixels[1, 0]), (0, 0, 0))
+
+        # Second column: second half of the line joining the last peak of the first column with the (silent) peaks
+        self.assertEqual([tuple(pixel) for pixel in waveform.pixels[4:8, 1]],
+                         [(25, 0, 100), line_color, line_color, (0, 0, 0)])
+
+    def test_render_images_benchmark(self):
+        # Draw 'L' size displays (see freesound_audio_processing.process) with random data and compare them with the
+        # images drawn column by column with PIL (as in previous versions). Only the relative speed of both is checked
+        # so that the test does not depend on the speed of the machine (numpy drawing is ~10x faster).
+        image_width, image_height, fft_size = 900, 201, 2048
+        random_state = numpy.random.RandomState(0)
+        peaks = random_state.random_sample((image_width, 2)) * 2 - 1
+        spectral_centroids = random_state.random_sample(image_width)
+        spectra = random_state.random_sample((image_width, fft_size / 2 + 1))
+
+        def draw_with_numpy():
+            waveform = WaveformImage(image_width, image_height, None)
+            waveform.draw_peaks(peaks, spectral_centroids)
+            spectrogram = SpectrogramImage(image_width, image_height, fft_size, None)
+            spectrogram.draw_spectra(spectra)
+            return waveform.pixels, spectrogram.pixels
+
+        def draw_with_pil():
+            return draw_waveform_with_pil(image_width, image_height, peaks, spectral_centroids), \
+                   draw_spectrogram_with_pil(image_width, image_height, fft_size, spectra)
+
+        waveform_pixels, spectrogram_pixels = draw_with_numpy()
+        pil_waveform_pixels, pil_spectrogram_pixels = draw_with_pil()
+        self.assertTrue(numpy.array_equal(waveform_pixels, pil_waveform_pixels))
+        self.assertTrue(numpy.array_equal(spectrogram_pixels, pil_spectrogram_pixels))
+
+        numpy_time = min(timeit.repeat(draw_with_numpy, number=1, repeat=3))
+        pil_time = min(timeit.repeat(draw_with_pil, number=1, repeat=3))
+        self.assertLess(numpy_time * 3, pil_time)
+
+
+class RecommendedTagsBatchTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @mock.patch('utils.tagrecommendation_utilities.TagRecommendation.recommend_tags_batch')
+    def test_get_recommended_tags_batch(self, recommend_tags_batch):
+        recommend_tags_batch.return_value = [
+            {'tags': ['loop', 'electronic'], 'community': 'Music'},
+            {'tags': [], 'community': 'Fx'},
+        ]
+        results = get_recommended_tags_batch([['drum', 'beat'], ['xyz']], max_number_of_tags=1)
+        recommend_tags_batch.assert_called_once_with([['drum', 'beat'], ['xyz']])
+        self.assertEqual(results, [(['loop'], 'Music'), ([], '-')])
+
+        # Cached recommendations (the order of input tags does not matter) are not requested again
+        recommend_tags_batch.reset_mock()
+        recommend_tags_batch.return_value = [{'tags': ['field-recording'], 'community': 'Soundscape'}]
+        results = get_recommended_tags_batch([['beat', 'drum'], ['birds'], ['xyz']])
+        recommend_tags_batch.assert_called_once_with([['birds']])
+        self.assertEqual(results, [(['loop', 'electronic'], 'Music'), (['field-recording'], 'Soundscape'), ([], '-')])
+
+    @mock.patch('utils.tagrecommendation_utilities.TagRecommendation.recommend_tags_batch')
+    def test_get_recommended_tags_batch_all_cached(self, recommend_tags_batch):
+        recommend_tags_batch.return_value = [{'tags': ['loop'], 'community': 'Music'}]
+        get_recommended_tags_batch([['drum']])
+        recommend_tags_batch.reset_mock()
+        self.assertEqual(get_recommended_tags_batch([['drum']]), [(['loop'], 'Music')])
+        recommend_tags_batch.assert_not_called()